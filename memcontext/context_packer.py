@@ -0,0 +1,179 @@
+import re
+import threading
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Prompt sections in the order slack budget is handed out; quotas are fractions of the total budget
+SECTIONS = ("history", "pages", "profile", "user_knowledge", "assistant_knowledge")
+DEFAULT_QUOTAS = {"history": 0.25, "pages": 0.45, "profile": 0.1, "user_knowledge": 0.1, "assistant_knowledge": 0.1}
+OVERFLOW_MODES = ("summarize", "truncate", "drop")
+
+_CJK_CHAR = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+_TRUNCATION_MARK = " ...[truncated]"
+
+_encoder_lock = threading.Lock()
+_encoders = {}
+
+
+def get_encoder(model_name):
+    """按模型名缓存 tiktoken 编码器；未安装 tiktoken 或编码表不可用时返回 None（改用估算）"""
+    with _encoder_lock:
+        if model_name in _encoders:
+            return _encoders[model_name]
+        encoder = None
+        if tiktoken is not None:
+            try:
+                encoder = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                try:
+                    encoder = tiktoken.get_encoding("cl100k_base") # Non-OpenAI model names
+                except Exception as e:
+                    print(f"ContextPacker: Could not load tiktoken encoding, estimating token counts: {e}")
+            except Exception as e:
+                print(f"ContextPacker: Could not load tiktoken encoding, estimating token counts: {e}")
+        _encoders[model_name] = encoder
+        return encoder
+
+
+def _estimate_tokens(text):
+    # Roughly one token per CJK character and per four other characters
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text, model_name="gpt-4o-mini"):
+    """文本的 token 数（结果按 (text, model_name) 缓存，同一 page 在多轮对话中只编码一次）"""
+    if not text:
+        return 0
+    encoder = get_encoder(model_name)
+    if encoder is None:
+        return _estimate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens, model_name="gpt-4o-mini"):
+    """截断到不超过 max_tokens 个 token（含截断标记）；本身未超出时原样返回"""
+    if count_tokens(text, model_name) <= max_tokens:
+        return text
+    budget = max_tokens - count_tokens(_TRUNCATION_MARK, model_name)
+    if budget <= 0:
+        return ""
+    encoder = get_encoder(model_name)
+    if encoder is not None:
+        return encoder.decode(encoder.encode(text, disallowed_special=())[:budget]) + _TRUNCATION_MARK
+    used, end = 0, 0
+    for end, char in enumerate(text):
+        used += 1 if _CJK_CHAR.match(char) else 0.25
+        if used > budget:
+            break
+    return text[:end] + _TRUNCATION_MARK
+
+
+class ContextItem:
+    """
+    待装入 prompt 的一条内容。score 越高越优先保留，输出仍按原顺序；
+    short 为超出预算时的摘要形式（如 page 的 meta_info），overflow="summarize" 时使用。
+    """
+
+    __slots__ = ("text", "score", "short")
+
+    def __init__(self, text, score=0.0, short=None):
+        self.text = text
+        self.score = score
+        self.short = short
+
+
+class ContextPacker:
+    """
+    把短期历史、检索到的 page、用户画像和知识装入固定的 token 预算：
+    - 每个 section 先按 quotas（占总预算的比例）分配，用不完的部分按比例分给仍超出的 section
+    - section 放得下时内容保持不变；超出时单条先截断到 max_item_tokens，再按 score 从高到低装入
+    - 装不下的条目：summarize 改用其 short 形式（没有 short 时同 truncate），truncate 截断到剩余预算，drop 直接丢弃
+    """
+
+    def __init__(self, token_budget=8000, quotas=None, model_name="gpt-4o-mini", max_item_tokens=512,
+                 overflow="summarize", min_item_tokens=32):
+        if overflow not in OVERFLOW_MODES:
+            raise ValueError(f"Unknown overflow mode '{overflow}', expected one of {OVERFLOW_MODES}")
+        self.token_budget = token_budget
+        self.quotas = dict(DEFAULT_QUOTAS if quotas is None else quotas)
+        self.model_name = model_name
+        self.max_item_tokens = max_item_tokens
+        self.overflow = overflow
+        self.min_item_tokens = min_item_tokens
+        self.last_stats = {}
+
+    def count(self, text):
+        return count_tokens(text, self.model_name)
+
+    def _allocate(self, needs):
+        """按 quotas 注水式分配预算，返回 {section: token 数}"""
+        alloc = {name: need for name, need in needs.items() if need == 0}
+        pending = [name for name in SECTIONS if needs.get(name)] + [name for name in needs if name not in SECTIONS and needs[name]]
+        remaining = self.token_budget
+        while pending:
+            weight = sum(self.quotas.get(name, 0) for name in pending)
+            if weight <= 0:
+                alloc.update({name: 0 for name in pending})
+                break
+            share = {name: remaining * self.quotas.get(name, 0) / weight for name in pending}
+            satisfied = [name for name in pending if needs[name] <= share[name]]
+            if not satisfied:
+                alloc.update({name: int(share[name]) for name in pending})
+                break
+            for name in satisfied:
+                alloc[name] = needs[name]
+                remaining -= needs[name]
+            pending = [name for name in pending if name not in satisfied]
+        return alloc
+
+    def _fit(self, items, budget):
+        """在 budget 内选出条目，返回 [(item, text), ...]（保持原顺序）"""
+        if sum(self.count(item.text) for item in items) <= budget:
+            return [(item, item.text) for item in items]
+        texts = {id(item): truncate_to_tokens(item.text, self.max_item_tokens, self.model_name) for item in items}
+        chosen = {}
+        remaining = budget
+        overflow = []
+        for item in sorted(items, key=lambda item: item.score, reverse=True):
+            cost = self.count(texts[id(item)])
+            if cost <= remaining:
+                chosen[id(item)] = texts[id(item)]
+                remaining -= cost
+            else:
+                overflow.append(item)
+        for item in overflow:
+            if remaining < self.min_item_tokens or self.overflow == "drop":
+                break
+            short = item.short if self.overflow == "summarize" else None
+            if short:
+                cost = self.count(short)
+                if cost <= remaining:
+                    chosen[id(item)] = short
+                    remaining -= cost
+                continue
+            # Items without a short form (e.g. the profile) are truncated into what is left
+            text = truncate_to_tokens(texts[id(item)], remaining, self.model_name)
+            if text:
+                chosen[id(item)] = text
+                remaining -= self.count(text)
+        return [(item, chosen[id(item)]) for item in items if id(item) in chosen]
+
+    def pack(self, sections):
+        """
+        sections: {section: [ContextItem, ...]}，返回 {section: [(item, 装入的文本), ...]}；
+        本次的 token 统计写入 last_stats。
+        """
+        needs = {name: sum(self.count(item.text) for item in items) for name, items in sections.items()}
+        alloc = self._allocate(needs)
+        packed = {name: self._fit(items, alloc.get(name, 0)) for name, items in sections.items()}
+        used = {name: sum(self.count(text) for _, text in entries) for name, entries in packed.items()}
+        self.last_stats = {"budget": self.token_budget, "needed": needs, "allocated": alloc, "used": used}
+        if sum(needs.values()) > self.token_budget:
+            print(f"ContextPacker: Packed {sum(needs.values())} tokens of context into {sum(used.values())} (budget {self.token_budget}).")
+        return packed
@@ -0,0 +1,138 @@
+import hashlib
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .sqlite_kv import SqliteKVStore
+
+
+class EmbeddingCache:
+    """
+    线程安全、按字节数限制容量的 LRU embedding 缓存。
+
+    key 为 sha256(模型配置 + 文本)，跨进程稳定；可选的 SQLite 磁盘层（disk_path）
+    让重启后的服务仍能命中已计算过的 embedding。内存未命中时查询磁盘并提升到内存。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, disk_path=None, disk_max_entries=500_000):
+        self.max_bytes = max_bytes
+        self.disk_max_entries = disk_max_entries
+        self._entries = OrderedDict()   # key -> read-only float32 vector
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_path:
+            self.attach_disk(disk_path)
+
+    @staticmethod
+    def make_key(model_config_key, text):
+        return hashlib.sha256(f"{model_config_key}\x00{text}".encode("utf-8")).hexdigest()
+
+    @property
+    def disk_path(self):
+        return self._disk.db_path if self._disk is not None else None
+
+    def attach_disk(self, disk_path, replace=True):
+        """
+        启用（或切换）磁盘层；相同路径重复调用为空操作，replace=False 时已有磁盘层则保持不变。
+        切换时不关闭旧的磁盘层：其他线程可能刚在锁外取到它，连接随最后一个引用释放。
+        """
+        with self._lock:
+            if self._disk is not None and (self._disk.db_path == disk_path or not replace):
+                return
+            self._disk = SqliteKVStore(disk_path, table="embeddings", max_entries=self.disk_max_entries)
+
+    # ---- (de)serialization for the disk tier: 4-byte dim header + float32 payload ----
+    @staticmethod
+    def _encode(vec):
+        return struct.pack("<I", vec.shape[0]) + vec.tobytes()
+
+    @staticmethod
+    def _decode(blob):
+        (dim,) = struct.unpack_from("<I", blob)
+        return np.frombuffer(blob, dtype=np.float32, count=dim, offset=4) # Read-only view
+
+    def _put_memory_locked(self, key, vec):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        self._entries[key] = vec
+        self._bytes += vec.nbytes
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+    @staticmethod
+    def _freeze(vec):
+        vec = np.array(vec, dtype=np.float32).reshape(-1)
+        vec.setflags(write=False) # Shared between callers, must not be modified in place
+        return vec
+
+    def get_many(self, keys):
+        """返回 {key: vector}，仅包含命中的 key"""
+        keys = list(keys)
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                vec = self._entries.get(key)
+                if vec is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = vec
+                    self.hits += 1
+                else:
+                    missing.append(key)
+            disk = self._disk
+        blobs = disk.get_many(missing) if missing and disk is not None else {}
+        with self._lock:
+            for key, blob in blobs.items():
+                vec = self._decode(blob)
+                self._put_memory_locked(key, vec)
+                found[key] = vec
+            self.disk_hits += len(blobs)
+            self.misses += len(missing) - len(blobs)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items):
+        """写入 [(key, vector), ...]；返回缓存中的只读向量列表"""
+        frozen = [(key, self._freeze(vec)) for key, vec in items]
+        with self._lock:
+            for key, vec in frozen:
+                self._put_memory_locked(key, vec)
+            disk = self._disk
+        if disk is not None and frozen:
+            disk.put_many((key, self._encode(vec)) for key, vec in frozen)
+        return [vec for _, vec in frozen]
+
+    def put(self, key, vec):
+        return self.put_many([(key, vec)])[0]
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if disk and self._disk is not None:
+                self._disk.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_path": self.disk_path,
+            }
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,139 @@
+import glob
+import json
+import os
+import threading
+
+import numpy as np
+
+from .utils import ensure_directory_exists
+from .storage import write_json_atomic
+
+
+class EmbeddingStore:
+    """
+    二进制 embedding 旁路存储：向量以 float32 行追加写入 <base_path>.<generation>.f32，
+    JSON 记录中只保存行号（*_embedding_row）。读取通过 np.memmap 零拷贝完成。
+
+    删除的行不会立即回收，由调用方在写完整快照时调用 compact() 生成新一代文件；
+    新一代文件在快照写入后才替代旧文件，因此崩溃时旧快照仍指向完整的旧文件。
+    """
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.generation = 0
+        self.dim = None
+        self._count = 0
+        self._mmap = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def file_path(self):
+        return f"{self.base_path}.{self.generation}.f32"
+
+    @property
+    def meta_path(self):
+        # Records dim for WAL-only stores that have no snapshot yet
+        return f"{self.base_path}.meta.json"
+
+    def _read_meta_dim(self):
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("dim")
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def state(self):
+        """写入快照 JSON 的元信息"""
+        return {"generation": self.generation, "dim": self.dim}
+
+    def open(self, state=None):
+        """按快照中记录的 generation 打开已有文件；截断崩溃时写了一半的行"""
+        with self._lock:
+            state = state or {}
+            self.generation = state.get("generation", 0)
+            self.dim = state.get("dim") or self._read_meta_dim()
+            self._mmap = None
+            self._count = 0
+            if self.dim and os.path.exists(self.file_path):
+                row_bytes = self.dim * 4
+                size = os.path.getsize(self.file_path)
+                if size % row_bytes:
+                    with open(self.file_path, "r+b") as f:
+                        f.truncate(size - size % row_bytes)
+                    size -= size % row_bytes
+                self._count = size // row_bytes
+            self.drop_stale_files()
+
+    def _remap(self):
+        if self._count == 0:
+            self._mmap = None
+            return
+        self._mmap = np.memmap(self.file_path, dtype=np.float32, mode="r", shape=(self._count, self.dim))
+
+    def append(self, vectors):
+        """追加一行或多行向量，返回对应的行号列表"""
+        arr = np.asarray(vectors, dtype=np.float32)
+        if arr.ndim == 1:
+            arr = arr.reshape(1, -1)
+        if arr.shape[0] == 0:
+            return []
+        with self._lock:
+            if self.dim is None:
+                self.dim = arr.shape[1]
+                write_json_atomic(self.meta_path, {"dim": self.dim})
+            if arr.shape[1] != self.dim:
+                raise ValueError(f"Embedding dim {arr.shape[1]} does not match store dim {self.dim}")
+            ensure_directory_exists(self.file_path)
+            with open(self.file_path, "ab") as f:
+                f.write(np.ascontiguousarray(arr).tobytes())
+            first_row = self._count
+            self._count += arr.shape[0]
+            return list(range(first_row, self._count))
+
+    def get(self, row):
+        """返回只读的 memmap 行视图（零拷贝）"""
+        with self._lock:
+            if row is None or row < 0 or row >= self._count:
+                return None
+            if self._mmap is None or row >= self._mmap.shape[0]:
+                self._remap()
+            return self._mmap[row]
+
+    def take(self, rows):
+        """按行号批量读取，返回连续的 (n, dim) float32 矩阵"""
+        with self._lock:
+            if not len(rows):
+                return np.zeros((0, self.dim or 0), dtype=np.float32)
+            if self._mmap is None or max(rows) >= self._mmap.shape[0]:
+                self._remap()
+            return np.ascontiguousarray(self._mmap[np.asarray(rows, dtype=np.int64)])
+
+    def needs_compaction(self, live_count, min_garbage=1024):
+        return self._count - live_count > max(min_garbage, live_count)
+
+    def compact(self, live_rows):
+        """
+        只保留 live_rows，写入下一代文件并返回 {old_row: new_row}。
+        旧文件在调用方写完快照后由 drop_stale_files() 删除。
+        """
+        with self._lock:
+            live_rows = sorted(set(r for r in live_rows if r is not None and 0 <= r < self._count))
+            vectors = self.take(live_rows)
+            self.generation += 1
+            ensure_directory_exists(self.file_path)
+            with open(self.file_path, "wb") as f:
+                f.write(vectors.tobytes())
+            self._count = len(live_rows)
+            self._mmap = None
+            return {old: new for new, old in enumerate(live_rows)}
+
+    def drop_stale_files(self):
+        for path in glob.glob(f"{glob.escape(self.base_path)}.*.f32"):
+            if path != self.file_path:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"EmbeddingStore: Could not remove stale embedding file {path}: {e}")
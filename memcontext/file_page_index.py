@@ -0,0 +1,138 @@
+import bisect
+import heapq
+import json
+import os
+
+from .utils import ensure_directory_exists
+from .storage import write_json_atomic
+
+
+def page_file_id(meta):
+    """page 关联的文件 ID：优先 file_storage_id，没有时用 source_file_id"""
+    if not isinstance(meta, dict):
+        return None
+    return meta.get("file_storage_id") or meta.get("source_file_id")
+
+
+def segment_start(meta):
+    """
+    片段开始时间，用于同一文件内排序：解析 time_range（如 "240.00s-274.50s" 或 "240.00-274.50"）的起点，
+    没有 time_range 时退回 chunk_index。
+    """
+    if not isinstance(meta, dict):
+        return 0
+    time_range = meta.get("time_range", "")
+    if isinstance(time_range, str) and "-" in time_range:
+        try:
+            return float(time_range.split("-")[0].replace("s", "").strip())
+        except ValueError:
+            return 0
+    start = meta.get("chunk_index", 0)
+    return start if isinstance(start, (int, float)) else 0
+
+
+class FilePageIndex:
+    """
+    多模态 page 的二级索引：
+    - 文件 ID -> [(片段开始时间, session_id, page_id), ...]，按开始时间有序
+    - source_file_id -> file_storage_id，用 source_file_id 查询时先映射到存储 ID
+    只依赖 page 的 meta_data，持久化为 JSON 旁路文件（如 mid_term_file_index.json），加载时不需要读取 details。
+    """
+
+    def __init__(self):
+        self._files = {}  # file_id -> sorted [(start, session_id, page_id)]
+        self._docs = {}  # (session_id, page_id) -> (file_id, start)
+        self.source_to_storage = {}
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._docs)
+
+    def clear(self):
+        self._files = {}
+        self._docs = {}
+        self.source_to_storage = {}
+        self.dirty = True
+
+    def file_ids(self):
+        return list(self._files)
+
+    def add(self, session_id, page):
+        meta = page.get("meta_data")
+        file_id = page_file_id(meta)
+        if not file_id:
+            return
+        source_file_id, storage_id = meta.get("source_file_id"), meta.get("file_storage_id")
+        if source_file_id and storage_id and self.source_to_storage.get(source_file_id) != storage_id:
+            self.source_to_storage[source_file_id] = storage_id
+        doc = (session_id, page.get("page_id"))
+        self.remove(*doc)
+        start = segment_start(meta)
+        bisect.insort(self._files.setdefault(file_id, []), (start, session_id, doc[1]))
+        self._docs[doc] = (file_id, start)
+        self.dirty = True
+
+    def remove(self, session_id, page_id):
+        located = self._docs.pop((session_id, page_id), None)
+        if located is None:
+            return
+        file_id, start = located
+        entries = self._files[file_id]
+        entries.pop(bisect.bisect_left(entries, (start, session_id, page_id)))
+        if not entries:
+            del self._files[file_id]
+        self.dirty = True
+
+    def remove_session(self, session_id, page_ids):
+        for page_id in page_ids:
+            self.remove(session_id, page_id)
+        self.dirty = True
+
+    def resolve(self, file_id):
+        """把 source_file_id 映射为索引中使用的 file_storage_id（已是存储 ID 时原样返回）"""
+        return self.source_to_storage.get(file_id, file_id)
+
+    def pages(self, file_id=None):
+        """
+        返回 [(session_id, page_id), ...]，按片段开始时间排序；file_id 为 None 时按开始时间合并所有文件。
+        source_file_id 同时匹配以它本身和以对应 file_storage_id 索引的 page。
+        """
+        if file_id is None:
+            lists = self._files.values()
+        else:
+            lists = [self._files[key] for key in {file_id, self.resolve(file_id)} if key in self._files]
+        return [(sid, page_id) for _, sid, page_id in heapq.merge(*lists)]
+
+    def save(self, file_path, meta=None):
+        """未变化时不写盘"""
+        if not self.dirty:
+            return
+        data = {
+            "meta": meta or {},
+            "pages": [[sid, page_id, file_id, start] for (sid, page_id), (file_id, start) in self._docs.items()],
+            "source_to_storage": self.source_to_storage,
+        }
+        ensure_directory_exists(file_path)
+        write_json_atomic(file_path, data)
+        self.dirty = False
+
+    def load(self, file_path):
+        """加载成功返回保存时的 meta，文件不存在或损坏返回 None"""
+        if not os.path.exists(file_path):
+            return None
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"FilePageIndex: Could not load {file_path}: {e}")
+            return None
+        self._files = {}
+        self._docs = {}
+        for sid, page_id, file_id, start in data.get("pages", []):
+            self._files.setdefault(file_id, []).append((start, sid, page_id))
+            self._docs[(sid, page_id)] = (file_id, start)
+        for entries in self._files.values():
+            entries.sort()
+        self.source_to_storage = data.get("source_to_storage", {})
+        self.dirty = False
+        return data.get("meta", {})
@@ -0,0 +1,175 @@
+import numpy as np
+
+
+class IndexedMaxHeap:
+    """
+    带位置索引的最大堆：按 key 以 O(log n) 插入 / 更新 / 删除，O(1) 查看最大值。
+    中期记忆用它按 H_segment 维护最热的 session（替代每次全量重建的 heapq 列表）。
+
+    优先级相同时 key 较小者优先，与原来 heapq 中 (-heat, session_id) 元组的顺序一致。
+    """
+
+    def __init__(self, items=None):
+        self._heap = []  # [(priority, key)]
+        self._pos = {}   # key -> index in self._heap
+        if items is not None:
+            self.rebuild(items)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __bool__(self):
+        return bool(self._heap)
+
+    def __contains__(self, key):
+        return key in self._pos
+
+    def _before(self, i, j):
+        (pi, ki), (pj, kj) = self._heap[i], self._heap[j]
+        return pi > pj or (pi == pj and ki < kj)
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._pos[heap[i][1]] = i
+        self._pos[heap[j][1]] = j
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if not self._before(i, parent):
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        n = len(self._heap)
+        while True:
+            best = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and self._before(child, best):
+                    best = child
+            if best == i:
+                break
+            self._swap(i, best)
+            i = best
+
+    def rebuild(self, items):
+        """用 [(key, priority), ...] 整体重建，O(n)"""
+        self._heap = [(priority, key) for key, priority in items]
+        self._pos = {key: i for i, (_, key) in enumerate(self._heap)}
+        for i in reversed(range(len(self._heap) // 2)):
+            self._sift_down(i)
+
+    def update(self, key, priority):
+        """插入 key，或修改已有 key 的优先级"""
+        i = self._pos.get(key)
+        if i is None:
+            self._heap.append((priority, key))
+            i = self._pos[key] = len(self._heap) - 1
+            self._sift_up(i)
+            return
+        old_priority = self._heap[i][0]
+        self._heap[i] = (priority, key)
+        if priority > old_priority:
+            self._sift_up(i)
+        else:
+            self._sift_down(i)
+
+    def remove(self, key):
+        i = self._pos.pop(key, None)
+        if i is None:
+            return False
+        last = self._heap.pop()
+        if i < len(self._heap):
+            self._heap[i] = last
+            self._pos[last[1]] = i
+            self._sift_up(i)
+            self._sift_down(self._pos[last[1]])
+        return True
+
+    def peek(self):
+        """返回 (key, priority)，堆为空时返回 None"""
+        if not self._heap:
+            return None
+        priority, key = self._heap[0]
+        return key, priority
+
+    def pop(self):
+        top = self.peek()
+        if top is not None:
+            self.remove(top[0])
+        return top
+
+    def priority(self, key):
+        i = self._pos.get(key)
+        return None if i is None else self._heap[i][0]
+
+    def clear(self):
+        self._heap = []
+        self._pos = {}
+
+
+class SessionHeatTable:
+    """
+    按列存放每个 session 的 N_visit / L_interaction / last_visit_epoch（numpy 数组），
+    用于一次性向量化计算所有 session 的热度：alpha*N + beta*L + gamma*exp(-dt/tau)。
+    """
+
+    def __init__(self, capacity=64):
+        self.session_ids = []
+        self._rows = {}
+        self._n_visit = np.zeros(capacity, dtype=np.float64)
+        self._l_interaction = np.zeros(capacity, dtype=np.float64)
+        self._last_visit = np.zeros(capacity, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.session_ids)
+
+    def __contains__(self, session_id):
+        return session_id in self._rows
+
+    def _grow(self):
+        capacity = max(64, 2 * len(self._n_visit))
+        for name in ("_n_visit", "_l_interaction", "_last_visit"):
+            column = np.zeros(capacity, dtype=np.float64)
+            column[:len(self.session_ids)] = getattr(self, name)[:len(self.session_ids)]
+            setattr(self, name, column)
+
+    def upsert(self, session_id, n_visit, l_interaction, last_visit_epoch):
+        row = self._rows.get(session_id)
+        if row is None:
+            if len(self.session_ids) == len(self._n_visit):
+                self._grow()
+            row = self._rows[session_id] = len(self.session_ids)
+            self.session_ids.append(session_id)
+        self._n_visit[row] = n_visit
+        self._l_interaction[row] = l_interaction
+        self._last_visit[row] = np.nan if last_visit_epoch is None else last_visit_epoch
+
+    def remove(self, session_id):
+        row = self._rows.pop(session_id, None)
+        if row is None:
+            return
+        last = len(self.session_ids) - 1
+        if row != last:
+            # Move the last row into the hole so the columns stay dense
+            moved = self.session_ids[last]
+            self.session_ids[row] = moved
+            self._rows[moved] = row
+            for column in (self._n_visit, self._l_interaction, self._last_visit):
+                column[row] = column[last]
+        self.session_ids.pop()
+
+    def clear(self):
+        self.session_ids = []
+        self._rows = {}
+
+    def compute(self, now, alpha, beta, gamma, tau_hours):
+        """返回 (heat, recency) 两个数组，顺序与 self.session_ids 一致"""
+        n = len(self.session_ids)
+        age_hours = (now - self._last_visit[:n]) / 3600.0
+        recency = np.exp(-age_hours / tau_hours)
+        recency[np.isnan(recency)] = 1.0 # No visit time recorded, same default as compute_segment_heat
+        heat = alpha * self._n_visit[:n] + beta * self._l_interaction[:n] + gamma * recency
+        return heat, recency
@@ -0,0 +1,115 @@
+import numpy as np
+
+
+class KnowledgeMatrix:
+    """
+    与 deque(maxlen=capacity) 对齐的环形 float32 embedding 矩阵：
+    deque 满后 FIFO 淘汰最旧条目时，新条目原地覆盖其所在行，检索为一次矩阵-向量乘 + argpartition。
+    矩阵按需倍增到 capacity（None 表示不限），满之前行号与 deque 下标一致。
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.dim = None
+        self._matrix = None
+        self._valid = np.zeros(0, dtype=bool)
+        self._entries = []
+        self._rows = {}  # id(entry) -> row
+        self._head = 0  # Row holding the oldest entry once the ring is full
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _ensure_rows(self, n_rows):
+        if len(self._entries) >= n_rows:
+            return
+        # Only grows while not full, so rows are still contiguous from 0 and copy as is
+        rows = max(64, 2 * n_rows) if self.capacity is None else min(self.capacity, max(64, 2 * n_rows))
+        valid = np.zeros(rows, dtype=bool)
+        valid[:self._count] = self._valid[:self._count]
+        self._valid = valid
+        self._entries.extend([None] * (rows - len(self._entries)))
+        if self._matrix is not None:
+            matrix = np.zeros((rows, self.dim), dtype=np.float32)
+            matrix[:self._count] = self._matrix[:self._count]
+            self._matrix = matrix
+
+    def append(self, entry, vector):
+        """追加一条（vector 为 None 时该条目不参与检索）；已满时覆盖最旧的一行，与 deque.append 行为一致"""
+        if self.capacity == 0:
+            return
+        vec = None if vector is None else np.asarray(vector, dtype=np.float32).reshape(-1)
+        if vec is not None and self._matrix is None:
+            self.dim = vec.shape[0]
+            self._matrix = np.zeros((len(self._entries), self.dim), dtype=np.float32)
+        if vec is not None and vec.shape[0] != self.dim:
+            print(f"KnowledgeMatrix: Embedding dim {vec.shape[0]} does not match {self.dim}, entry will not be searchable.")
+            vec = None
+        if self.capacity is None or self._count < self.capacity:
+            row = self._count
+            self._ensure_rows(row + 1)
+            self._count += 1
+        else:
+            row = self._head
+            self._head = (self._head + 1) % self.capacity
+        if self._entries[row] is not None:
+            self._rows.pop(id(self._entries[row]), None)
+        self._entries[row] = entry
+        self._rows[id(entry)] = row
+        self._valid[row] = vec is not None
+        if vec is not None:
+            self._matrix[row] = vec
+
+    def rebuild(self, entries_and_vectors):
+        """用 [(entry, vector), ...]（从旧到新）整体重建"""
+        self.dim = None
+        self._matrix = None
+        self._valid = np.zeros(0, dtype=bool)
+        self._entries = []
+        self._rows = {}
+        self._head = 0
+        self._count = 0
+        for entry, vector in entries_and_vectors:
+            self.append(entry, vector)
+
+    def _row_at(self, position):
+        # deque position (0 = oldest) -> matrix row
+        if self.capacity is None or self._count < self.capacity:
+            return position
+        return (self._head + position) % self.capacity
+
+    def position(self, entry):
+        """entry 在对齐的 deque 中的下标（0 为最旧），不在矩阵中时返回 None"""
+        row = self._rows.get(id(entry))
+        if row is None or self._entries[row] is not entry:
+            return None
+        if self.capacity is None or self._count < self.capacity:
+            return row
+        return (row - self._head) % self.capacity
+
+    def swap(self, position_a, position_b):
+        """交换两个 deque 下标对应的行（调用方同时交换 deque 中的两个条目），O(dim)"""
+        row_a, row_b = self._row_at(position_a), self._row_at(position_b)
+        if row_a == row_b:
+            return
+        entries = self._entries
+        entries[row_a], entries[row_b] = entries[row_b], entries[row_a]
+        self._rows[id(entries[row_a])] = row_a
+        self._rows[id(entries[row_b])] = row_b
+        self._valid[[row_a, row_b]] = self._valid[[row_b, row_a]]
+        if self._matrix is not None:
+            self._matrix[[row_a, row_b]] = self._matrix[[row_b, row_a]]
+
+    def search(self, query_vec, threshold=0.1, top_k=5):
+        """返回 [(entry, score), ...]，分数 >= threshold，按分数降序，至多 top_k 条"""
+        if self._matrix is None or not self._count or top_k <= 0:
+            return []
+        n = self._count
+        scores = self._matrix[:n] @ np.asarray(query_vec, dtype=np.float32)
+        scores[~self._valid[:n]] = -np.inf
+        k = min(top_k, n)
+        top_rows = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+        top_rows = top_rows[scores[top_rows] >= threshold]
+        top_rows = top_rows[np.argsort(-scores[top_rows], kind="stable")]
+        return [(self._entries[row], float(scores[row])) for row in top_rows]
@@ -0,0 +1,182 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+from .utils import ensure_directory_exists
+from .storage import write_json_atomic
+
+# CJK ideographs, kana and hangul are tokenized as overlapping bigrams (no word boundaries in the text)
+_CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN_RE = re.compile(rf"[{_CJK_RANGES}]+|[0-9a-z]+(?:[._\-/:#][0-9a-z]+)*")
+_CJK_RE = re.compile(rf"[{_CJK_RANGES}]")
+_SEPARATOR_RE = re.compile(r"[._\-/:#]")
+# Identifier-shaped words: joined by separators (file names, ABC-1234, v1.2.3), hex ids, long numbers, prefixed codes (sku12345)
+_COMPOUND_TERM_RE = re.compile(r"[0-9a-z]+(?:[._\-/:#][0-9a-z]+)+")
+_ID_TERM_RE = re.compile(r"(?=[0-9a-f]*\d)[0-9a-f]{8,}|\d{6,}|[a-z]{1,5}\d{4,}")
+
+
+def tokenize(text):
+    """
+    CJK 感知的分词：拉丁字母/数字按词切分（小写），文件名、ID 等带分隔符的词同时保留整体与各部分；
+    连续的中日韩字符切成重叠的二元组（单个字符保留为一元）。
+    """
+    if not text:
+        return []
+    tokens = []
+    for match in _TOKEN_RE.finditer(str(text).lower()):
+        run = match.group()
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+            if _SEPARATOR_RE.search(run):
+                tokens.extend(part for part in _SEPARATOR_RE.split(run) if part)
+    return tokens
+
+
+def _is_identifier(word):
+    if _COMPOUND_TERM_RE.fullmatch(word):
+        # Hyphenated words ("state-of-the-art") are prose and bare numbers ("3.5") are values
+        return bool(re.search(r"[a-z]", word) and re.search(r"[\d._/:#]", word))
+    return bool(_ID_TERM_RE.fullmatch(word))
+
+
+def is_exact_term_query(text, max_tokens=3):
+    """
+    查询是否像一个精确词（文件名、产品型号、ID），这类查询可以只走词法索引。
+    只看词形：仅含数字的普通短语（"top 5 movies"、"iphone 15"）不算。
+    """
+    words = str(text or "").strip().lower().split()
+    if not words or len(words) > max_tokens:
+        return False
+    return any(_is_identifier(word.strip("\"'`“”‘’()[]<>,，。?？!！")) for word in words)
+
+
+class BM25Index:
+    """
+    内存中的 BM25 倒排索引，文档 id 可以是任意可哈希、可 JSON 序列化的值（list 会还原为 tuple）。
+    增删文档为 O(文档词数)；idf / 平均长度在查询时按当前统计计算。
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}   # term -> {doc_id: tf}
+        self._doc_terms = {}  # doc_id -> {term: tf}
+        self._doc_len = {}    # doc_id -> token count
+        self._total_len = 0
+        self._lock = threading.RLock()
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._doc_len)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._doc_len
+
+    def doc_ids(self):
+        with self._lock:
+            return list(self._doc_len)
+
+    def add(self, doc_id, text=None, tokens=None):
+        """加入（或替换）一个文档"""
+        tokens = tokenize(text) if tokens is None else tokens
+        with self._lock:
+            self._remove_locked(doc_id)
+            terms = Counter(tokens)
+            self._doc_terms[doc_id] = dict(terms)
+            self._doc_len[doc_id] = len(tokens)
+            self._total_len += len(tokens)
+            for term, tf in terms.items():
+                self._postings.setdefault(term, {})[doc_id] = tf
+            self.dirty = True
+
+    def _remove_locked(self, doc_id):
+        terms = self._doc_terms.pop(doc_id, None)
+        if terms is None:
+            return False
+        self._total_len -= self._doc_len.pop(doc_id, 0)
+        for term in terms:
+            docs = self._postings.get(term)
+            if docs is not None:
+                docs.pop(doc_id, None)
+                if not docs:
+                    del self._postings[term]
+        self.dirty = True
+        return True
+
+    def remove(self, doc_id):
+        with self._lock:
+            return self._remove_locked(doc_id)
+
+    def clear(self):
+        with self._lock:
+            self._postings = {}
+            self._doc_terms = {}
+            self._doc_len = {}
+            self._total_len = 0
+            self.dirty = True
+
+    def search(self, query, top_k=None):
+        """返回 [(doc_id, score), ...]，按分数降序；query 可以是文本或 token 列表"""
+        query_terms = set(tokenize(query) if isinstance(query, str) else query)
+        with self._lock:
+            n_docs = len(self._doc_len)
+            if not n_docs or not query_terms:
+                return []
+            avg_len = self._total_len / n_docs or 1.0
+            scores = {}
+            for term in query_terms:
+                docs = self._postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1.0 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for doc_id, tf in docs.items():
+                    norm = self.k1 * (1.0 - self.b + self.b * self._doc_len[doc_id] / avg_len)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1.0) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:top_k] if top_k else ranked
+
+    # ---- Persistence ----
+    def save(self, file_path, meta=None):
+        """写入 JSON（只保存每个文档的词频，倒排表在加载时重建）；未变化时不写盘"""
+        with self._lock:
+            if not self.dirty:
+                return
+            data = {
+                "k1": self.k1,
+                "b": self.b,
+                "meta": meta or {},
+                "docs": [[doc_id, self._doc_len[doc_id], terms] for doc_id, terms in self._doc_terms.items()],
+            }
+            ensure_directory_exists(file_path)
+            write_json_atomic(file_path, data)
+            self.dirty = False
+
+    def load(self, file_path):
+        """加载成功返回保存时的 meta，文件不存在或损坏返回 None"""
+        if not os.path.exists(file_path):
+            return None
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"BM25Index: Could not load {file_path}: {e}")
+            return None
+        with self._lock:
+            self.clear()
+            for doc_id, doc_len, terms in data.get("docs", []):
+                doc_id = tuple(doc_id) if isinstance(doc_id, list) else doc_id
+                self._doc_terms[doc_id] = terms
+                self._doc_len[doc_id] = doc_len
+                self._total_len += doc_len
+                for term, tf in terms.items():
+                    self._postings.setdefault(term, {})[doc_id] = tf
+            self.dirty = False
+        return data.get("meta", {})
@@ -0,0 +1,110 @@
+from .heat_queue import IndexedMaxHeap
+
+
+class LFUTracker:
+    """
+    LFU 淘汰结构：访问次数 -> 同频 session 桶。
+
+    最小频率 O(1) 维护，只有 remove / pop_victims 清空最小频率桶时才扫描其余频率；
+    桶内按 H_segment 从低到高、同热度时按进入该桶的先后（较早者优先）排序，由 IndexedMaxHeap 维护，
+    插入 / 删除 / 热度更新均为 O(log n)。
+    """
+
+    def __init__(self):
+        self._buckets = {}  # freq -> IndexedMaxHeap(session_id -> (-heat, -seq))
+        self._freq = {}     # session_id -> freq
+        self._seq = 0
+        self._min_freq = None
+
+    def __len__(self):
+        return len(self._freq)
+
+    def __contains__(self, session_id):
+        return session_id in self._freq
+
+    def frequency(self, session_id):
+        return self._freq.get(session_id)
+
+    def _next_seq(self):
+        self._seq += 1
+        return self._seq
+
+    def _detach(self, session_id, rescan=True):
+        """
+        移出 session。最小频率桶被清空时 rescan=True 重新查找最小频率；
+        rescan=False 时把 _min_freq 置为 None，由调用方（set）直接确定。
+        """
+        freq = self._freq.pop(session_id, None)
+        if freq is None:
+            return None
+        bucket = self._buckets[freq]
+        priority = bucket.priority(session_id)
+        bucket.remove(session_id)
+        if not bucket:
+            del self._buckets[freq]
+            if freq == self._min_freq:
+                # Frequencies are sparse after load, so look the next one up instead of assuming freq + 1
+                self._min_freq = min(self._buckets) if rescan and self._buckets else None
+        return priority
+
+    def set(self, session_id, freq, heat=0.0):
+        """设置 session 的访问次数与热度；改变频率时视为最近进入新桶"""
+        old_freq = self._freq.get(session_id)
+        if old_freq == freq:
+            self.update_heat(session_id, heat)
+            return
+        self._detach(session_id, rescan=False)
+        bucket = self._buckets.get(freq)
+        if bucket is None:
+            bucket = self._buckets[freq] = IndexedMaxHeap()
+        bucket.update(session_id, (-heat, -self._next_seq()))
+        self._freq[session_id] = freq
+        if self._min_freq is None:
+            if old_freq is not None and freq <= old_freq + 1:
+                # The emptied minimum bucket was old_freq and every other bucket is above it, so freq is the minimum (touch)
+                self._min_freq = freq
+            else:
+                self._min_freq = min(self._buckets)
+        elif freq < self._min_freq:
+            self._min_freq = freq
+
+    def touch(self, session_id, heat=0.0):
+        """访问次数 +1"""
+        self.set(session_id, self._freq.get(session_id, -1) + 1, heat)
+
+    def update_heat(self, session_id, heat):
+        """只更新热度，保留在桶内的先后顺序"""
+        freq = self._freq.get(session_id)
+        if freq is None:
+            return
+        bucket = self._buckets[freq]
+        _, neg_seq = bucket.priority(session_id)
+        bucket.update(session_id, (-heat, neg_seq))
+
+    def remove(self, session_id):
+        return self._detach(session_id) is not None
+
+    def peek_victim(self):
+        """访问次数最少（其次热度最低、最早进入）的 session_id，为空时返回 None"""
+        if self._min_freq is None:
+            return None
+        return self._buckets[self._min_freq].peek()[0]
+
+    def pop_victims(self, count=1):
+        """按淘汰顺序取出至多 count 个 session_id 并从结构中移除"""
+        victims = []
+        while len(victims) < count:
+            session_id = self.peek_victim()
+            if session_id is None:
+                break
+            self._detach(session_id)
+            victims.append(session_id)
+        return victims
+
+    def rebuild(self, items):
+        """用 [(session_id, freq, heat), ...] 重建；先出现的视为更早进入桶"""
+        self._buckets = {}
+        self._freq = {}
+        self._min_freq = None
+        for session_id, freq, heat in items:
+            self.set(session_id, freq, heat)
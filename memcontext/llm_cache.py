@@ -0,0 +1,119 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from .sqlite_kv import SqliteKVStore
+
+
+class LLMResponseCache:
+    """
+    线程安全的 LLM 响应缓存，按内容寻址：key 为 sha256(接口地址 + 模型 + messages + 采样参数)。
+
+    内存层为条目数受限的 LRU；可选的 SQLite 磁盘层（disk_path）让重新导入、重试在重启后也能命中。
+    条目超过 ttl 秒视为过期（None 表示不过期），内存未命中时查询磁盘并提升到内存。
+    """
+
+    def __init__(self, max_entries=2048, ttl=7 * 24 * 3600, disk_path=None, disk_max_entries=100_000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_max_entries = disk_max_entries
+        self._entries = OrderedDict()  # key -> (response, created_epoch)
+        self._lock = threading.Lock()
+        self._disk = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_path:
+            self.attach_disk(disk_path)
+
+    @staticmethod
+    def make_key(base_url, model, messages, **params):
+        payload = json.dumps({"base_url": base_url, "model": model, "messages": messages, **params},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @property
+    def disk_path(self):
+        return self._disk.db_path if self._disk is not None else None
+
+    def attach_disk(self, disk_path, replace=True):
+        """
+        启用（或切换）磁盘层；相同路径重复调用为空操作，replace=False 时已有磁盘层则保持不变。
+        切换时不关闭旧的磁盘层：其他线程可能刚在锁外取到它，连接随最后一个引用释放。
+        """
+        with self._lock:
+            if self._disk is not None and (self._disk.db_path == disk_path or not replace):
+                return
+            self._disk = SqliteKVStore(disk_path, table="llm_responses", max_entries=self.disk_max_entries)
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _put_memory_locked(self, key, response, created):
+        self._entries.pop(key, None)
+        self._entries[key] = (response, created)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """返回缓存的响应文本，未命中或已过期返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[1]):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            disk = self._disk
+        blob = disk.get(key) if disk is not None else None
+        if blob is not None:
+            record = json.loads(blob.decode("utf-8"))
+            if not self._expired(record["created"]):
+                with self._lock:
+                    self._put_memory_locked(key, record["response"], record["created"])
+                    self.disk_hits += 1
+                return record["response"]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, response):
+        created = time.time()
+        with self._lock:
+            self._put_memory_locked(key, response, created)
+            disk = self._disk
+        if disk is not None:
+            disk.put(key, json.dumps({"response": response, "created": created}, ensure_ascii=False).encode("utf-8"))
+
+    def delete(self, key):
+        """删除一条缓存（内存和磁盘层），用于调用方发现缓存的回复无法使用时"""
+        with self._lock:
+            self._entries.pop(key, None)
+            disk = self._disk
+        if disk is not None:
+            disk.delete(key)
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._entries.clear()
+            if disk and self._disk is not None:
+                self._disk.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_path": self.disk_path,
+            }
+
+    def __len__(self):
+        return len(self._entries)
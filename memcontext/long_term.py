@@ -1,41 +1,85 @@
 import json
+import os
+import threading
+import weakref
 import numpy as np
-import faiss
 from collections import deque
 
-from .utils import get_timestamp, get_embedding, normalize_vector, ensure_directory_exists
+from .utils import get_timestamp, get_embedding, get_embeddings, normalize_vector, has_embedding, ensure_directory_exists
+from .storage import create_storage_backend
+from .embedding_store import EmbeddingStore
+from .knowledge_matrix import KnowledgeMatrix
+
+_EMPTY_KNOWLEDGE = ("", "none", "- none", "- none.")
+
+_shared_instances = weakref.WeakValueDictionary() # abspath -> LongTermMemory
+_shared_instances_lock = threading.Lock()
+
+def get_long_term_memory(file_path, **kwargs):
+    """
+    返回 file_path 对应的进程内共享 LongTermMemory，不存在时用 kwargs 创建。
+    同一文件（例如所有用户共用的 assistant 知识）只能有一个实例：各实例各自分配 embedding sidecar 的行号，
+    多个实例同时追加会让不同条目指向同一行。已存在时 kwargs 被忽略，以先创建者的配置为准。
+    """
+    key = os.path.abspath(file_path)
+    with _shared_instances_lock:
+        memory = _shared_instances.get(key)
+        if memory is None:
+            memory = LongTermMemory(file_path, **kwargs)
+            _shared_instances[key] = memory
+        return memory
 
 class LongTermMemory:
-    def __init__(self, file_path, knowledge_capacity=100, embedding_model_name: str = "all-MiniLM-L6-v2", embedding_model_kwargs: dict = None):
+    def __init__(self, file_path, knowledge_capacity=100, embedding_model_name: str = "all-MiniLM-L6-v2", embedding_model_kwargs: dict = None,
+                 storage_backend="json", storage_options=None, dedup_threshold=0.9):
+        """
+        dedup_threshold: 新知识与已有知识的余弦相似度达到该值即视为近似重复并合并，None 表示不去重
+        """
         self.file_path = file_path
         ensure_directory_exists(self.file_path)
+        self.storage = create_storage_backend(self.file_path, storage_backend, **(storage_options or {}))
+        self._pending_records = [] # WAL records produced since the last save
+        # Instances are shared between Memcontext instances (see get_long_term_memory), writes come from many threads
+        self._lock = threading.RLock()
+        self.version = 0 # Bumped on every write, retrieval caches compare it to detect stale results
+        # Binary embedding sidecar; JSON entries only store knowledge_embedding_row
+        self.embedding_store = EmbeddingStore(f"{os.path.splitext(self.file_path)[0]}_embeddings")
         self.knowledge_capacity = knowledge_capacity
+        self.dedup_threshold = dedup_threshold
         self.user_profiles = {} # {user_id: {data: "profile_string", "last_updated": "timestamp"}}
         # Use deques for knowledge bases to easily manage capacity
         self.knowledge_base = deque(maxlen=self.knowledge_capacity) # For general/user private knowledge
         self.assistant_knowledge = deque(maxlen=self.knowledge_capacity) # For assistant specific knowledge
+        # Ring-buffer embedding matrices kept row-aligned with the two deques, keyed by _deque_name
+        self.knowledge_matrices = {
+            "knowledge_base": KnowledgeMatrix(self.knowledge_capacity),
+            "assistant_knowledge": KnowledgeMatrix(self.knowledge_capacity),
+        }
 
         self.embedding_model_name = embedding_model_name
         self.embedding_model_kwargs = embedding_model_kwargs if embedding_model_kwargs is not None else {}
         self.load()
 
     def update_user_profile(self, user_id, new_data, merge=True):
-        if merge and user_id in self.user_profiles and self.user_profiles[user_id].get("data"): # Check if data exists
-            current_data = self.user_profiles[user_id]["data"]
-            if isinstance(current_data, str) and isinstance(new_data, str):
-                updated_data = f"{current_data}\n\n--- Updated on {get_timestamp()} ---\n{new_data}"
-            else: # Fallback to overwrite if types are not strings or for more complex merge
+        with self._lock:
+            if merge and user_id in self.user_profiles and self.user_profiles[user_id].get("data"): # Check if data exists
+                current_data = self.user_profiles[user_id]["data"]
+                if isinstance(current_data, str) and isinstance(new_data, str):
+                    updated_data = f"{current_data}\n\n--- Updated on {get_timestamp()} ---\n{new_data}"
+                else: # Fallback to overwrite if types are not strings or for more complex merge
+                    updated_data = new_data
+            else:
+                # If merge=False or no existing data, replace with new data
                 updated_data = new_data
-        else:
-            # If merge=False or no existing data, replace with new data
-            updated_data = new_data
-        
-        self.user_profiles[user_id] = {
-            "data": updated_data,
-            "last_updated": get_timestamp()
-        }
-        print(f"LongTermMemory: Updated user profile for {user_id} (merge={merge}).")
-        self.save()
+
+            self.user_profiles[user_id] = {
+                "data": updated_data,
+                "last_updated": get_timestamp()
+            }
+            self.version += 1
+            print(f"LongTermMemory: Updated user profile for {user_id} (merge={merge}).")
+            self._pending_records.append({"op": "put_profile", "user_id": user_id, "profile": self.user_profiles[user_id]})
+            self.save()
 
     def get_raw_user_profile(self, user_id):
         return self.user_profiles.get(user_id, {}).get("data", "None") # Return "None" string if not found
@@ -44,25 +88,75 @@ class LongTermMemory:
         return self.user_profiles.get(user_id, {})
 
     def add_knowledge_entry(self, knowledge_text, knowledge_deque: deque, type_name="knowledge"):
-        if not knowledge_text or knowledge_text.strip().lower() in ["", "none", "- none", "- none."]:
+        return self.add_knowledge_entries([knowledge_text], knowledge_deque, type_name)
+
+    def add_knowledge_entries(self, knowledge_texts, knowledge_deque: deque, type_name="knowledge"):
+        """
+        批量写入一批知识：一次批量 embedding、一次 save。
+        与已有条目（含本批之前写入的条目）相似度 >= dedup_threshold 的知识不再新增，而是按时间合并：
+        已有条目的 timestamp 刷新为当前时间并移到队尾，避免被 FIFO 优先淘汰。
+        返回 {"added": 新增条数, "merged": 合并条数}
+        """
+        texts = [text.strip() for text in knowledge_texts if text and text.strip().lower() not in _EMPTY_KNOWLEDGE]
+        if not texts:
             print(f"LongTermMemory: Empty {type_name} received, not saving.")
-            return
-        
-        # If deque is full, the oldest item is automatically removed when appending.
-        vec = get_embedding(
-            knowledge_text, 
-            model_name=self.embedding_model_name, 
+            return {"added": 0, "merged": 0}
+
+        vecs = get_embeddings(
+            texts,
+            model_name=self.embedding_model_name,
             **self.embedding_model_kwargs
         )
-        vec = normalize_vector(vec).tolist()
-        entry = {
-            "knowledge": knowledge_text,
-            "timestamp": get_timestamp(),
-            "knowledge_embedding": vec
-        }
-        knowledge_deque.append(entry)
-        print(f"LongTermMemory: Added {type_name}. Current count: {len(knowledge_deque)}.")
-        self.save()
+        name = self._deque_name(knowledge_deque)
+        matrix = self.knowledge_matrices[name]
+        timestamp = get_timestamp()
+        added = merged = 0
+        with self._lock:
+            for text, vec in zip(texts, vecs):
+                vec = normalize_vector(vec)
+                hits = matrix.search(vec, self.dedup_threshold, top_k=1) if self.dedup_threshold is not None else []
+                if hits:
+                    self._refresh_knowledge_entry(hits[0][0], knowledge_deque, timestamp)
+                    merged += 1
+                    continue
+                # If deque is full, the oldest item is automatically removed when appending.
+                entry = {
+                    "knowledge": text,
+                    "timestamp": timestamp,
+                    "knowledge_embedding": vec,
+                    "knowledge_embedding_row": self.embedding_store.append(vec)[0]
+                }
+                knowledge_deque.append(entry)
+                matrix.append(entry, vec)
+                self._pending_records.append({"op": "append_knowledge", "deque": name,
+                                              "entry": self._serialize_entry(entry), "embedding_generation": self.embedding_store.generation})
+                added += 1
+            self.version += 1
+            print(f"LongTermMemory: Added {added} {type_name}, merged {merged} near-duplicate(s). Current count: {len(knowledge_deque)}.")
+            self.save()
+        return {"added": added, "merged": merged}
+
+    def _refresh_knowledge_entry(self, entry, knowledge_deque: deque, timestamp):
+        """
+        把近似重复命中的已有条目刷新为 timestamp，并与队尾（最新）条目交换位置，避免被 FIFO 优先淘汰；
+        矩阵中对应的两行同时交换，O(dim)，不重建矩阵。
+        """
+        previous = entry["timestamp"]
+        if previous == timestamp and knowledge_deque[-1] is entry:
+            return # Already refreshed by an earlier line of this batch
+        entry["timestamp"] = timestamp
+        position = self.knowledge_matrices[self._deque_name(knowledge_deque)].position(entry)
+        if position is not None:
+            self._swap_with_newest(knowledge_deque, position)
+        self._pending_records.append({"op": "refresh_knowledge", "deque": self._deque_name(knowledge_deque),
+                                      "knowledge": entry["knowledge"], "timestamp": previous, "new_timestamp": timestamp})
+
+    def _swap_with_newest(self, knowledge_deque: deque, position):
+        last = len(knowledge_deque) - 1
+        if position == last:
+            return
+        knowledge_deque[position], knowledge_deque[last] = knowledge_deque[last], knowledge_deque[position]
+        self.knowledge_matrices[self._deque_name(knowledge_deque)].swap(position, last)
 
     def add_user_knowledge(self, knowledge_text):
         self.add_knowledge_entry(knowledge_text, self.knowledge_base, "user knowledge")
@@ -70,96 +164,168 @@ class LongTermMemory:
     def add_assistant_knowledge(self, knowledge_text):
         self.add_knowledge_entry(knowledge_text, self.assistant_knowledge, "assistant knowledge")
 
+    def add_user_knowledge_batch(self, knowledge_texts):
+        return self.add_knowledge_entries(knowledge_texts, self.knowledge_base, "user knowledge")
+
+    def add_assistant_knowledge_batch(self, knowledge_texts):
+        return self.add_knowledge_entries(knowledge_texts, self.assistant_knowledge, "assistant knowledge")
+
     def get_user_knowledge(self):
-        return list(self.knowledge_base)
+        with self._lock:
+            return list(self.knowledge_base)
 
     def get_assistant_knowledge(self):
-        return list(self.assistant_knowledge)
+        with self._lock:
+            return list(self.assistant_knowledge)
 
-    def _search_knowledge_deque(self, query, knowledge_deque: deque, threshold=0.1, top_k=5):
+    def _search_knowledge_deque(self, query, knowledge_deque: deque, threshold=0.1, top_k=5, query_vec=None):
         if not knowledge_deque:
             return []
         
-        query_vec = get_embedding(
-            query, 
-            model_name=self.embedding_model_name, 
-            **self.embedding_model_kwargs
-        )
+        if query_vec is None: # Callers such as Retriever pass a query embedding computed once per turn
+            query_vec = get_embedding(
+                query, 
+                model_name=self.embedding_model_name, 
+                **self.embedding_model_kwargs
+            )
         query_vec = normalize_vector(query_vec)
         
-        embeddings = []
-        valid_entries = []
-        for entry in knowledge_deque:
-            if "knowledge_embedding" in entry and entry["knowledge_embedding"]:
-                embeddings.append(np.array(entry["knowledge_embedding"], dtype=np.float32))
-                valid_entries.append(entry)
-            else:
-                print(f"Warning: Entry without embedding found in knowledge_deque: {entry.get('knowledge','N/A')[:50]}")
+        # Single matvec over the maintained matrix instead of rebuilding a faiss index per query
+        with self._lock:
+            hits = self.knowledge_matrices[self._deque_name(knowledge_deque)].search(query_vec, threshold, top_k)
+        return [entry for entry, _ in hits]
 
-        if not embeddings:
-            return []
-            
-        embeddings_np = np.array(embeddings, dtype=np.float32)
-        if embeddings_np.ndim == 1: # Single item case
-            if embeddings_np.shape[0] == 0: return [] # Empty embeddings
-            embeddings_np = embeddings_np.reshape(1, -1)
-        
-        if embeddings_np.shape[0] == 0: # No valid embeddings
-            return []
-
-        dim = embeddings_np.shape[1]
-        index = faiss.IndexFlatIP(dim) # Using Inner Product for similarity
-        index.add(embeddings_np)
-        
-        query_arr = np.array([query_vec], dtype=np.float32)
-        distances, indices = index.search(query_arr, min(top_k, len(valid_entries))) # Search at most k or length of valid_entries
-        
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if idx != -1: # faiss returns -1 for no valid index
-                similarity_score = float(distances[0][i]) # For IndexFlatIP, distance is the dot product (similarity)
-                if similarity_score >= threshold:
-                    results.append(valid_entries[idx]) # Add the original entry dict
-        
-        # Sort by similarity score descending before returning, as faiss might not guarantee order for IP
-        results.sort(key=lambda x: float(np.dot(np.array(x["knowledge_embedding"], dtype=np.float32), query_vec)), reverse=True)
-        return results
-
-    def search_user_knowledge(self, query, threshold=0.1, top_k=5):
-        results = self._search_knowledge_deque(query, self.knowledge_base, threshold, top_k)
+    def search_user_knowledge(self, query, threshold=0.1, top_k=5, query_vec=None):
+        results = self._search_knowledge_deque(query, self.knowledge_base, threshold, top_k, query_vec)
         print(f"LongTermMemory: Searched user knowledge for '{query[:30]}...'. Found {len(results)} matches.")
         return results
 
-    def search_assistant_knowledge(self, query, threshold=0.1, top_k=5):
-        results = self._search_knowledge_deque(query, self.assistant_knowledge, threshold, top_k)
+    def search_assistant_knowledge(self, query, threshold=0.1, top_k=5, query_vec=None):
+        results = self._search_knowledge_deque(query, self.assistant_knowledge, threshold, top_k, query_vec)
         print(f"LongTermMemory: Searched assistant knowledge for '{query[:30]}...'. Found {len(results)} matches.")
         return results
 
-    def save(self):
-        data = {
+    def _deque_name(self, knowledge_deque):
+        return "assistant_knowledge" if knowledge_deque is self.assistant_knowledge else "knowledge_base"
+
+    def _serialize_entry(self, entry, inline_embedding=False):
+        out = {k: v for k, v in entry.items() if k != "knowledge_embedding"}
+        if inline_embedding and has_embedding(entry.get("knowledge_embedding")):
+            out["knowledge_embedding"] = np.asarray(entry["knowledge_embedding"], dtype=np.float32).tolist()
+            out.pop("knowledge_embedding_row", None)
+        return out
+
+    def _compact_embeddings_if_needed(self):
+        entries = list(self.knowledge_base) + list(self.assistant_knowledge)
+        # Entries dropped by the bounded deques leave garbage rows behind
+        if not self.embedding_store.needs_compaction(len(entries)):
+            return
+        row_map = self.embedding_store.compact([e.get("knowledge_embedding_row") for e in entries])
+        for entry in entries:
+            if "knowledge_embedding_row" in entry:
+                entry["knowledge_embedding_row"] = row_map.get(entry["knowledge_embedding_row"])
+                entry["knowledge_embedding"] = self.embedding_store.get(entry["knowledge_embedding_row"])
+
+    def _build_snapshot(self, inline_embeddings=False):
+        if not inline_embeddings:
+            self._compact_embeddings_if_needed() # Only when a full snapshot is written
+        snapshot = {
             "user_profiles": self.user_profiles,
-            "knowledge_base": list(self.knowledge_base), # Convert deques to lists for JSON serialization
-            "assistant_knowledge": list(self.assistant_knowledge)
+            # Convert deques to lists for JSON serialization
+            "knowledge_base": [self._serialize_entry(e, inline_embeddings) for e in self.knowledge_base],
+            "assistant_knowledge": [self._serialize_entry(e, inline_embeddings) for e in self.assistant_knowledge]
         }
-        try:
-            # 确保目录存在（防止目录被删除或路径变更的情况）
-            ensure_directory_exists(self.file_path)
-            with open(self.file_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except IOError as e:
-            print(f"Error saving LongTermMemory to {self.file_path}: {e}")
+        if not inline_embeddings:
+            snapshot["embedding_store"] = self.embedding_store.state()
+        return snapshot
+
+    def save(self):
+        # Records are only used by the WAL backend; the JSON backend rewrites the full snapshot
+        with self._lock:
+            records, self._pending_records = self._pending_records, []
+            try:
+                self.storage.save(records, self._build_snapshot)
+                self.embedding_store.drop_stale_files() # Previous generation is unreferenced once the snapshot is written
+            except IOError as e:
+                print(f"Error saving LongTermMemory to {self.file_path}: {e}")
+
+    def export_json(self, export_path):
+        """以原有 JSON 布局（indent=2，embedding 为 float 列表）导出"""
+        ensure_directory_exists(export_path)
+        with self._lock:
+            snapshot = self._build_snapshot(inline_embeddings=True)
+        with open(export_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, indent=2)
+
+    def _apply_record(self, record):
+        op = record.get("op")
+        if op == "put_profile":
+            self.user_profiles[record["user_id"]] = record["profile"]
+        elif op == "append_knowledge":
+            if record.get("embedding_generation", 0) < self.embedding_store.generation:
+                return # Written before the snapshot's embedding compaction, already folded into it
+            target = self.assistant_knowledge if record.get("deque") == "assistant_knowledge" else self.knowledge_base
+            entry = record["entry"]
+            # Compaction may have already folded this record into the snapshot
+            if any(e.get("knowledge") == entry.get("knowledge") and e.get("timestamp") == entry.get("timestamp") for e in target):
+                return
+            target.append(entry)
+        elif op == "refresh_knowledge":
+            target = self.assistant_knowledge if record.get("deque") == "assistant_knowledge" else self.knowledge_base
+            # Not found when the snapshot already holds the refreshed timestamp; matrices are rebuilt after replay
+            for i, entry in enumerate(target):
+                if entry.get("knowledge") == record.get("knowledge") and entry.get("timestamp") == record.get("timestamp"):
+                    entry["timestamp"] = record["new_timestamp"]
+                    target[i], target[-1] = target[-1], target[i]
+                    break
+
+    def _attach_embeddings(self):
+        """把 knowledge_embedding_row 解析为 memmap 行视图；旧版 JSON 中的 float 列表迁移到 sidecar"""
+        migrated = 0
+        for entry in list(self.knowledge_base) + list(self.assistant_knowledge):
+            if "knowledge_embedding_row" in entry:
+                entry["knowledge_embedding"] = self.embedding_store.get(entry["knowledge_embedding_row"])
+            elif has_embedding(entry.get("knowledge_embedding")):
+                vec = np.asarray(entry["knowledge_embedding"], dtype=np.float32)
+                entry["knowledge_embedding_row"] = self.embedding_store.append(vec)[0]
+                entry["knowledge_embedding"] = vec
+                migrated += 1
+        if migrated:
+            print(f"LongTermMemory: Migrated {migrated} JSON embeddings to binary sidecar.")
+            self.storage.compact(self._build_snapshot()) # Persist row ids so the next load does not migrate again
+
+    def _rebuild_knowledge_matrix(self, knowledge_deque: deque):
+        entries = []
+        for entry in knowledge_deque:
+            vec = entry.get("knowledge_embedding")
+            if not has_embedding(vec):
+                print(f"Warning: Entry without embedding found in knowledge_deque: {entry.get('knowledge','N/A')[:50]}")
+                vec = None
+            entries.append((entry, vec))
+        self.knowledge_matrices[self._deque_name(knowledge_deque)].rebuild(entries)
+
+    def _rebuild_knowledge_matrices(self):
+        for knowledge_deque in (self.knowledge_base, self.assistant_knowledge):
+            self._rebuild_knowledge_matrix(knowledge_deque)
 
     def load(self):
         try:
-            with open(self.file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                self.user_profiles = data.get("user_profiles", {})
-                # Load into deques, respecting maxlen
-                kb_data = data.get("knowledge_base", [])
-                self.knowledge_base = deque(kb_data, maxlen=self.knowledge_capacity)
-                
-                ak_data = data.get("assistant_knowledge", [])
-                self.assistant_knowledge = deque(ak_data, maxlen=self.knowledge_capacity)
+            data, records = self.storage.load()
+            if data is None and not records:
+                raise FileNotFoundError(self.file_path)
+            data = data or {}
+            self.user_profiles = data.get("user_profiles", {})
+            # Load into deques, respecting maxlen
+            kb_data = data.get("knowledge_base", [])
+            self.knowledge_base = deque(kb_data, maxlen=self.knowledge_capacity)
+            
+            ak_data = data.get("assistant_knowledge", [])
+            self.assistant_knowledge = deque(ak_data, maxlen=self.knowledge_capacity)
+
+            self.embedding_store.open(data.get("embedding_store"))
+            for record in records:
+                self._apply_record(record)
+            self._attach_embeddings()
                 
             print(f"LongTermMemory: Loaded from {self.file_path}.")
         except FileNotFoundError:
@@ -167,4 +333,5 @@ class LongTermMemory:
         except json.JSONDecodeError:
             print(f"LongTermMemory: Error decoding JSON from {self.file_path}. Initializing new memory.")
         except Exception as e:
-             print(f"LongTermMemory: An unexpected error occurred during load from {self.file_path}: {e}. Initializing new memory.") 
\ No newline at end of file
+             print(f"LongTermMemory: An unexpected error occurred during load from {self.file_path}: {e}. Initializing new memory.")
+        self._rebuild_knowledge_matrices() 
\ No newline at end of file
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class MaintenanceQueue:
+    """
+    按用户串行、按任务名合并的后台维护队列（中期迁移、画像/知识分析等）：
+    - 同一 key 的任务依次执行，不会有两个迁移/分析同时修改同一用户的 sessions
+    - 同一 key 下已排队、尚未开始的同名任务合并为一次执行，返回同一个 Future
+    - 排队任务总数不超过 max_pending：超出时丢弃新任务（shedding），或 block=True 时等待空位（backpressure）
+    - saturation_check() 返回 True（LLM 后端已满载）时，可丢弃的新任务直接丢弃；被丢弃的触发不会丢数据，
+      短期记忆仍然保留，下一次触发会一并处理
+    任务由 executor（如 MemcontextRuntime.background_executor）执行，为 None 时自建 max_workers 个线程。
+    """
+
+    def __init__(self, executor=None, max_workers=1, max_pending=1000, saturation_check=None):
+        self._owns_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="memcontext-maintenance")
+        self.max_pending = max_pending
+        self.saturation_check = saturation_check
+        self._keys = {}  # key -> {"queue": OrderedDict(name -> (fn, future)), "running": bool}
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self.stats = {"submitted": 0, "coalesced": 0, "shed": 0, "completed": 0, "failed": 0}
+
+    def submit(self, key, name, fn, shed=True, block=False, timeout=None):
+        """
+        为 key 排队一个名为 name 的任务，返回 Future；任务被丢弃时返回 None。
+        shed=False 的任务不会因后端满载被丢弃；block=True 时队列满则最多等待 timeout 秒。
+        """
+        with self._cond:
+            if self._closed:
+                return None
+            state = self._keys.get(key)
+            if state is not None and name in state["queue"]:
+                self.stats["coalesced"] += 1
+                return state["queue"][name][1]
+            if shed and self.saturation_check is not None and self.saturation_check():
+                self.stats["shed"] += 1
+                print(f"MaintenanceQueue: LLM backend saturated, dropped '{name}' for {key}.")
+                return None
+            if self._pending >= self.max_pending:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while block and self._pending >= self.max_pending and not self._closed:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._pending >= self.max_pending or self._closed:
+                    self.stats["shed"] += 1
+                    print(f"MaintenanceQueue: Queue full ({self._pending} pending), dropped '{name}' for {key}.")
+                    return None
+                # Waiting released the lock, the key may have been drained or have queued the same job meanwhile
+                state = self._keys.get(key)
+                if state is not None and name in state["queue"]:
+                    self.stats["coalesced"] += 1
+                    return state["queue"][name][1]
+            if state is None:
+                state = self._keys[key] = {"queue": OrderedDict(), "running": False}
+            future = Future()
+            state["queue"][name] = (fn, future)
+            self._pending += 1
+            self.stats["submitted"] += 1
+            if not state["running"]:
+                state["running"] = True
+                self.executor.submit(self._run_next, key)
+            return future
+
+    def _run_next(self, key):
+        with self._cond:
+            state = self._keys[key]
+            _, (fn, future) = state["queue"].popitem(last=False)
+            self._pending -= 1
+            self._cond.notify_all()
+        outcome = None
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn()
+                    outcome = "completed"
+                    future.set_result(result)
+                except Exception as e:
+                    print(f"MaintenanceQueue: Job for {key} failed: {e}")
+                    outcome = "failed"
+                    future.set_exception(e)
+        finally:
+            with self._cond:
+                if outcome is not None:
+                    self.stats[outcome] += 1
+                if state["queue"] and not self._closed:
+                    # One job per executor task, so a busy user cannot hold a worker while others wait
+                    self.executor.submit(self._run_next, key)
+                else:
+                    state["running"] = False
+                    if not state["queue"]:
+                        self._keys.pop(key, None)
+
+    def depth(self, key=None):
+        """排队中（未开始）的任务数；key 为 None 时返回全部"""
+        with self._cond:
+            if key is None:
+                return self._pending
+            state = self._keys.get(key)
+            return len(state["queue"]) if state is not None else 0
+
+    def is_busy(self, key):
+        """key 是否有正在执行或排队的任务"""
+        with self._cond:
+            return key in self._keys
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._closed = True
+            # Jobs that never started are cancelled; running ones finish
+            for state in self._keys.values():
+                for _, future in state["queue"].values():
+                    future.cancel()
+                self._pending -= len(state["queue"])
+                state["queue"].clear()
+            self._cond.notify_all()
+        if self._owns_executor:
+            self.executor.shutdown(wait=wait)
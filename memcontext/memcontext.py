@@ -1,27 +1,37 @@
 import os
+import re
 import json
+import asyncio
 import threading
+import time
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Sequence, Union
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 支持相对导入和绝对导入的回退机制
 try:
     # 尝试相对导入（当作为包使用时）
     from .utils import (
         OpenAIClient,
+        AsyncOpenAIClient,
         get_timestamp,
         generate_id,
         gpt_user_profile_analysis,
         gpt_knowledge_extraction,
         ensure_directory_exists,
+        configure_embedding_cache,
+        configure_llm_response_cache,
     )
     from . import prompts
     from .short_term import ShortTermMemory
-    from .mid_term import MidTermMemory, compute_segment_heat
-    from .long_term import LongTermMemory
+    from .mid_term import MidTermMemory, compute_segment_heat, set_last_visit
+    from .long_term import LongTermMemory, get_long_term_memory
     from .updater import Updater
     from .retriever import Retriever
+    from .retrieval_cache import RetrievalCache
+    from .maintenance import MaintenanceQueue
+    from .context_packer import ContextPacker, ContextItem
+    from .lexical_index import tokenize
+    from .stage_graph import StageGraph
     from .multimodal import ConverterFactory
     from .multimodal.converter import ConversionChunk, ConversionOutput
     from .multimodal.utils import guess_file_extension, guess_mime_type, compute_file_hash
@@ -29,18 +39,26 @@ except ImportError:
     # 回退到绝对导入（当作为独立模块使用时）
     from utils import (
         OpenAIClient,
+        AsyncOpenAIClient,
         get_timestamp,
         generate_id,
         gpt_user_profile_analysis,
         gpt_knowledge_extraction,
         ensure_directory_exists,
+        configure_embedding_cache,
+        configure_llm_response_cache,
     )
     import prompts
     from short_term import ShortTermMemory
-    from mid_term import MidTermMemory, compute_segment_heat
-    from long_term import LongTermMemory
+    from mid_term import MidTermMemory, compute_segment_heat, set_last_visit
+    from long_term import LongTermMemory, get_long_term_memory
     from updater import Updater
     from retriever import Retriever
+    from retrieval_cache import RetrievalCache
+    from maintenance import MaintenanceQueue
+    from context_packer import ContextPacker, ContextItem
+    from lexical_index import tokenize
+    from stage_graph import StageGraph
     from multimodal import ConverterFactory
     from multimodal.converter import ConversionChunk, ConversionOutput
     from multimodal.utils import guess_file_extension, guess_mime_type, compute_file_hash
@@ -58,6 +76,7 @@ class Memcontext:
                  short_term_capacity=10,
                  mid_term_capacity=2000,
                  long_term_knowledge_capacity=100,
+                 long_term_dedup_threshold=0.9,
                  retrieval_queue_capacity=4,
                  mid_term_heat_threshold=H_PROFILE_UPDATE_THRESHOLD,
                  mid_term_similarity_threshold=0.6,
@@ -67,45 +86,46 @@ class Memcontext:
                  multimodal_config: dict = None,
                  file_storage_manager=None,
                  file_storage_base_path: str = None,
+                 mid_term_index_type: str = "flat",
+                 mid_term_lexical_weight: float = 0.3,
+                 batch_migration: bool = True,
+                 retrieval_cache_size: int = 128,
+                 retrieval_cache_ttl: float = 300,
+                 retrieval_cache_similarity: float = 0.97,
+                 context_token_budget: int = 8000,
+                 context_quotas: dict = None,
+                 context_overflow: str = "summarize",
+                 storage_backend: str = "json",
+                 storage_options: dict = None,
+                 embedding_cache_max_bytes: int = None,
+                 embedding_cache_persist: bool = True,
+                 llm_cache_persist: bool = True,
+                 runtime=None,
                  ):
         self.user_id = user_id
         self.assistant_id = assistant_id
+        # Optional MemcontextRuntime shared by many instances (LLM clients, executors, concurrency limit)
+        self.runtime = runtime
         self.data_storage_path = os.path.abspath(data_storage_path)
         self.llm_model = llm_model
         self.mid_term_similarity_threshold = mid_term_similarity_threshold
         self.embedding_model_name = embedding_model_name
         self.multimodal_config = multimodal_config or {}
+        # Token budget for the get_response* prompts (history, pages, profile, knowledge); None disables packing
+        self.context_packer = ContextPacker(
+            token_budget=context_token_budget, quotas=context_quotas, model_name=llm_model, overflow=context_overflow
+        ) if context_token_budget else None
         
-        # 初始化文件存储管理器
-        if file_storage_manager is None:
-            try:
-                from memcontext.file_storage import FileStorageManager
-                # 如果未指定 file_storage_base_path，默认使用项目根目录（与 file_storage 和 memdemo 平齐）
-                if file_storage_base_path is None:
-                    # 获取当前文件所在目录（memcontext-playground），作为项目根目录
-                    current_file_dir = os.path.dirname(os.path.abspath(__file__))
-                    file_storage_base_path = current_file_dir
-                else:
-                    file_storage_base_path = os.path.abspath(file_storage_base_path)
-                
-                self.file_storage_manager = FileStorageManager(
-                    storage_base_path=file_storage_base_path,
-                    user_id=user_id
-                )
-                print(f"FileStorageManager initialized at: {file_storage_base_path}")
-                print(f"FileStorageManager files_dir will be: {self.file_storage_manager.files_dir}")
-            except ImportError as e:
-                print(f"Warning: file_storage module not found, file storage features will be disabled. Error: {e}")
-                import traceback
-                traceback.print_exc()
-                self.file_storage_manager = None
-            except Exception as e:
-                print(f"Warning: Failed to initialize FileStorageManager: {e}")
-                import traceback
-                traceback.print_exc()
-                self.file_storage_manager = None
-        else:
-            self.file_storage_manager = file_storage_manager
+        # Memory tiers, file storage and the updater/retriever are created on first access (see _get_component),
+        # so requests that only touch one tier do not deserialize the others
+        self._components = {}
+        self._component_lock = threading.RLock()
+        # One lock per component, so stages loading different tiers concurrently do not wait on each other
+        self._component_locks = {}
+        self.last_response_timings = {} # Per-stage timings of the latest get_response* call, see _record_response_timings
+        if file_storage_manager is not None:
+            self._components["file_storage_manager"] = file_storage_manager
+        self._file_storage_base_path = file_storage_base_path
         
         # Smart defaults for embedding_model_kwargs
         if embedding_model_kwargs is None:
@@ -117,6 +137,19 @@ class Memcontext:
         else:
             self.embedding_model_kwargs = embedding_model_kwargs
 
+        # The caches are process-wide and a runtime configures them itself; otherwise persisting them under
+        # data_storage_path gives restarted servers warm hits. The first instance to attach a disk tier keeps it
+        if self.runtime is None:
+            configure_embedding_cache(
+                max_bytes=embedding_cache_max_bytes,
+                disk_path=os.path.join(self.data_storage_path, "embedding_cache.sqlite") if embedding_cache_persist else None,
+                replace=False
+            )
+            # Deterministic (temperature 0) LLM replies are cached the same way, so re-imports and retried migrations are free
+            configure_llm_response_cache(
+                disk_path=os.path.join(self.data_storage_path, "llm_cache.sqlite") if llm_cache_persist else None,
+                replace=False
+            )
 
         print(f"Initializing Memcontext for user '{self.user_id}' and assistant '{self.assistant_id}'. Data path: {self.data_storage_path}")
         print(f"Using unified LLM model: {self.llm_model}")
@@ -127,7 +160,13 @@ class Memcontext:
                 ConverterFactory.configure(converter_type, **config)
 
         # Initialize OpenAI Client
-        self.client = OpenAIClient(api_key=openai_api_key, base_url=openai_base_url)
+        if self.runtime is not None:
+            self.client = self.runtime.get_client(api_key=openai_api_key, base_url=openai_base_url)
+        else:
+            self.client = OpenAIClient(api_key=openai_api_key, base_url=openai_base_url)
+        self._async_client = None # Created on first use by the async API (aget_response, ...)
+        # Migration / profile analysis jobs, serialized per user and coalesced (see _schedule_long_term_analysis)
+        self._maintenance_queue = None
 
         # Define file paths for user-specific data
         self.user_data_dir = os.path.join(self.data_storage_path, "users", self.user_id)
@@ -145,46 +184,140 @@ class Memcontext:
         ensure_directory_exists(user_long_term_path)
         ensure_directory_exists(assistant_long_term_path)
 
-        # Initialize Memory Modules for User
-        self.short_term_memory = ShortTermMemory(file_path=user_short_term_path, max_capacity=short_term_capacity)
-        self.mid_term_memory = MidTermMemory(
-            file_path=user_mid_term_path, 
-            client=self.client, 
-            max_capacity=mid_term_capacity,
-            embedding_model_name=self.embedding_model_name,
-            embedding_model_kwargs=self.embedding_model_kwargs
-        )
-        self.user_long_term_memory = LongTermMemory(
-            file_path=user_long_term_path, 
-            knowledge_capacity=long_term_knowledge_capacity,
-            embedding_model_name=self.embedding_model_name,
-            embedding_model_kwargs=self.embedding_model_kwargs
-        )
-
-        # Initialize Memory Module for Assistant Knowledge
-        self.assistant_long_term_memory = LongTermMemory(
-            file_path=assistant_long_term_path, 
-            knowledge_capacity=long_term_knowledge_capacity,
-            embedding_model_name=self.embedding_model_name,
-            embedding_model_kwargs=self.embedding_model_kwargs
-        )
-
-        # Initialize Orchestration Modules
-        self.updater = Updater(short_term_memory=self.short_term_memory, 
-                               mid_term_memory=self.mid_term_memory, 
-                               long_term_memory=self.user_long_term_memory, # Updater primarily updates user's LTM profile/knowledge
-                               client=self.client,
-                               topic_similarity_threshold=mid_term_similarity_threshold,  # 传递中期记忆相似度阈值
-                               llm_model=self.llm_model)
-        self.retriever = Retriever(
-            mid_term_memory=self.mid_term_memory,
-            long_term_memory=self.user_long_term_memory,
-            assistant_long_term_memory=self.assistant_long_term_memory, # Pass assistant LTM
-            queue_capacity=retrieval_queue_capacity
-        )
+        # storage_backend: "json" rewrites each tier file on save, "wal" appends to <file>.wal and compacts periodically
+        storage_options = storage_options or {}
+        self._component_factories = {
+            "short_term_memory": lambda: ShortTermMemory(
+                file_path=user_short_term_path,
+                max_capacity=short_term_capacity,
+                storage_backend=storage_backend,
+                storage_options=storage_options
+            ),
+            "mid_term_memory": lambda: MidTermMemory(
+                file_path=user_mid_term_path, 
+                client=self.client, 
+                max_capacity=mid_term_capacity,
+                embedding_model_name=self.embedding_model_name,
+                embedding_model_kwargs=self.embedding_model_kwargs,
+                summary_index_type=mid_term_index_type,
+                storage_backend=storage_backend,
+                storage_options=storage_options,
+                lexical_weight=mid_term_lexical_weight
+            ),
+            # Long-term files are shared by instances of the same user/assistant, one LongTermMemory per file
+            "user_long_term_memory": lambda: get_long_term_memory(
+                file_path=user_long_term_path, 
+                knowledge_capacity=long_term_knowledge_capacity,
+                dedup_threshold=long_term_dedup_threshold,
+                embedding_model_name=self.embedding_model_name,
+                embedding_model_kwargs=self.embedding_model_kwargs,
+                storage_backend=storage_backend,
+                storage_options=storage_options
+            ),
+            # Assistant knowledge
+            "assistant_long_term_memory": lambda: get_long_term_memory(
+                file_path=assistant_long_term_path, 
+                knowledge_capacity=long_term_knowledge_capacity,
+                dedup_threshold=long_term_dedup_threshold,
+                embedding_model_name=self.embedding_model_name,
+                embedding_model_kwargs=self.embedding_model_kwargs,
+                storage_backend=storage_backend,
+                storage_options=storage_options
+            ),
+            # Orchestration modules, creating them loads the tiers they wrap
+            "updater": lambda: Updater(short_term_memory=self.short_term_memory, 
+                                       mid_term_memory=self.mid_term_memory, 
+                                       long_term_memory=self.user_long_term_memory, # Updater primarily updates user's LTM profile/knowledge
+                                       client=self.client,
+                                       topic_similarity_threshold=mid_term_similarity_threshold,  # 传递中期记忆相似度阈值
+                                       llm_model=self.llm_model,
+                                       batch_migration=batch_migration),
+            "retriever": lambda: Retriever(
+                mid_term_memory=self.mid_term_memory,
+                long_term_memory=self.user_long_term_memory,
+                assistant_long_term_memory=self.assistant_long_term_memory, # Pass assistant LTM
+                queue_capacity=retrieval_queue_capacity,
+                executor=self.runtime.retrieval_executor if self.runtime is not None else None,
+                cache=RetrievalCache(max_entries=retrieval_cache_size, ttl=retrieval_cache_ttl,
+                                     similarity_threshold=retrieval_cache_similarity) if retrieval_cache_size else None
+            ),
+            "file_storage_manager": self._create_file_storage_manager,
+        }
         
         self.mid_term_heat_threshold = mid_term_heat_threshold
 
+    def _create_file_storage_manager(self):
+        try:
+            from memcontext.file_storage import FileStorageManager
+            # 如果未指定 file_storage_base_path，默认使用项目根目录（与 file_storage 和 memdemo 平齐）
+            if self._file_storage_base_path is None:
+                # 获取当前文件所在目录（memcontext-playground），作为项目根目录
+                current_file_dir = os.path.dirname(os.path.abspath(__file__))
+                file_storage_base_path = current_file_dir
+            else:
+                file_storage_base_path = os.path.abspath(self._file_storage_base_path)
+            
+            file_storage_manager = FileStorageManager(
+                storage_base_path=file_storage_base_path,
+                user_id=self.user_id
+            )
+            print(f"FileStorageManager initialized at: {file_storage_base_path}")
+            print(f"FileStorageManager files_dir will be: {file_storage_manager.files_dir}")
+            return file_storage_manager
+        except ImportError as e:
+            print(f"Warning: file_storage module not found, file storage features will be disabled. Error: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+        except Exception as e:
+            print(f"Warning: Failed to initialize FileStorageManager: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+
+    def _get_component(self, name):
+        """首次访问时创建（并从磁盘加载）对应的记忆层/组件"""
+        if name not in self._components:
+            with self._component_lock:
+                lock = self._component_locks.setdefault(name, threading.RLock())
+            # Factories may build the tiers they depend on; those dependencies form a DAG, so this cannot deadlock
+            with lock:
+                if name not in self._components:
+                    self._components[name] = self._component_factories[name]()
+        return self._components[name]
+
+    def is_loaded(self, name: str) -> bool:
+        """组件是否已创建，例如 is_loaded("mid_term_memory")"""
+        return name in self._components
+
+    @property
+    def short_term_memory(self) -> ShortTermMemory:
+        return self._get_component("short_term_memory")
+
+    @property
+    def mid_term_memory(self) -> MidTermMemory:
+        return self._get_component("mid_term_memory")
+
+    @property
+    def user_long_term_memory(self) -> LongTermMemory:
+        return self._get_component("user_long_term_memory")
+
+    @property
+    def assistant_long_term_memory(self) -> LongTermMemory:
+        return self._get_component("assistant_long_term_memory")
+
+    @property
+    def updater(self) -> Updater:
+        return self._get_component("updater")
+
+    @property
+    def retriever(self) -> Retriever:
+        return self._get_component("retriever")
+
+    @property
+    def file_storage_manager(self):
+        return self._get_component("file_storage_manager")
+
     def _extract_knowledge_from_recent_mid_term(self, pages_to_extract=None):
         """
         从最近的 mid_term 页面中提取知识，不依赖 heat 阈值。
@@ -192,16 +325,17 @@ class Memcontext:
         """
         if pages_to_extract is None:
             # 如果没有提供页面，从最新的 session 中获取未分析的页面
-            if not self.mid_term_memory.heap:
+            hottest = self.mid_term_memory.peek_hottest()
+            if hottest is None:
                 return
             
             # 获取最新的 session（heat 最高的）
-            neg_heat, sid = self.mid_term_memory.heap[0]
+            sid, _ = hottest
             session = self.mid_term_memory.sessions.get(sid)
             if not session:
                 return
             
-            pages_to_extract = [p for p in session.get("details", []) if not p.get("analyzed", False)]
+            pages_to_extract = [p for p in self.mid_term_memory.get_session_details(sid) if not p.get("analyzed", False)]
         
         if not pages_to_extract:
             print("Memorycontext: No unanalyzed pages to extract knowledge from.")
@@ -218,17 +352,13 @@ class Memcontext:
             
             # 存储用户私有知识
             if new_user_private_knowledge and new_user_private_knowledge.lower() != "none":
-                for line in new_user_private_knowledge.split('\n'):
-                    if line.strip() and line.strip().lower() not in ["none", "- none", "- none."]:
-                        self.user_long_term_memory.add_user_knowledge(line.strip())
-                        print(f"Memorycontext: Added user knowledge: {line.strip()[:50]}...")
+                result = self.user_long_term_memory.add_user_knowledge_batch(new_user_private_knowledge.split('\n'))
+                print(f"Memorycontext: Added {result['added']} user knowledge entries, merged {result['merged']}.")
             
             # 存储 Assistant Knowledge
             if new_assistant_knowledge and new_assistant_knowledge.lower() != "none":
-                for line in new_assistant_knowledge.split('\n'):
-                    if line.strip() and line.strip().lower() not in ["none", "- none", "- none."]:
-                        self.assistant_long_term_memory.add_assistant_knowledge(line.strip())
-                        print(f"Memorycontext: Added assistant knowledge: {line.strip()[:50]}...")
+                result = self.assistant_long_term_memory.add_assistant_knowledge_batch(new_assistant_knowledge.split('\n'))
+                print(f"Memorycontext: Added {result['added']} assistant knowledge entries, merged {result['merged']}.")
             
             print("Memorycontext: Knowledge extraction completed.")
         except Exception as e:
@@ -242,23 +372,21 @@ class Memcontext:
         Adapted from main_memoybank.py's update_user_profile_from_top_segment.
         Enhanced with parallel LLM processing for better performance.
         """
-        if not self.mid_term_memory.heap:
+        # Decay every session's recency to now (one vectorized pass), then take the top of the rebuilt heap
+        hottest = self.mid_term_memory.refresh_all_heat()
+        if hottest is None:
             return
-
-        # Peek at the top of the heap (hottest segment)
-        # MidTermMemory heap stores (-H_segment, sid)
-        neg_heat, sid = self.mid_term_memory.heap[0] 
-        current_heat = -neg_heat
+        sid, current_heat = hottest
 
         if current_heat >= self.mid_term_heat_threshold:
             session = self.mid_term_memory.sessions.get(sid)
             if not session:
-                self.mid_term_memory.rebuild_heap() # Clean up if session is gone
+                self.mid_term_memory.refresh_heat(sid) # Clean up if session is gone
                 return
 
             # Get unanalyzed pages from this hot session
             # A page is a dict: {"user_input": ..., "agent_response": ..., "timestamp": ..., "analyzed": False, ...}
-            unanalyzed_pages = [p for p in session.get("details", []) if not p.get("analyzed", False)]
+            unanalyzed_pages = [p for p in self.mid_term_memory.get_session_details(sid) if not p.get("analyzed", False)]
 
             if unanalyzed_pages:
                 print(f"Memcontext: Mid-term session {sid} heat ({current_heat:.2f}) exceeded threshold. Analyzing {len(unanalyzed_pages)} pages for profile/knowledge update.")
@@ -278,19 +406,15 @@ class Memcontext:
                     print("Memcontext: Starting parallel knowledge extraction...")
                     return gpt_knowledge_extraction(unanalyzed_pages, self.client, model=self.llm_model)
                 
-                # 使用并行任务执行                
-                with ThreadPoolExecutor(max_workers=2) as executor:
-                    # 提交两个主要任务
-                    future_profile = executor.submit(task_user_profile_analysis)
-                    future_knowledge = executor.submit(task_knowledge_extraction)
-                    
-                    # 等待结果
-                    try:
-                        updated_user_profile = future_profile.result()  # 直接是更新后的完整画像
-                        knowledge_result = future_knowledge.result()
-                    except Exception as e:
-                        print(f"Error in parallel LLM processing: {e}")
-                        return
+                # 知识提取提交到共享线程池，画像分析在当前线程执行
+                future_knowledge = self._submit_background(task_knowledge_extraction)
+                try:
+                    updated_user_profile = task_user_profile_analysis()  # 直接是更新后的完整画像
+                    # This job may itself hold a pool worker; if the extraction has not started yet, run it here instead of waiting
+                    knowledge_result = task_knowledge_extraction() if future_knowledge.cancel() else future_knowledge.result()
+                except Exception as e:
+                    print(f"Error in parallel LLM processing: {e}")
+                    return
                 
                 new_user_private_knowledge = knowledge_result.get("private")
                 new_assistant_knowledge = knowledge_result.get("assistant_knowledge")
@@ -302,18 +426,14 @@ class Memcontext:
                 
                 # Add User Private Knowledge to user's LTM
                 if new_user_private_knowledge and new_user_private_knowledge.lower() != "none":
-                    for line in new_user_private_knowledge.split('\n'):
-                         if line.strip() and line.strip().lower() not in ["none", "- none", "- none."]:
-                            self.user_long_term_memory.add_user_knowledge(line.strip())
+                    self.user_long_term_memory.add_user_knowledge_batch(new_user_private_knowledge.split('\n'))
 
                 # Add Assistant Knowledge to assistant's LTM
                 if new_assistant_knowledge and new_assistant_knowledge.lower() != "none":
-                    for line in new_assistant_knowledge.split('\n'):
-                        if line.strip() and line.strip().lower() not in ["none", "- none", "- none."]:
-                           self.assistant_long_term_memory.add_assistant_knowledge(line.strip()) # Save to dedicated assistant LTM
+                    self.assistant_long_term_memory.add_assistant_knowledge_batch(new_assistant_knowledge.split('\n')) # Save to dedicated assistant LTM
 
                 # Mark pages as analyzed and reset session heat contributors
-                for p in session["details"]:
+                for p in self.mid_term_memory.get_session_details(sid):
                     p["analyzed"] = True # Mark all pages in session, or just unanalyzed_pages?
                                           # Original code marked all pages in session
                 
@@ -321,9 +441,10 @@ class Memcontext:
                 session["L_interaction"] = 0 # Reset interaction length contribution
                 # session["R_recency"] = 1.0 # Recency will re-calculate naturally
                 session["H_segment"] = compute_segment_heat(session) # Recompute heat with reset factors
-                session["last_visit_time"] = get_timestamp() # Update last visit time
+                set_last_visit(session) # Update last visit time
+                self.mid_term_memory.mark_session_dirty(sid)
                 
-                self.mid_term_memory.rebuild_heap() # Heap needs rebuild due to H_segment change
+                self.mid_term_memory.refresh_heat(sid) # H_segment changed
                 self.mid_term_memory.save()
                 print(f"Memcontext: Profile/Knowledge update for session {sid} complete. Heat reset.")
             else:
@@ -338,7 +459,10 @@ class Memcontext:
         Now calls sync part then async part.
         """
         self.add_short_term_memory_sync(user_input, agent_response, timestamp, meta_data)
-        self.trigger_long_term_analysis_async()
+        # Through the per-user queue so it never overlaps a background run, but wait for it like before
+        future = self._schedule_long_term_analysis(shed=False, block=True, job=self.trigger_long_term_analysis_async)
+        if future is not None:
+            future.result()
 
     def add_short_term_memory_sync(self, user_input: str, agent_response: str, timestamp: str = None, meta_data: dict = None):
         """
@@ -564,138 +688,113 @@ class Memcontext:
                     meta_data=mem.get("meta_data")
                 )
 
-    def get_response(self, query: str, relationship_with_user="friend", style_hint="", user_conversation_meta_data: dict = None) -> str:
+    def _lookup_file_response(self, query: str) -> Optional[str]:
         """
-        Generates a response to the user's query, incorporating memory and context.
-        
-        Args:
-            query: 用户查询
-            relationship_with_user: 与用户的关系
-            style_hint: 风格提示
-            user_conversation_meta_data: 当前对话的 metadata
+        检测用户是否在查询文件（通过 file_id 或 original_filename）。
+        找到（或明确找不到）文件时返回直接回复的文本，否则返回 None 继续正常流程。
         """
-        print(f"Memorycontext: Generating response for query: '{query[:50]}...'")
-
-        # 0. 检测用户是否在查询文件（通过 file_id 或 original_filename）
-        if self.file_storage_manager:
-            try:
-                # 0.1 尝试通过 file_id 查询
-                file_id = self._extract_file_id_from_query(query)
-                file_record = None
-                file_storage_id = None
-                
-                if file_id:
-                    # 先尝试直接查询（可能是 file_storage_id，32位十六进制）
-                    file_record = self.file_storage_manager.get_file_record(file_id)
+        # Cheap regex gate first: ordinary queries never load the file storage index
+        file_id = self._extract_file_id_from_query(query)
+        if not file_id and not self._extract_filename_from_query(query):
+            return None
+        if not self.file_storage_manager:
+            return None
+        try:
+            # 0.1 尝试通过 file_id 查询
+            file_record = None
+            file_storage_id = None
+            
+            if file_id:
+                # 先尝试直接查询（可能是 file_storage_id，32位十六进制）
+                file_record = self.file_storage_manager.get_file_record(file_id)
+                if file_record:
+                    file_storage_id = file_id
+                else:
+                    # 如果直接查询失败，可能是 source_file_id（64位十六进制），需要从记忆中查找对应的 file_storage_id
+                    print(f"Memorycontext: File ID {file_id} not found in file_storage, searching in memories for file_storage_id...")
+                    file_storage_id = self._find_file_storage_id_from_memory(file_id)
+                    if file_storage_id:
+                        file_record = self.file_storage_manager.get_file_record(file_storage_id)
+            
+            # 0.2 如果没有通过 file_id 找到，尝试通过文件名查询
+            filename = None
+            if not file_record:
+                filename = self._extract_filename_from_query(query)
+                if filename:
+                    print(f"Memorycontext: Searching file by filename: {filename}")
+                    file_record = self.file_storage_manager.find_file_by_name(filename)
                     if file_record:
-                        file_storage_id = file_id
-                    else:
-                        # 如果直接查询失败，可能是 source_file_id（64位十六进制），需要从记忆中查找对应的 file_storage_id
-                        print(f"Memorycontext: File ID {file_id} not found in file_storage, searching in memories for file_storage_id...")
-                        file_storage_id = self._find_file_storage_id_from_memory(file_id)
-                        if file_storage_id:
-                            file_record = self.file_storage_manager.get_file_record(file_storage_id)
-                
-                # 0.2 如果没有通过 file_id 找到，尝试通过文件名查询
-                filename = None
-                if not file_record:
-                    filename = self._extract_filename_from_query(query)
-                    if filename:
-                        print(f"Memorycontext: Searching file by filename: {filename}")
-                        file_record = self.file_storage_manager.find_file_by_name(filename)
-                        if file_record:
-                            file_storage_id = file_record.file_id
-                
-                # 0.3 如果找到了文件记录，返回文件信息
-                if file_record and file_storage_id:
-                    file_path = file_record.stored_path
-                    if os.path.exists(file_path):
-                        response = f"找到文件：{file_record.original_filename}\n\n文件信息：\n- 文件ID (file_storage_id): {file_storage_id}\n- 文件路径：{file_path}\n- 文件类型：{file_record.file_type.value if hasattr(file_record.file_type, 'value') else file_record.file_type}\n- 原始文件名：{file_record.original_filename}\n- 上传时间：{file_record.upload_time}"
-                        
-                        # 添加文件元数据信息
-                        if file_record.metadata:
-                            metadata = file_record.metadata
-                            if metadata.get('file_size'):
-                                response += f"\n- 文件大小：{metadata['file_size']} 字节"
-                            if metadata.get('duration'):
-                                response += f"\n- 时长：{metadata['duration']:.2f} 秒"
-                            if metadata.get('width') and metadata.get('height'):
-                                response += f"\n- 分辨率：{metadata['width']}x{metadata['height']}"
-                            if metadata.get('source_file_id'):
-                                response += f"\n- source_file_id (hash): {metadata['source_file_id']}"
-                        
-                        return response
-                    else:
-                        return f"找到文件记录，但文件不存在：{file_path}"
-                elif file_id:
-                    return f"未找到文件ID {file_id} 对应的文件路径。可能是 source_file_id，但未在记忆中找到对应的 file_storage_id。"
-                elif filename:
-                    return f"未找到文件名 {filename} 对应的文件。"
-            except Exception as e:
-                print(f"Memorycontext: Error querying file: {e}")
-                import traceback
-                traceback.print_exc()
-                # 继续正常流程，不中断
+                        file_storage_id = file_record.file_id
+            
+            # 0.3 如果找到了文件记录，返回文件信息
+            if file_record and file_storage_id:
+                file_path = file_record.stored_path
+                if os.path.exists(file_path):
+                    response = f"找到文件：{file_record.original_filename}\n\n文件信息：\n- 文件ID (file_storage_id): {file_storage_id}\n- 文件路径：{file_path}\n- 文件类型：{file_record.file_type.value if hasattr(file_record.file_type, 'value') else file_record.file_type}\n- 原始文件名：{file_record.original_filename}\n- 上传时间：{file_record.upload_time}"
+                    
+                    # 添加文件元数据信息
+                    if file_record.metadata:
+                        metadata = file_record.metadata
+                        if metadata.get('file_size'):
+                            response += f"\n- 文件大小：{metadata['file_size']} 字节"
+                        if metadata.get('duration'):
+                            response += f"\n- 时长：{metadata['duration']:.2f} 秒"
+                        if metadata.get('width') and metadata.get('height'):
+                            response += f"\n- 分辨率：{metadata['width']}x{metadata['height']}"
+                        if metadata.get('source_file_id'):
+                            response += f"\n- source_file_id (hash): {metadata['source_file_id']}"
+                    
+                    return response
+                else:
+                    return f"找到文件记录，但文件不存在：{file_path}"
+            elif file_id:
+                return f"未找到文件ID {file_id} 对应的文件路径。可能是 source_file_id，但未在记忆中找到对应的 file_storage_id。"
+            elif filename:
+                return f"未找到文件名 {filename} 对应的文件。"
+        except Exception as e:
+            print(f"Memorycontext: Error querying file: {e}")
+            import traceback
+            traceback.print_exc()
+            # 继续正常流程，不中断
+        return None
 
-        # 1. Retrieve context
-        # 检测用户是否在询问视频相关内容
+    def _collect_video_pages(self, query: str):
+        """
+        检测用户是否在询问视频相关内容；是则找出所有视频片段（按时间排序）。
+        返回 (is_video_query, all_video_pages)。
+        """
         is_video_query = any(keyword in query for keyword in [
             '视频', '这个视频', '该视频', '影片', 'movie', 'video'
         ])
         
-        # 如果用户询问视频相关内容，找出所有视频片段
         # 优先使用file_storage_id，如果没有则使用source_file_id
         all_video_pages = []
         if is_video_query:
             print(f"Memorycontext: Video query detected, collecting all video pages from mid_term memory")
-            # 统计所有视频ID及其片段数
-            video_ids = set()
-            for session_id, session_data in self.mid_term_memory.sessions.items():
-                for page in session_data.get("details", []):
-                    page_meta = page.get('meta_data', {}) or {}
-                    page_video_id = page_meta.get('file_storage_id') or page_meta.get('source_file_id')
-                    if page_video_id:
-                        video_ids.add(page_video_id)
-                        all_video_pages.append(page)
+            # 文件索引已按时间范围（或 chunk_index）排序，只读取包含视频片段的 session
+            video_ids = self.mid_term_memory.file_ids()
+            all_video_pages = self.mid_term_memory.file_pages()
             
-            print(f"Memorycontext: Found {len(all_video_pages)} video pages from {len(video_ids)} video(s): {list(video_ids)[:3]}...")
+            print(f"Memorycontext: Found {len(all_video_pages)} video pages from {len(video_ids)} video(s): {video_ids[:3]}...")
             
             if all_video_pages:
-                # 按时间范围排序
-                def get_time_range(page):
-                    meta = page.get('meta_data', {}) or {}
-                    time_range = meta.get('time_range', '')
-                    if isinstance(time_range, str) and '-' in time_range:
-                        try:
-                            # 处理格式如 "240.00s-274.50s" 或 "240.00-274.50"
-                            start_str = time_range.split('-')[0].replace('s', '').strip()
-                            start_time = float(start_str)
-                            return start_time
-                        except:
-                            return 0
-                    # 如果没有time_range，尝试从chunk_index排序
-                    return meta.get('chunk_index', 0)
-                
-                all_video_pages.sort(key=get_time_range)
                 print(f"Memorycontext: Using all {len(all_video_pages)} video pages for video query")
-        
-        # 如果找到了视频片段，使用它们；否则使用正常的检索逻辑
+        return is_video_query, all_video_pages
+
+    def _build_response_messages(self, query: str, retrieval_results: dict, is_video_query: bool, all_video_pages: list,
+                                 relationship_with_user="friend", user_conversation_meta_data: dict = None,
+                                 short_term_history: list = None, user_profile_text: str = None) -> list:
+        """
+        根据检索结果、短期历史、用户画像和知识构建最终回复的 messages（同步与异步版本共用）。
+        short_term_history / user_profile_text 为 None 时在这里读取（见 _response_stage_graph）。
+        """
+        # 如果找到了视频片段，使用它们；否则使用正常的检索结果
         if all_video_pages:
-            retrieval_results = self.retriever.retrieve_context(
-                user_query=query,
-                user_id=self.user_id
-            )
             retrieved_pages = all_video_pages  # 使用所有视频片段
-            retrieved_user_knowledge = retrieval_results["retrieved_user_knowledge"]
-            retrieved_assistant_knowledge = retrieval_results["retrieved_assistant_knowledge"]
         else:
-            retrieval_results = self.retriever.retrieve_context(
-                user_query=query,
-                user_id=self.user_id
-            )
             retrieved_pages = retrieval_results["retrieved_pages"]
-            retrieved_user_knowledge = retrieval_results["retrieved_user_knowledge"]
-            retrieved_assistant_knowledge = retrieval_results["retrieved_assistant_knowledge"]
+        retrieved_user_knowledge = retrieval_results["retrieved_user_knowledge"]
+        retrieved_assistant_knowledge = retrieval_results["retrieved_assistant_knowledge"]
         
         # 1.1 识别需要的 metadata 字段并重新排序检索结果
         # 如果已经收集了所有视频片段（all_video_pages），跳过过滤，保持所有片段
@@ -708,46 +807,17 @@ class Memcontext:
             print(f"Memorycontext: Using all {len(retrieved_pages)} video pages, skipping metadata filtering")
 
         # 2. Get short-term history
-        short_term_history = self.short_term_memory.get_all()
-        history_text = "\n".join([
+        if short_term_history is None:
+            short_term_history = self.short_term_memory.get_all()
+        history_entries = [
             f"User: {qa.get('user_input', '')}\nAssistant: {qa.get('agent_response', '')} (Time: {qa.get('timestamp', '')})"
             for qa in short_term_history
-        ])
+        ]
 
         # 3. Format retrieved mid-term pages (retrieval_queue equivalent)
-        def _format_meta(meta_obj):
-            if not meta_obj or not isinstance(meta_obj, dict) or len(meta_obj) == 0:
-                return "None"
-            try:
-                # 格式化 metadata，突出关键字段
-                formatted = []
-                key_fields = ['name', 'video_name', 'time_range', 'chunk_index', 'objects_detected', 'scene_label', 'duration_seconds']
-                for key in key_fields:
-                    if key in meta_obj and meta_obj[key]:
-                        formatted.append(f"  {key}: {meta_obj[key]}")
-                # 添加其他字段
-                for key, value in meta_obj.items():
-                    if key not in key_fields and value:
-                        formatted.append(f"  {key}: {value}")
-                if formatted:
-                    return "\n" + "\n".join(formatted)
-                return "None"
-            except TypeError:
-                return str(meta_obj)
-
-        retrieval_text = "\n".join([
-            f"【Historical Memory】\n"
-            f"User: {page.get('user_input', '')}\n"
-            f"Assistant: {page.get('agent_response', '')}\n"
-            f"Time: {page.get('timestamp', '')}\n"
-            f"Conversation chain overview: {page.get('meta_info','N/A')}\n"
-            f"Metadata:{_format_meta(page.get('meta_data', {}) or {})}"
-            for page in retrieved_pages
-        ])
         # 提取查询中提到的视频信息（如果有），用于过滤结果
         query_video_id = None
         if '描述' in query and '的' in query:
-            import re
             # 尝试从查询中提取视频ID（格式：描述{视频id}的{time_range}）
             video_match = re.search(r'描述(.+?)的', query)
             if video_match:
@@ -755,7 +825,6 @@ class Memcontext:
         
         # 兼容旧格式：尝试提取视频路径或名称
         if not query_video_id and '视频' in query:
-            import re
             # 尝试从查询中提取视频路径或名称
             video_match = re.search(r'["\']?([^"\']+\.(mp4|avi|mov|mkv|webm))["\']?', query)
             if video_match:
@@ -769,7 +838,9 @@ class Memcontext:
         query_video_path = query_video_id  # 为了兼容性，使用同一个变量
         
         retrieval_text_parts = []
-        for page in retrieved_pages:
+        page_items = []
+        query_terms = set(tokenize(query)) if is_video_query and all_video_pages else set()
+        for rank, page in enumerate(retrieved_pages):
             # 安全获取 meta_data，确保是字典类型
             try:
                 page_meta = page.get('meta_data', {})
@@ -784,7 +855,6 @@ class Memcontext:
             page_video_path = None  # 用于兼容旧数据
             
             if '描述' in user_input and '的' in user_input:
-                import re
                 try:
                     # 匹配格式：描述{视频id}的{time_range}
                     match = re.search(r'描述(.+?)的', user_input)
@@ -828,36 +898,64 @@ class Memcontext:
                 if not matched:
                     continue  # 跳过不匹配的视频
             
-            page_text = f"【Historical Memory】\nUser: {page.get('user_input', '')}\nAssistant: {page.get('agent_response', '')}\nTime: {page.get('timestamp', '')}\nConversation chain overview: {page.get('meta_info','N/A')}"
+            source_line = ""
             # 显示视频ID或路径（优先显示ID）
             if page_video_id:
-                page_text += f"\n[Video Source: {page_video_id}]"
+                source_line = f"\n[Video Source: {page_video_id}]"
             elif page_video_path:
-                page_text += f"\n[Video Source: {page_video_path}]"
+                source_line = f"\n[Video Source: {page_video_path}]"
+            page_text = f"【Historical Memory】\nUser: {page.get('user_input', '')}\nAssistant: {page.get('agent_response', '')}\nTime: {page.get('timestamp', '')}\nConversation chain overview: {page.get('meta_info','N/A')}" + source_line
+            # Over budget, a page falls back to its question and chain summary without the full answer
+            short_text = f"【Historical Memory】\nUser: {page.get('user_input', '')}\nTime: {page.get('timestamp', '')}\nConversation chain overview: {page.get('meta_info','N/A')}" + source_line
+            if query_terms:
+                # Video pages come in time order, so rank them by overlap with the query instead
+                score = len(query_terms.intersection(tokenize(f"{page.get('user_input', '')} {page.get('agent_response', '')}"))) / len(query_terms)
+            else:
+                score = -rank # Retrieved pages are already ranked
             retrieval_text_parts.append(page_text)
-        
-        retrieval_text = "\n\n".join(retrieval_text_parts)
+            page_items.append(ContextItem(page_text, score=score, short=short_text))
 
         # 4. Get user profile
-        user_profile_text = self.user_long_term_memory.get_raw_user_profile(self.user_id)
+        if user_profile_text is None:
+            user_profile_text = self.user_long_term_memory.get_raw_user_profile(self.user_id)
         if not user_profile_text or user_profile_text.lower() == "none": 
             user_profile_text = "No detailed profile available yet."
 
+        user_knowledge_lines = [f"- {kn_entry['knowledge']} (Recorded: {kn_entry['timestamp']})\n" for kn_entry in retrieved_user_knowledge or []]
+        assistant_knowledge_lines = [f"- {ak_entry['knowledge']} (Recorded: {ak_entry['timestamp']})\n" for ak_entry in retrieved_assistant_knowledge or []]
+
+        # 4.1 Fit every section into the token budget (no-op when everything fits)
+        if self.context_packer is not None:
+            n_items = len(history_entries)
+            packed = self.context_packer.pack({
+                # Newer turns matter more
+                "history": [ContextItem(text, score=i - n_items) for i, text in enumerate(history_entries)],
+                "pages": page_items,
+                "profile": [ContextItem(user_profile_text)],
+                "user_knowledge": [ContextItem(text, score=-i) for i, text in enumerate(user_knowledge_lines)],
+                "assistant_knowledge": [ContextItem(text, score=-i) for i, text in enumerate(assistant_knowledge_lines)],
+            })
+            history_entries = [text for _, text in packed["history"]]
+            retrieval_text_parts = [text for _, text in packed["pages"]]
+            user_profile_text = "".join(text for _, text in packed["profile"])
+            user_knowledge_lines = [text if text.endswith("\n") else text + "\n" for _, text in packed["user_knowledge"]]
+            assistant_knowledge_lines = [text if text.endswith("\n") else text + "\n" for _, text in packed["assistant_knowledge"]]
+
+        history_text = "\n".join(history_entries)
+        retrieval_text = "\n\n".join(retrieval_text_parts)
+
         # 5. Format retrieved user knowledge for background
         user_knowledge_background = ""
-        if retrieved_user_knowledge:
-            user_knowledge_background = "\n【Relevant User Knowledge Entries】\n"
-            for kn_entry in retrieved_user_knowledge:
-                user_knowledge_background += f"- {kn_entry['knowledge']} (Recorded: {kn_entry['timestamp']})\n"
+        if user_knowledge_lines:
+            user_knowledge_background = "\n【Relevant User Knowledge Entries】\n" + "".join(user_knowledge_lines)
         
         background_context = f"【User Profile】\n{user_profile_text}\n{user_knowledge_background}"
 
         # 6. Format retrieved Assistant Knowledge (from assistant's LTM)
         # Use retrieved assistant knowledge instead of all assistant knowledge
         assistant_knowledge_text_for_prompt = "【Assistant Knowledge Base】\n"
-        if retrieved_assistant_knowledge:
-            for ak_entry in retrieved_assistant_knowledge:
-                assistant_knowledge_text_for_prompt += f"- {ak_entry['knowledge']} (Recorded: {ak_entry['timestamp']})\n"
+        if assistant_knowledge_lines:
+            assistant_knowledge_text_for_prompt += "".join(assistant_knowledge_lines)
         else:
             assistant_knowledge_text_for_prompt += "- No relevant assistant knowledge found for this query.\n"
 
@@ -878,7 +976,6 @@ class Memcontext:
             meta_data_text=meta_data_text_for_prompt # Using meta_data_text placeholder for user_conversation_meta_data
         )
         
-        # 8. Construct Prompts
         user_prompt_text = prompts.GENERATE_SYSTEM_RESPONSE_USER_PROMPT.format(
             history_text=history_text,
             retrieval_text=retrieval_text,
@@ -887,15 +984,117 @@ class Memcontext:
             query=query
         )
         
-        messages = [
+        return [
             {"role": "system", "content": system_prompt_text},
             {"role": "user", "content": user_prompt_text}
         ]
 
+    def _response_stage_graph(self, query: str, retrieve, relationship_with_user="friend", user_conversation_meta_data: dict = None) -> StageGraph:
+        """
+        回复生成前的阶段依赖图：视频片段收集、检索、短期历史、用户画像互不依赖，并发执行（各自按需加载所需的记忆层），
+        全部就绪后立即构建 messages（metadata 重排与各 section 格式化依赖检索结果，放在最后一步）。
+        retrieve 为无参的检索函数（同步或协程函数）。
+        """
+        graph = StageGraph()
+        graph.add("video_pages", lambda: self._collect_video_pages(query))
+        graph.add("retrieval", retrieve)
+        graph.add("short_term", lambda: self.short_term_memory.get_all())
+        graph.add("profile", lambda: self.user_long_term_memory.get_raw_user_profile(self.user_id))
+        graph.add("messages", lambda video, retrieval_results, history, profile: self._build_response_messages(
+            query, retrieval_results, video[0], video[1],
+            relationship_with_user=relationship_with_user,
+            user_conversation_meta_data=user_conversation_meta_data,
+            short_term_history=history,
+            user_profile_text=profile
+        ), deps=("video_pages", "retrieval", "short_term", "profile"))
+        return graph
+
+    def _record_response_timings(self, started, file_lookup_ms, graph=None):
+        """记录本次请求各阶段耗时（毫秒）到 last_response_timings，流式调用会再补上 ttft_ms"""
+        self.last_response_timings = {
+            "file_lookup_ms": file_lookup_ms,
+            "stages": dict(graph.timings) if graph is not None else {},
+            "pre_llm_ms": (time.perf_counter() - started) * 1000,
+        }
+        if graph is not None:
+            print(f"Memorycontext: Pre-LLM stages (ms): file_lookup={file_lookup_ms:.1f} {graph.format_timings()} "
+                  f"total={self.last_response_timings['pre_llm_ms']:.1f}")
+
+    def _prepare_response(self, query: str, relationship_with_user="friend", user_conversation_meta_data: dict = None):
+        """返回 (file_response, messages)：文件查询时只有 file_response，否则 messages 由阶段图并发构建"""
+        started = time.perf_counter()
+        file_response = self._lookup_file_response(query)
+        file_lookup_ms = (time.perf_counter() - started) * 1000
+        if file_response is not None:
+            self._record_response_timings(started, file_lookup_ms)
+            return file_response, None
+        graph = self._response_stage_graph(
+            query, lambda: self.retriever.retrieve_context(user_query=query, user_id=self.user_id),
+            relationship_with_user=relationship_with_user, user_conversation_meta_data=user_conversation_meta_data
+        )
+        messages = graph.run()["messages"].result()
+        self._record_response_timings(started, file_lookup_ms, graph)
+        return None, messages
+
+    async def _aprepare_response(self, query: str, relationship_with_user="friend", user_conversation_meta_data: dict = None):
+        """
+        _prepare_response 的 asyncio 版本，检索 embedding 为异步 I/O；
+        文件查询、记忆层的首次加载和其余阶段都会读写磁盘，在线程池中执行。
+        """
+        started = time.perf_counter()
+        file_response = await asyncio.to_thread(self._lookup_file_response, query)
+        file_lookup_ms = (time.perf_counter() - started) * 1000
+        if file_response is not None:
+            self._record_response_timings(started, file_lookup_ms)
+            return file_response, None
+
+        async def retrieve():
+            retriever = await asyncio.to_thread(lambda: self.retriever) # Loads the tiers on first use
+            return await retriever.aretrieve_context(user_query=query, user_id=self.user_id)
+
+        graph = self._response_stage_graph(
+            query, retrieve,
+            relationship_with_user=relationship_with_user, user_conversation_meta_data=user_conversation_meta_data
+        )
+        messages = await (await graph.arun())["messages"]
+        self._record_response_timings(started, file_lookup_ms, graph)
+        return None, messages
+
+    def _record_first_token(self, started):
+        self.last_response_timings["ttft_ms"] = (time.perf_counter() - started) * 1000
+        print(f"Memorycontext: Time to first token {self.last_response_timings['ttft_ms']:.1f} ms")
+
+    @staticmethod
+    def _stream_chunk_content(chunk):
+        # 兼容不同的 SDK 返回格式
+        if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
+            delta = chunk.choices[0].delta
+            if hasattr(delta, 'content'):
+                return delta.content
+        return None
+
+    def get_response(self, query: str, relationship_with_user="friend", style_hint="", user_conversation_meta_data: dict = None) -> str:
+        """
+        Generates a response to the user's query, incorporating memory and context.
+        
+        Args:
+            query: 用户查询
+            relationship_with_user: 与用户的关系
+            style_hint: 风格提示
+            user_conversation_meta_data: 当前对话的 metadata
+        """
+        print(f"Memorycontext: Generating response for query: '{query[:50]}...'")
+
+        # 0. 检测用户是否在查询文件（通过 file_id 或 original_filename），否则
+        # 1-8. 并发检索上下文、读取短期历史与画像，并构建 prompts
+        file_response, messages = self._prepare_response(
+            query, relationship_with_user=relationship_with_user, user_conversation_meta_data=user_conversation_meta_data
+        )
+        if file_response is not None:
+            return file_response
+
         # 9. Call LLM for response
         print("Memorycontext: Calling LLM for final response generation...")
-        # print("System Prompt:\n", system_prompt_text)
-        # print("User Prompt:\n", user_prompt_text)
         response_content = self.client.chat_completion(
             model=self.llm_model, 
             messages=messages, 
@@ -905,339 +1104,21 @@ class Memcontext:
         self.add_memory(user_input=query, agent_response=response_content, timestamp=get_timestamp())
         
         return response_content
-# 在 Memcontext 类中添加此新方法
 
     def get_response_stream(self, query: str, relationship_with_user="friend", style_hint="", user_conversation_meta_data: dict = None):
         """
         流式版本的 get_response
         """
         print(f"Memorycontext: Streaming response for query: '{query[:50]}...'")
+        started = time.perf_counter()
 
-        # === 1. 复用原有的检索逻辑 (复制 get_response 的前半部分) ===
-        # ... (此处省略 Step 0 到 Step 8 的代码，与原 get_response 完全一致，用于构建 Prompt) ...
-        # 假设此时你已经得到了 messages 列表
-        
-        # 注意：如果 Step 0 中检测到文件并直接有了静态 response (例如 "找到文件...")
-        # 需要改成 yield 并存储，如下：
-        # if file_response:
-        #     yield file_response
-        #     self.add_memory(user_input=query, agent_response=file_response, timestamp=get_timestamp())
-        #     return
-        # 0. 检测用户是否在查询文件（通过 file_id 或 original_filename）
-        if self.file_storage_manager:
-            try:
-                # 0.1 尝试通过 file_id 查询
-                file_id = self._extract_file_id_from_query(query)
-                file_record = None
-                file_storage_id = None
-                
-                if file_id:
-                    # 先尝试直接查询（可能是 file_storage_id，32位十六进制）
-                    file_record = self.file_storage_manager.get_file_record(file_id)
-                    if file_record:
-                        file_storage_id = file_id
-                    else:
-                        # 如果直接查询失败，可能是 source_file_id（64位十六进制），需要从记忆中查找对应的 file_storage_id
-                        print(f"Memorycontext: File ID {file_id} not found in file_storage, searching in memories for file_storage_id...")
-                        file_storage_id = self._find_file_storage_id_from_memory(file_id)
-                        if file_storage_id:
-                            file_record = self.file_storage_manager.get_file_record(file_storage_id)
-                
-                # 0.2 如果没有通过 file_id 找到，尝试通过文件名查询
-                filename = None
-                if not file_record:
-                    filename = self._extract_filename_from_query(query)
-                    if filename:
-                        print(f"Memorycontext: Searching file by filename: {filename}")
-                        file_record = self.file_storage_manager.find_file_by_name(filename)
-                        if file_record:
-                            file_storage_id = file_record.file_id
-                
-                # 0.3 如果找到了文件记录，返回文件信息
-                if file_record and file_storage_id:
-                    file_path = file_record.stored_path
-                    if os.path.exists(file_path):
-                        response = f"找到文件：{file_record.original_filename}\n\n文件信息：\n- 文件ID (file_storage_id): {file_storage_id}\n- 文件路径：{file_path}\n- 文件类型：{file_record.file_type.value if hasattr(file_record.file_type, 'value') else file_record.file_type}\n- 原始文件名：{file_record.original_filename}\n- 上传时间：{file_record.upload_time}"
-                        
-                        # 添加文件元数据信息
-                        if file_record.metadata:
-                            metadata = file_record.metadata
-                            if metadata.get('file_size'):
-                                response += f"\n- 文件大小：{metadata['file_size']} 字节"
-                            if metadata.get('duration'):
-                                response += f"\n- 时长：{metadata['duration']:.2f} 秒"
-                            if metadata.get('width') and metadata.get('height'):
-                                response += f"\n- 分辨率：{metadata['width']}x{metadata['height']}"
-                            if metadata.get('source_file_id'):
-                                response += f"\n- source_file_id (hash): {metadata['source_file_id']}"
-                        
-                        return response
-                    else:
-                        return f"找到文件记录，但文件不存在：{file_path}"
-                elif file_id:
-                    return f"未找到文件ID {file_id} 对应的文件路径。可能是 source_file_id，但未在记忆中找到对应的 file_storage_id。"
-                elif filename:
-                    return f"未找到文件名 {filename} 对应的文件。"
-            except Exception as e:
-                print(f"Memorycontext: Error querying file: {e}")
-                import traceback
-                traceback.print_exc()
-                # 继续正常流程，不中断
-
-        # 1. Retrieve context
-        # 检测用户是否在询问视频相关内容
-        is_video_query = any(keyword in query for keyword in [
-            '视频', '这个视频', '该视频', '影片', 'movie', 'video'
-        ])
-        
-        # 如果用户询问视频相关内容，找出所有视频片段
-        # 优先使用file_storage_id，如果没有则使用source_file_id
-        all_video_pages = []
-        if is_video_query:
-            print(f"Memorycontext: Video query detected, collecting all video pages from mid_term memory")
-            # 统计所有视频ID及其片段数
-            video_ids = set()
-            for session_id, session_data in self.mid_term_memory.sessions.items():
-                for page in session_data.get("details", []):
-                    page_meta = page.get('meta_data', {}) or {}
-                    page_video_id = page_meta.get('file_storage_id') or page_meta.get('source_file_id')
-                    if page_video_id:
-                        video_ids.add(page_video_id)
-                        all_video_pages.append(page)
-            
-            print(f"Memorycontext: Found {len(all_video_pages)} video pages from {len(video_ids)} video(s): {list(video_ids)[:3]}...")
-            
-            if all_video_pages:
-                # 按时间范围排序
-                def get_time_range(page):
-                    meta = page.get('meta_data', {}) or {}
-                    time_range = meta.get('time_range', '')
-                    if isinstance(time_range, str) and '-' in time_range:
-                        try:
-                            # 处理格式如 "240.00s-274.50s" 或 "240.00-274.50"
-                            start_str = time_range.split('-')[0].replace('s', '').strip()
-                            start_time = float(start_str)
-                            return start_time
-                        except:
-                            return 0
-                    # 如果没有time_range，尝试从chunk_index排序
-                    return meta.get('chunk_index', 0)
-                
-                all_video_pages.sort(key=get_time_range)
-                print(f"Memorycontext: Using all {len(all_video_pages)} video pages for video query")
-        
-        # 如果找到了视频片段，使用它们；否则使用正常的检索逻辑
-        if all_video_pages:
-            retrieval_results = self.retriever.retrieve_context(
-                user_query=query,
-                user_id=self.user_id
-            )
-            retrieved_pages = all_video_pages  # 使用所有视频片段
-            retrieved_user_knowledge = retrieval_results["retrieved_user_knowledge"]
-            retrieved_assistant_knowledge = retrieval_results["retrieved_assistant_knowledge"]
-        else:
-            retrieval_results = self.retriever.retrieve_context(
-                user_query=query,
-                user_id=self.user_id
-            )
-            retrieved_pages = retrieval_results["retrieved_pages"]
-            retrieved_user_knowledge = retrieval_results["retrieved_user_knowledge"]
-            retrieved_assistant_knowledge = retrieval_results["retrieved_assistant_knowledge"]
-        
-        # 1.1 识别需要的 metadata 字段并重新排序检索结果
-        # 如果已经收集了所有视频片段（all_video_pages），跳过过滤，保持所有片段
-        if not is_video_query or not all_video_pages:
-            needed_metadata_fields = self._needs_metadata(query)
-            retrieved_pages = self._filter_and_rank_by_metadata(retrieved_pages, needed_metadata_fields)
-            if needed_metadata_fields:
-                print(f"Memorycontext: Query needs metadata fields: {needed_metadata_fields}, re-ranked {len(retrieved_pages)} pages")
-        else:
-            print(f"Memorycontext: Using all {len(retrieved_pages)} video pages, skipping metadata filtering")
-
-        # 2. Get short-term history
-        short_term_history = self.short_term_memory.get_all()
-        history_text = "\n".join([
-            f"User: {qa.get('user_input', '')}\nAssistant: {qa.get('agent_response', '')} (Time: {qa.get('timestamp', '')})"
-            for qa in short_term_history
-        ])
-
-        # 3. Format retrieved mid-term pages (retrieval_queue equivalent)
-        def _format_meta(meta_obj):
-            if not meta_obj or not isinstance(meta_obj, dict) or len(meta_obj) == 0:
-                return "None"
-            try:
-                # 格式化 metadata，突出关键字段
-                formatted = []
-                key_fields = ['name', 'video_name', 'time_range', 'chunk_index', 'objects_detected', 'scene_label', 'duration_seconds']
-                for key in key_fields:
-                    if key in meta_obj and meta_obj[key]:
-                        formatted.append(f"  {key}: {meta_obj[key]}")
-                # 添加其他字段
-                for key, value in meta_obj.items():
-                    if key not in key_fields and value:
-                        formatted.append(f"  {key}: {value}")
-                if formatted:
-                    return "\n" + "\n".join(formatted)
-                return "None"
-            except TypeError:
-                return str(meta_obj)
-
-        retrieval_text = "\n".join([
-            f"【Historical Memory】\n"
-            f"User: {page.get('user_input', '')}\n"
-            f"Assistant: {page.get('agent_response', '')}\n"
-            f"Time: {page.get('timestamp', '')}\n"
-            f"Conversation chain overview: {page.get('meta_info','N/A')}\n"
-            f"Metadata:{_format_meta(page.get('meta_data', {}) or {})}"
-            for page in retrieved_pages
-        ])
-        # 提取查询中提到的视频信息（如果有），用于过滤结果
-        query_video_id = None
-        if '描述' in query and '的' in query:
-            import re
-            # 尝试从查询中提取视频ID（格式：描述{视频id}的{time_range}）
-            video_match = re.search(r'描述(.+?)的', query)
-            if video_match:
-                query_video_id = video_match.group(1)
-        
-        # 兼容旧格式：尝试提取视频路径或名称
-        if not query_video_id and '视频' in query:
-            import re
-            # 尝试从查询中提取视频路径或名称
-            video_match = re.search(r'["\']?([^"\']+\.(mp4|avi|mov|mkv|webm))["\']?', query)
-            if video_match:
-                query_video_id = video_match.group(1)
-            else:
-                # 尝试提取"xxx视频"格式
-                video_match = re.search(r'([^\s]+)视频', query)
-                if video_match:
-                    query_video_id = video_match.group(1)
-        
-        query_video_path = query_video_id  # 为了兼容性，使用同一个变量
-        
-        retrieval_text_parts = []
-        for page in retrieved_pages:
-            # 安全获取 meta_data，确保是字典类型
-            try:
-                page_meta = page.get('meta_data', {})
-                if not isinstance(page_meta, dict):
-                    page_meta = {}
-            except (AttributeError, TypeError):
-                page_meta = {}
-            
-            # 从 user_input 中提取视频ID（格式：描述{视频id}的{time_range}）
-            user_input = page.get('user_input', '')
-            page_video_id = None
-            page_video_path = None  # 用于兼容旧数据
-            
-            if '描述' in user_input and '的' in user_input:
-                import re
-                try:
-                    # 匹配格式：描述{视频id}的{time_range}
-                    match = re.search(r'描述(.+?)的', user_input)
-                    if match:
-                        page_video_id = match.group(1)
-                except Exception as e:
-                    print(f"Memorycontext: Error extracting video_id from user_input: {e}")
-            
-            # 如果从 user_input 中提取失败，尝试从 meta_data 中获取（使用 .get() 安全访问）
-            if not page_video_id:
-                page_video_id = page_meta.get('file_storage_id') or page_meta.get('source_file_id')
-            
-            # 为了兼容性，也尝试获取 video_path（用于旧数据）
-            if not page_video_id:
-                page_video_path = page_meta.get('video_path') or page_meta.get('video_name')
-                if page_video_path:
-                    page_video_id = page_video_path  # 使用 video_path 作为 fallback
-            else:
-                # 如果有 video_id，也尝试获取 video_path 用于显示
-                page_video_path = page_meta.get('video_path') or page_meta.get('video_name')
-            
-            # 如果查询中明确指定了视频ID/路径，只返回匹配的视频内容
-            # 但如果已经收集了所有视频片段（is_video_query且all_video_pages），跳过这个过滤
-            if query_video_path and not (is_video_query and all_video_pages):
-                # 检查是否匹配（支持 video_id 或 video_path 匹配）
-                matched = False
-                if page_video_id:
-                    try:
-                        if query_video_path in str(page_video_id) or str(page_video_id) in query_video_path:
-                            matched = True
-                    except TypeError:
-                        pass
-                elif page_video_path:
-                    # 回退到 video_path 匹配（兼容旧数据）
-                    try:
-                        if query_video_path in str(page_video_path) or str(page_video_path) in query_video_path:
-                            matched = True
-                    except TypeError:
-                        pass
-                
-                if not matched:
-                    continue  # 跳过不匹配的视频
-            
-            page_text = f"【Historical Memory】\nUser: {page.get('user_input', '')}\nAssistant: {page.get('agent_response', '')}\nTime: {page.get('timestamp', '')}\nConversation chain overview: {page.get('meta_info','N/A')}"
-            # 显示视频ID或路径（优先显示ID）
-            if page_video_id:
-                page_text += f"\n[Video Source: {page_video_id}]"
-            elif page_video_path:
-                page_text += f"\n[Video Source: {page_video_path}]"
-            retrieval_text_parts.append(page_text)
-        
-        retrieval_text = "\n\n".join(retrieval_text_parts)
-
-        # 4. Get user profile
-        user_profile_text = self.user_long_term_memory.get_raw_user_profile(self.user_id)
-        if not user_profile_text or user_profile_text.lower() == "none": 
-            user_profile_text = "No detailed profile available yet."
-
-        # 5. Format retrieved user knowledge for background
-        user_knowledge_background = ""
-        if retrieved_user_knowledge:
-            user_knowledge_background = "\n【Relevant User Knowledge Entries】\n"
-            for kn_entry in retrieved_user_knowledge:
-                user_knowledge_background += f"- {kn_entry['knowledge']} (Recorded: {kn_entry['timestamp']})\n"
-        
-        background_context = f"【User Profile】\n{user_profile_text}\n{user_knowledge_background}"
-
-        # 6. Format retrieved Assistant Knowledge (from assistant's LTM)
-        # Use retrieved assistant knowledge instead of all assistant knowledge
-        assistant_knowledge_text_for_prompt = "【Assistant Knowledge Base】\n"
-        if retrieved_assistant_knowledge:
-            for ak_entry in retrieved_assistant_knowledge:
-                assistant_knowledge_text_for_prompt += f"- {ak_entry['knowledge']} (Recorded: {ak_entry['timestamp']})\n"
-        else:
-            assistant_knowledge_text_for_prompt += "- No relevant assistant knowledge found for this query.\n"
-
-        # 7. Format user_conversation_meta_data (if provided)
-        meta_data_text_for_prompt = "【Current Conversation Metadata】\n"
-        if user_conversation_meta_data:
-            try:
-                meta_data_text_for_prompt += json.dumps(user_conversation_meta_data, ensure_ascii=False, indent=2)
-            except TypeError:
-                meta_data_text_for_prompt += str(user_conversation_meta_data)
-        else:
-            meta_data_text_for_prompt += "None provided for this turn."
-
-        # 8. Construct Prompts
-        system_prompt_text = prompts.GENERATE_SYSTEM_RESPONSE_SYSTEM_PROMPT.format(
-            relationship=relationship_with_user,
-            assistant_knowledge_text=assistant_knowledge_text_for_prompt,
-            meta_data_text=meta_data_text_for_prompt # Using meta_data_text placeholder for user_conversation_meta_data
+        # 0. 文件查询直接返回静态回复；否则 1-8. 各阶段并发执行后构建 prompts
+        file_response, messages = self._prepare_response(
+            query, relationship_with_user=relationship_with_user, user_conversation_meta_data=user_conversation_meta_data
         )
-        
-        # 8. Construct Prompts
-        user_prompt_text = prompts.GENERATE_SYSTEM_RESPONSE_USER_PROMPT.format(
-            history_text=history_text,
-            retrieval_text=retrieval_text,
-            background=background_context,
-            relationship=relationship_with_user,
-            query=query
-        )
-        
-        messages = [
-            {"role": "system", "content": system_prompt_text},
-            {"role": "user", "content": user_prompt_text}
-        ]
+        if file_response is not None:
+            yield file_response
+            return
 
         # 流式调用与存储 ===
         
@@ -1257,14 +1138,10 @@ class Memcontext:
             
             # 迭代流对象
             for chunk in stream:
-                content = None
-                # 兼容不同的 SDK 返回格式
-                if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                    delta = chunk.choices[0].delta
-                    if hasattr(delta, 'content'):
-                        content = delta.content
-                
+                content = self._stream_chunk_content(chunk)
                 if content:
+                    if not full_response_content:
+                        self._record_first_token(started)
                     full_response_content += content
                     yield content # 实时把字符吐给 app.py
             
@@ -1280,14 +1157,8 @@ class Memcontext:
                 except Exception as e:
                     print(f"Error in sync add_short_term_memory: {e}")
 
-                # 2. 异步：启动后台线程处理长期记忆分析（耗时操作）
-                def async_long_term_process():
-                    try:
-                        self.trigger_long_term_analysis_async()
-                    except Exception as e:
-                        print(f"Error in async long_term_process: {e}")
-                
-                threading.Thread(target=async_long_term_process).start()
+                # 2. 异步：后台处理长期记忆分析（耗时操作），同一用户的触发排队合并
+                self._schedule_long_term_analysis()
                 
         except Exception as e:
             print(f"Streaming error: {e}")
@@ -1296,6 +1167,147 @@ class Memcontext:
                  self.add_memory(user_input=query, agent_response=full_response_content, timestamp=get_timestamp())
             yield f"\n[System Error: {str(e)}]"
 
+    def _run_long_term_analysis(self):
+        try:
+            self.trigger_long_term_analysis_async()
+        except Exception as e:
+            print(f"Error in async long_term_process: {e}")
+
+    @property
+    def maintenance_queue(self) -> MaintenanceQueue:
+        """有共享 runtime 时使用其维护队列，否则使用实例自己的单线程队列"""
+        if self.runtime is not None:
+            return self.runtime.maintenance
+        with self._component_lock:
+            if self._maintenance_queue is None:
+                self._maintenance_queue = MaintenanceQueue(max_workers=1)
+            return self._maintenance_queue
+
+    def _schedule_long_term_analysis(self, shed=True, block=False, job=None):
+        """
+        把中期迁移 + 画像/知识分析排入该用户的维护队列，返回 Future；被丢弃时返回 None。
+        已排队未开始的分析会与本次触发合并，执行时读取的是最新的短期记忆，所以不会漏处理。
+        """
+        return self.maintenance_queue.submit(self.user_data_dir, "long_term_analysis", job or self._run_long_term_analysis,
+                                             shed=shed, block=block)
+
+    def maintenance_queue_depth(self):
+        """该用户排队中（未开始）的后台维护任务数"""
+        return self.maintenance_queue.depth(self.user_data_dir)
+
+    def has_pending_maintenance(self):
+        """该用户是否有正在执行或排队的后台维护任务（runtime 回收实例前检查）"""
+        return self.maintenance_queue.is_busy(self.user_data_dir)
+
+    def _submit_background(self, fn):
+        """提交后台子任务：有 runtime 时用其共享线程池，否则用 LLM 客户端的线程池"""
+        if self.runtime is not None:
+            return self.runtime.submit_background(fn)
+        return self.client.executor.submit(fn)
+
+    def close(self):
+        """释放实例独占的资源；共享 runtime 的客户端与线程池由 runtime 管理"""
+        if self.runtime is None:
+            if self._maintenance_queue is not None:
+                self._maintenance_queue.shutdown(wait=True) # Let a running migration finish writing
+            self.client.shutdown()
+
+    # --- Asyncio API ---
+    @property
+    def async_client(self) -> AsyncOpenAIClient:
+        """与 self.client 使用相同配置的 AsyncOpenAIClient（首次使用时创建）"""
+        if self._async_client is None:
+            if self.runtime is not None:
+                self._async_client = self.runtime.get_async_client(api_key=self.client.api_key, base_url=self.client.base_url)
+            else:
+                self._async_client = AsyncOpenAIClient(api_key=self.client.api_key, base_url=self.client.base_url)
+        return self._async_client
+
+    async def aadd_memory(self, user_input: str, agent_response: str, timestamp: str = None, meta_data: dict = None):
+        """
+        add_memory 的 asyncio 版本：短期记忆立即写入，
+        中期迁移/画像分析（同步 LLM 调用链）放到后台线程池执行，不阻塞事件循环。
+        """
+        self.add_short_term_memory_sync(user_input, agent_response, timestamp, meta_data)
+        future = self._schedule_long_term_analysis(shed=False, job=self.trigger_long_term_analysis_async)
+        if future is not None:
+            await asyncio.wrap_future(future)
+
+    async def aget_response(self, query: str, relationship_with_user="friend", style_hint="", user_conversation_meta_data: dict = None) -> str:
+        """get_response 的 asyncio 版本：检索 embedding 与 LLM 调用均为异步 I/O"""
+        print(f"Memorycontext: Generating response (async) for query: '{query[:50]}...'")
+
+        file_response, messages = await self._aprepare_response(
+            query, relationship_with_user=relationship_with_user, user_conversation_meta_data=user_conversation_meta_data
+        )
+        if file_response is not None:
+            return file_response
+
+        print("Memorycontext: Calling LLM (async) for final response generation...")
+        response_content = await self.async_client.chat_completion(
+            model=self.llm_model, 
+            messages=messages, 
+            temperature=0.7, 
+            max_tokens=1500
+        )
+        await self.aadd_memory(user_input=query, agent_response=response_content, timestamp=get_timestamp())
+        
+        return response_content
+
+    async def aget_response_stream(self, query: str, relationship_with_user="friend", style_hint="", user_conversation_meta_data: dict = None):
+        """get_response_stream 的 asyncio 版本（async generator）"""
+        print(f"Memorycontext: Streaming response (async) for query: '{query[:50]}...'")
+        started = time.perf_counter()
+
+        file_response, messages = await self._aprepare_response(
+            query, relationship_with_user=relationship_with_user, user_conversation_meta_data=user_conversation_meta_data
+        )
+        if file_response is not None:
+            yield file_response
+            return
+
+        print("Memorycontext: Calling LLM (async) for streaming response generation...")
+        full_response_content = ""
+        try:
+            stream = await self.async_client.chat_completion(
+                model=self.llm_model, 
+                messages=messages, 
+                temperature=0.7, 
+                max_tokens=1500,
+                stream=True 
+            )
+            async for chunk in stream:
+                content = self._stream_chunk_content(chunk)
+                if content:
+                    if not full_response_content:
+                        self._record_first_token(started)
+                    full_response_content += content
+                    yield content
+            
+            if full_response_content:
+                try:
+                    self.add_short_term_memory_sync(
+                        user_input=query, 
+                        agent_response=full_response_content, 
+                        timestamp=get_timestamp()
+                    )
+                except Exception as e:
+                    print(f"Error in sync add_short_term_memory: {e}")
+
+                # 长期记忆分析在后台维护队列中执行，不阻塞事件循环
+                self._schedule_long_term_analysis()
+                
+        except Exception as e:
+            print(f"Streaming error: {e}")
+            if full_response_content:
+                # Same as the success path: keep the partial reply, analysis runs in the background queue
+                try:
+                    self.add_short_term_memory_sync(user_input=query, agent_response=full_response_content, timestamp=get_timestamp())
+                except Exception as save_error:
+                    print(f"Error in sync add_short_term_memory: {save_error}")
+                self._schedule_long_term_analysis()
+            yield f"\n[System Error: {str(e)}]"
+
 
     # --- Multimodal ingestion ---
     def add_multimodal_memory(
@@ -1728,18 +1740,11 @@ class Memcontext:
                         print(f"Memorycontext: Found file_storage_id {file_storage_id} for source_file_id {source_file_id} in short_term memory")
                         return file_storage_id
         
-        # 2. 从中期记忆中查找
-        if hasattr(self.mid_term_memory, 'sessions'):
-            for session in self.mid_term_memory.sessions.values():
-                pages = session.get('details', [])
-                for page in pages:
-                    meta_data = page.get('meta_data', {})
-                    if isinstance(meta_data, dict):
-                        if meta_data.get('source_file_id') == source_file_id:
-                            file_storage_id = meta_data.get('file_storage_id')
-                            if file_storage_id:
-                                print(f"Memorycontext: Found file_storage_id {file_storage_id} for source_file_id {source_file_id} in mid_term memory")
-                                return file_storage_id
+        # 2. 从中期记忆的文件索引中查找
+        file_storage_id = self.mid_term_memory.find_file_storage_id(source_file_id)
+        if file_storage_id:
+            print(f"Memorycontext: Found file_storage_id {file_storage_id} for source_file_id {source_file_id} in mid_term memory")
+            return file_storage_id
         
         print(f"Memorycontext: Could not find file_storage_id for source_file_id {source_file_id} in memories")
         return None
@@ -1751,6 +1756,15 @@ class Memcontext:
     def get_assistant_knowledge_summary(self) -> list:
         return self.assistant_long_term_memory.get_assistant_knowledge()
 
+    def export_memory_json(self, export_dir: str):
+        """以原有 JSON 布局导出各层记忆（WAL 存储模式下用于备份或迁移）"""
+        export_dir = os.path.abspath(export_dir)
+        self.short_term_memory.export_json(os.path.join(export_dir, "users", self.user_id, "short_term.json"))
+        self.mid_term_memory.export_json(os.path.join(export_dir, "users", self.user_id, "mid_term.json"))
+        self.user_long_term_memory.export_json(os.path.join(export_dir, "users", self.user_id, "long_term_user.json"))
+        self.assistant_long_term_memory.export_json(os.path.join(export_dir, "assistants", self.assistant_id, "long_term_assistant.json"))
+        print(f"Memorycontext: Exported memory JSON to {export_dir}")
+
     def force_mid_term_analysis(self):
         """Forces analysis of all unanalyzed pages in the hottest mid-term segment if heat is above 0.
            Useful for testing or manual triggering.
@@ -1,14 +1,28 @@
+import functools
 import json
+import os
+import threading
+import time
 import numpy as np
 from collections import defaultdict
-import faiss
-import heapq
 from datetime import datetime
 
 from .utils import (
-    get_timestamp, generate_id, get_embedding, normalize_vector,
+    get_timestamp, parse_timestamp, generate_id, get_embedding, get_embeddings, normalize_vector, has_embedding,
     compute_time_decay, ensure_directory_exists, OpenAIClient
 )
+from .vector_index import SessionSummaryIndex
+from .storage import create_storage_backend, write_json_atomic
+from .embedding_store import EmbeddingStore
+from .heat_queue import IndexedMaxHeap, SessionHeatTable
+from .lfu import LFUTracker
+from .lexical_index import BM25Index, is_exact_term_query
+from .file_page_index import FilePageIndex
+
+# Embedding fields kept in the binary sidecar; JSON records carry <field>_row instead
+EMBEDDING_FIELDS = ("summary_embedding", "page_embedding")
+# Per-page fields that live in the session header (page_ids / page_embedding_rows), not in the details file
+PAGE_HEADER_FIELDS = ("page_embedding", "page_embedding_row")
 
 # Heat computation constants (can be tuned or made configurable)
 HEAT_ALPHA = 1.0
@@ -16,114 +30,454 @@ HEAT_BETA = 1.0
 HEAT_GAMMA = 1
 RECENCY_TAU_HOURS = 24 # For R_recency calculation in compute_segment_heat
 
-def compute_segment_heat(session, alpha=HEAT_ALPHA, beta=HEAT_BETA, gamma=HEAT_GAMMA, tau_hours=RECENCY_TAU_HOURS):
+# search_sessions modes: dense (FAISS only), lexical (BM25 only, no embedding call) or hybrid (both fused)
+SEARCH_MODES = ("hybrid", "dense", "lexical")
+
+# Display string field -> numeric epoch seconds stored next to it
+EPOCH_FIELDS = {"last_visit_time": "last_visit_epoch", "timestamp": "timestamp_epoch"}
+
+def set_last_visit(session, now=None):
+    """同时更新显示用的 last_visit_time 和用于计算的 last_visit_epoch"""
+    now = time.time() if now is None else now
+    session["last_visit_epoch"] = now
+    session["last_visit_time"] = get_timestamp(now)
+
+def compute_segment_heat(session, alpha=HEAT_ALPHA, beta=HEAT_BETA, gamma=HEAT_GAMMA, tau_hours=RECENCY_TAU_HOURS, now=None):
     N_visit = session.get("N_visit", 0)
     L_interaction = session.get("L_interaction", 0)
     
-    # Calculate recency based on last_visit_time
+    # Calculate recency based on last_visit_epoch, no string parsing needed
     R_recency = 1.0 # Default if no last_visit_time
-    if session.get("last_visit_time"):
-        R_recency = compute_time_decay(session["last_visit_time"], get_timestamp(), tau_hours)
+    if session.get("last_visit_epoch") is not None:
+        R_recency = compute_time_decay(session["last_visit_epoch"], time.time() if now is None else now, tau_hours)
+    elif session.get("last_visit_time"):
+        R_recency = compute_time_decay(session["last_visit_time"], get_timestamp(now), tau_hours) # Not migrated yet
     
     session["R_recency"] = R_recency # Update session's recency factor
     return alpha * N_visit + beta * L_interaction + gamma * R_recency
 
+def _synchronized(method):
+    """在实例的 RLock 内执行：检索、保存与 details 加载可能来自不同线程（如并发的回复阶段与后台维护）"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class MidTermMemory:
-    def __init__(self, file_path: str, client: OpenAIClient, max_capacity=2000, embedding_model_name: str = "all-MiniLM-L6-v2", embedding_model_kwargs: dict = None):
+    def __init__(self, file_path: str, client: OpenAIClient, max_capacity=2000, embedding_model_name: str = "all-MiniLM-L6-v2", embedding_model_kwargs: dict = None,
+                 summary_index_type: str = "flat", storage_backend="json", storage_options=None, lexical_weight=0.3):
         self.file_path = file_path
         ensure_directory_exists(self.file_path)
+        self.storage = create_storage_backend(self.file_path, storage_backend, **(storage_options or {}))
+        # Guards sessions / details / dirty sets against concurrent search, save and lazy detail loading
+        self._lock = threading.RLock()
+        # Sessions changed/removed since the last save, written as WAL records by the WAL backend
+        self._dirty_sessions = set()
+        self._deleted_sessions = set()
+        # Bumped on every content change (not on access stats), retrieval caches compare it to detect stale results
+        self.version = 0
         self.client = client
         self.max_capacity = max_capacity
         self.sessions = {} # {session_id: session_object}
-        self.access_frequency = defaultdict(int) # {session_id: access_count_for_lfu}
-        self.heap = []  # Min-heap storing (-H_segment, session_id) for hottest segments
+        self.access_frequency = defaultdict(int) # {session_id: access_count_for_lfu}, persisted
+        self.lfu = LFUTracker() # Eviction order derived from access_frequency, ties broken by H_segment then recency
+        self.heap = IndexedMaxHeap()  # session_id -> H_segment, O(1) peek at the hottest segment
+        self.heat_table = SessionHeatTable() # Heat inputs as numpy columns for refresh_all_heat
+
+        # Long-lived summary index, persisted next to mid_term.json (e.g. mid_term_summary_index.faiss)
+        self.summary_index = SessionSummaryIndex(index_type=summary_index_type)
+        self.summary_index_path = f"{os.path.splitext(self.file_path)[0]}_summary_index"
+        # Binary embedding sidecar (e.g. mid_term_embeddings.0.f32), JSON only stores row ids
+        self.embedding_store = EmbeddingStore(f"{os.path.splitext(self.file_path)[0]}_embeddings")
+        # {session_id: float32 (n_pages, dim) matrix}, rows aligned with session["page_embedding_rows"]
+        self.page_matrices = {}
+        # {page_id: [(session_id, position), ...]}; the same page may be inserted into several theme sessions
+        self.page_index = {}
+        # Page details are stored per session (e.g. mid_term_details/<sid>.json) and read on first use;
+        # the session header keeps page_ids / page_embedding_rows so search can score pages without them
+        self.details_dir = f"{os.path.splitext(self.file_path)[0]}_details"
+        self._dirty_details = set()
+        # {keyword: {session_id, ...}} over summary_keywords, for merge candidate scoring
+        self.keyword_index = {}
+        self._keyword_counts = {} # {session_id: number of distinct summary keywords}
+        # BM25 over summaries/summary_keywords (doc id = session_id) and page text/page_keywords
+        # (doc id = (session_id, page_id)), persisted as e.g. mid_term_lexical.json
+        self.lexical_index = BM25Index()
+        self.lexical_index_path = f"{os.path.splitext(self.file_path)[0]}_lexical.json"
+        self.lexical_weight = lexical_weight # Weight of the normalized BM25 score in hybrid search
+        # Multimodal pages by file id (sorted by segment start) and source_file_id -> file_storage_id,
+        # persisted as e.g. mid_term_file_index.json so file lookups never scan every session's details
+        self.file_index = FilePageIndex()
+        self.file_index_path = f"{os.path.splitext(self.file_path)[0]}_file_index.json"
 
         self.embedding_model_name = embedding_model_name
         self.embedding_model_kwargs = embedding_model_kwargs if embedding_model_kwargs is not None else {}
         self.load()
 
-    def get_page_by_id(self, page_id):
-        for session in self.sessions.values():
-            for page in session.get("details", []):
-                if page.get("page_id") == page_id:
-                    return page
+    def _index_keywords(self, session_id):
+        keywords = set(self.sessions[session_id].get("summary_keywords", []))
+        self._keyword_counts[session_id] = len(keywords)
+        for keyword in keywords:
+            self.keyword_index.setdefault(keyword, set()).add(session_id)
+
+    def _unindex_keywords(self, session_id, keywords):
+        self._keyword_counts.pop(session_id, None)
+        for keyword in set(keywords):
+            sids = self.keyword_index.get(keyword)
+            if sids is not None:
+                sids.discard(session_id)
+                if not sids:
+                    del self.keyword_index[keyword]
+
+    def rebuild_keyword_index(self):
+        self.keyword_index = {}
+        self._keyword_counts = {}
+        for sid in self.sessions:
+            self._index_keywords(sid)
+
+    def keyword_jaccard(self, keywords):
+        """返回 {session_id: Jaccard(summary_keywords, keywords)}，只包含至少有一个共同关键词的 session"""
+        new_keywords_set = set(keywords)
+        shared = defaultdict(int)
+        for keyword in new_keywords_set:
+            for sid in self.keyword_index.get(keyword, ()):
+                shared[sid] += 1
+        # |A ∪ B| = |A| + |B| - |A ∩ B|
+        return {sid: intersection / (self._keyword_counts[sid] + len(new_keywords_set) - intersection)
+                for sid, intersection in shared.items()}
+
+    @staticmethod
+    def _session_text(session):
+        return " ".join([session.get("summary") or ""] + list(session.get("summary_keywords") or []))
+
+    @staticmethod
+    def _page_text(page):
+        return " ".join([page.get("user_input") or "", page.get("agent_response") or ""] + list(page.get("page_keywords") or []))
+
+    def _index_lexical(self, session_id):
+        """把 session 的摘要和全部 page 加入词法索引（需要 details）"""
+        self.lexical_index.add(session_id, self._session_text(self.sessions[session_id]))
+        self._index_lexical_pages(session_id, self.get_session_details(session_id))
+
+    def _index_lexical_pages(self, session_id, pages):
+        for page in pages:
+            self.lexical_index.add((session_id, page.get("page_id")), self._page_text(page))
+
+    def _unindex_lexical(self, session_id, page_ids):
+        self.lexical_index.remove(session_id)
+        for page_id in page_ids:
+            self.lexical_index.remove((session_id, page_id))
+
+    def _lexical_meta(self):
+        # Page count per session, checked on load to detect an index written before a crash
+        return {sid: len(session.get("page_ids", [])) for sid, session in self.sessions.items()}
+
+    def _index_files(self, session_id, pages):
+        for page in pages:
+            self.file_index.add(session_id, page)
+        self.file_index.dirty = True # The page counts saved as its meta changed even without file pages
+
+    @_synchronized
+    def file_ids(self):
+        """关联了 page 的文件 ID 列表"""
+        return self.file_index.file_ids()
+
+    @_synchronized
+    def file_pages(self, file_id=None):
+        """
+        返回关联了文件（file_storage_id / source_file_id）的 page，按片段开始时间排序；
+        file_id 为 None 时返回所有文件的 page。只读取命中 session 的 details。
+        """
+        pages = []
+        for sid, page_id in self.file_index.pages(file_id):
+            page = self._get_session_page(sid, page_id)
+            if page is not None:
+                pages.append(page)
+        return pages
+
+    def find_file_storage_id(self, source_file_id):
+        """返回 source_file_id 对应的 file_storage_id，未记录时返回 None"""
+        return self.file_index.source_to_storage.get(source_file_id)
+
+    def lexical_search(self, query_text, top_k_sessions=None):
+        """
+        只查 BM25 词法索引（不计算 embedding）。分数按本次查询的最高分归一化到 [0, 1]。
+        返回 {session_id: {"score": session 分数, "pages": {page_id: page 分数}}}，
+        session 分数取摘要命中与最佳 page 命中中的较大者。
+        """
+        hits = self.lexical_index.search(query_text)
+        summary_max = max((score for doc_id, score in hits if not isinstance(doc_id, tuple)), default=0.0)
+        page_max = max((score for doc_id, score in hits if isinstance(doc_id, tuple)), default=0.0)
+        matches = {}
+        for doc_id, score in hits:
+            if isinstance(doc_id, tuple):
+                sid, page_id = doc_id
+                score /= page_max
+            else:
+                sid, page_id = doc_id, None
+                score /= summary_max
+            if sid not in self.sessions:
+                continue
+            match = matches.setdefault(sid, {"score": 0.0, "pages": {}})
+            match["score"] = max(match["score"], score)
+            if page_id is not None:
+                match["pages"][page_id] = score
+        if top_k_sessions and len(matches) > top_k_sessions:
+            ranked = sorted(matches.items(), key=lambda item: item[1]["score"], reverse=True)[:top_k_sessions]
+            matches = dict(ranked)
+        return matches
+
+    def _details_path(self, session_id):
+        return os.path.join(self.details_dir, f"{session_id}.json")
+
+    def details_loaded(self, session_id):
+        return "details" in self.sessions.get(session_id, {})
+
+    @_synchronized
+    def get_session_details(self, session_id):
+        """返回 session 的 page 列表；首次访问时才从磁盘读取"""
+        session = self.sessions.get(session_id)
+        if session is None:
+            return []
+        if "details" not in session:
+            session["details"] = self._read_details(session_id, session)
+        return session["details"]
+
+    def iter_pages(self):
+        """遍历所有 (session_id, page)；会加载全部 session 的 details"""
+        for sid in list(self.sessions.keys()):
+            for page in self.get_session_details(sid):
+                yield sid, page
+
+    def _read_details(self, session_id, session):
+        try:
+            with open(self._details_path(session_id), "r", encoding="utf-8") as f:
+                stored = {page.get("page_id"): page for page in json.load(f)}
+        except FileNotFoundError:
+            stored = {}
+        except json.JSONDecodeError:
+            print(f"MidTermMemory: Error decoding details of session {session_id}, its pages are dropped.")
+            stored = {}
+        page_ids = session.get("page_ids", [])
+        details, kept_ids, kept_rows = [], [], []
+        for page_id, row in zip(page_ids, session.get("page_embedding_rows", [])):
+            page = stored.get(page_id)
+            if page is None:
+                continue # Header was saved but the details write was lost
+            page["page_embedding"] = self.embedding_store.get(row)
+            details.append(page)
+            kept_ids.append(page_id)
+            kept_rows.append(row)
+        if len(kept_ids) != len(page_ids):
+            print(f"MidTermMemory: Session {session_id} is missing {len(page_ids) - len(kept_ids)} page(s) on disk, dropping them.")
+            self._unindex_session(session_id, page_ids)
+            for page_id in set(page_ids) - set(kept_ids):
+                self.lexical_index.remove((session_id, page_id))
+                self.file_index.remove(session_id, page_id)
+            self.file_index.dirty = True
+            session["page_ids"], session["page_embedding_rows"] = kept_ids, kept_rows
+            self.page_matrices.pop(session_id, None)
+            self._index_pages(session_id)
+            self._dirty_sessions.add(session_id)
+            self.version += 1
+        return details
+
+    def _index_pages(self, session_id, start=0):
+        page_ids = self.sessions[session_id].get("page_ids", [])
+        for position in range(start, len(page_ids)):
+            page_id = page_ids[position]
+            if page_id:
+                self.page_index.setdefault(page_id, []).append((session_id, position))
+
+    def _unindex_session(self, session_id, page_ids):
+        for page_id in page_ids:
+            locations = self.page_index.get(page_id)
+            if not locations:
+                continue
+            locations[:] = [loc for loc in locations if loc[0] != session_id]
+            if not locations:
+                del self.page_index[page_id]
+
+    def rebuild_page_index(self):
+        self.page_index = {}
+        for sid in self.sessions:
+            self._index_pages(sid)
+
+    def get_page_location(self, page_id):
+        """返回 (session_id, position)，找不到时返回 None"""
+        for attempt in range(2):
+            for sid, position in self.page_index.get(page_id, []):
+                page_ids = self.sessions.get(sid, {}).get("page_ids", [])
+                if position < len(page_ids) and page_ids[position] == page_id:
+                    return sid, position
+            if attempt == 0 and page_id in self.page_index:
+                # page_ids were changed outside MidTermMemory, resync once
+                self.rebuild_page_index()
         return None
 
+    def _get_session_page(self, session_id, page_id):
+        """返回 session_id 中的 page_id（同一 page 可能存在于多个 session）"""
+        page_ids = self.sessions.get(session_id, {}).get("page_ids", [])
+        for sid, position in self.page_index.get(page_id, []):
+            if sid == session_id and position < len(page_ids) and page_ids[position] == page_id:
+                details = self.get_session_details(session_id)
+                return details[position] if position < len(details) else None
+        return None
+
+    def get_page_by_id(self, page_id):
+        location = self.get_page_location(page_id)
+        if location is None:
+            return None
+        sid, position = location
+        details = self.get_session_details(sid)
+        return details[position] if position < len(details) else None
+
+    def _get_page_matrix(self, session_id):
+        """返回 session 的 page embedding 矩阵（直接按行号从 sidecar 读取，不需要加载 details）"""
+        rows = self.sessions[session_id].get("page_embedding_rows", [])
+        matrix = self.page_matrices.get(session_id)
+        if matrix is None or matrix.shape[0] != len(rows):
+            matrix = self.embedding_store.take(rows)
+            self.page_matrices[session_id] = matrix
+        return matrix
+
+    def _append_page_vectors(self, session_id, new_pages):
+        matrix = self.page_matrices.get(session_id)
+        if matrix is None or not new_pages:
+            return # Built lazily on next search
+        new_rows = np.array([page["page_embedding"] for page in new_pages], dtype=np.float32)
+        self.page_matrices[session_id] = np.concatenate([matrix, new_rows]) if matrix.size else new_rows
+
+    @_synchronized
+    def mark_session_dirty(self, session_id):
+        """在 MidTermMemory 之外直接修改 session 后调用，确保下次 save() 写入该 session"""
+        self._dirty_sessions.add(session_id)
+        self._dirty_details.add(session_id)
+        self.version += 1
+
+    @_synchronized
+    def mark_page_dirty(self, page_id):
+        location = self.get_page_location(page_id)
+        if location:
+            self._dirty_details.add(location[0])
+            self.version += 1
+
     def update_page_connections(self, prev_page_id, next_page_id):
         if prev_page_id:
             prev_page = self.get_page_by_id(prev_page_id)
             if prev_page:
                 prev_page["next_page"] = next_page_id
+                self.mark_page_dirty(prev_page_id)
         if next_page_id:
             next_page = self.get_page_by_id(next_page_id)
             if next_page:
                 next_page["pre_page"] = prev_page_id
+                self.mark_page_dirty(next_page_id)
         # self.save() # Avoid saving on every minor update; save at higher level operations
 
-    def evict_lfu(self):
-        if not self.access_frequency or not self.sessions:
-            return
-        
-        lfu_sid = min(self.access_frequency, key=self.access_frequency.get)
-        print(f"MidTermMemory: LFU eviction. Session {lfu_sid} has lowest access frequency.")
-        
+    @_synchronized
+    def evict_lfu(self, count=1):
+        """淘汰 count 个访问次数最少的 session（同频时热度低、较早的优先），所有变更一次写盘"""
+        evicted = self._evict_sessions(count)
+        if evicted:
+            self.save()
+        return evicted
+
+    def _evict_sessions(self, count):
+        victims = self.lfu.pop_victims(count)
+        for lfu_sid in victims:
+            print(f"MidTermMemory: LFU eviction. Session {lfu_sid} has lowest access frequency ({self.access_frequency.get(lfu_sid, 0)}).")
+            self._remove_session(lfu_sid)
+        return victims
+
+    def _remove_session(self, lfu_sid):
+        self.version += 1
+        self._deleted_sessions.add(lfu_sid)
+        self._dirty_sessions.discard(lfu_sid)
+        self._dirty_details.discard(lfu_sid)
+        self.heap.remove(lfu_sid)
+        self.lfu.remove(lfu_sid)
+        self.heat_table.remove(lfu_sid)
+        self.access_frequency.pop(lfu_sid, None) # Remove from LFU tracking
         if lfu_sid not in self.sessions:
-            del self.access_frequency[lfu_sid] # Clean up access frequency if session already gone
-            self.rebuild_heap()
             return
         
+        deleted_details = self.get_session_details(lfu_sid) # Needed below to unlink neighbouring pages
         session_to_delete = self.sessions.pop(lfu_sid) # Remove from sessions
-        del self.access_frequency[lfu_sid] # Remove from LFU tracking
-
-        # Clean up page connections if this session's pages were linked
-        for page in session_to_delete.get("details", []):
-            prev_page_id = page.get("pre_page")
-            next_page_id = page.get("next_page")
-            # If a page from this session was linked to an external page, nullify the external link
-            if prev_page_id and not self.get_page_by_id(prev_page_id): # Check if prev page is still in memory
-                 # This case should ideally not happen if connections are within sessions or handled carefully
-                 pass 
-            if next_page_id and not self.get_page_by_id(next_page_id):
-                 pass
-            # More robustly, one might need to search all other sessions if inter-session linking was allowed
-            # For now, assuming internal consistency or that Memcontext class manages higher-level links
-
-        self.rebuild_heap()
-        self.save()
+        self.summary_index.remove(lfu_sid)
+        self.page_matrices.pop(lfu_sid, None)
+        self._unindex_keywords(lfu_sid, session_to_delete.get("summary_keywords", []))
+        self._unindex_lexical(lfu_sid, session_to_delete.get("page_ids", []))
+        self.file_index.remove_session(lfu_sid, session_to_delete.get("page_ids", []))
+
+        self._unindex_session(lfu_sid, session_to_delete.get("page_ids", []))
+
+        # Clean up page connections if this session's pages were linked to pages that are still in memory
+        for page in deleted_details:
+            if page.get("page_id") in self.page_index:
+                continue # Another session still holds a copy of this page, keep its links
+            prev_page = self.get_page_by_id(page.get("pre_page")) if page.get("pre_page") else None
+            if prev_page and prev_page.get("next_page") == page.get("page_id"):
+                prev_page["next_page"] = None
+                self.mark_page_dirty(page["pre_page"])
+            next_page = self.get_page_by_id(page.get("next_page")) if page.get("next_page") else None
+            if next_page and next_page.get("pre_page") == page.get("page_id"):
+                next_page["pre_page"] = None
+                self.mark_page_dirty(page["next_page"])
         print(f"MidTermMemory: Evicted session {lfu_sid}.")
 
+    def _embed_pages(self, pages):
+        """返回每个 page 的归一化 embedding；已有的直接复用，缺失的通过 get_embeddings 一次批量计算"""
+        vectors = [None] * len(pages)
+        missing = []
+        for i, page_data in enumerate(pages):
+            # 检查是否已有embedding，避免重复计算
+            if has_embedding(page_data.get("page_embedding")):
+                print(f"MidTermMemory: Reusing existing embedding for page {page_data.get('page_id')}")
+                inp_vec = np.asarray(page_data["page_embedding"], dtype=np.float32)
+                # 确保embedding是normalized的
+                if np.linalg.norm(inp_vec) > 1.1 or np.linalg.norm(inp_vec) < 0.9:  # 检查是否需要重新normalize
+                    inp_vec = normalize_vector(inp_vec)
+                vectors[i] = inp_vec
+            else:
+                missing.append(i)
+        if missing:
+            print(f"MidTermMemory: Computing {len(missing)} new page embedding(s) in one batch")
+            texts = [f"User: {pages[i].get('user_input','')} Assistant: {pages[i].get('agent_response','')}" for i in missing]
+            computed = get_embeddings(
+                texts,
+                model_name=self.embedding_model_name,
+                **self.embedding_model_kwargs
+            )
+            for i, inp_vec in zip(missing, computed):
+                vectors[i] = normalize_vector(inp_vec)
+        return vectors
+
+    def _embed_text(self, summary):
+        return normalize_vector(get_embedding(
+            summary,
+            model_name=self.embedding_model_name,
+            **self.embedding_model_kwargs
+        ))
+
     def add_session(self, summary, details, summary_keywords=None):
+        # Embeddings are computed before taking the lock, searches are not blocked on the embedding call
+        summary_vec = self._embed_text(summary)
+        page_vectors = self._embed_pages(details)
+        with self._lock:
+            return self._add_session_locked(summary, details, summary_keywords, summary_vec, page_vectors)
+
+    def _add_session_locked(self, summary, details, summary_keywords, summary_vec, page_vectors):
         session_id = generate_id("session")
-        summary_vec = get_embedding(
-            summary, 
-            model_name=self.embedding_model_name, 
-            **self.embedding_model_kwargs
-        )
-        summary_vec = normalize_vector(summary_vec).tolist()
         summary_keywords = summary_keywords if summary_keywords is not None else []
         
         processed_details = []
-        for page_data in details:
+        page_rows = self.embedding_store.append(np.vstack(page_vectors)) if page_vectors else []
+        for idx, page_data in enumerate(details):
             page_id = page_data.get("page_id", generate_id("page"))
             
-            # 检查是否已有embedding，避免重复计算
-            if "page_embedding" in page_data and page_data["page_embedding"]:
-                print(f"MidTermMemory: Reusing existing embedding for page {page_id}")
-                inp_vec = page_data["page_embedding"]
-                # 确保embedding是normalized的
-                if isinstance(inp_vec, list):
-                    inp_vec_np = np.array(inp_vec, dtype=np.float32)
-                    if np.linalg.norm(inp_vec_np) > 1.1 or np.linalg.norm(inp_vec_np) < 0.9:  # 检查是否需要重新normalize
-                        inp_vec = normalize_vector(inp_vec_np).tolist()
-            else:
-                print(f"MidTermMemory: Computing new embedding for page {page_id}")
-                full_text = f"User: {page_data.get('user_input','')} Assistant: {page_data.get('agent_response','')}"
-                inp_vec = get_embedding(
-                    full_text,
-                    model_name=self.embedding_model_name,
-                    **self.embedding_model_kwargs
-                )
-                inp_vec = normalize_vector(inp_vec).tolist()
+            inp_vec = page_vectors[idx]
             
             # 使用已有keywords或设置为空（由multi-summary提供）
             if "page_keywords" in page_data and page_data["page_keywords"]:
@@ -144,103 +498,150 @@ class MidTermMemory:
             }
             processed_details.append(processed_page)
         
-        current_ts = get_timestamp()
+        now = time.time()
+        current_ts = get_timestamp(now)
         session_obj = {
             "id": session_id,
             "summary": summary,
             "summary_keywords": summary_keywords,
             "summary_embedding": summary_vec,
+            "summary_embedding_row": self.embedding_store.append(summary_vec)[0],
             "details": processed_details,
+            "page_ids": [page["page_id"] for page in processed_details],
+            "page_embedding_rows": list(page_rows),
             "L_interaction": len(processed_details),
             "R_recency": 1.0, # Initial recency
             "N_visit": 0,
             "H_segment": 0.0, # Initial heat, will be computed
             "timestamp": current_ts, # Creation timestamp
+            "timestamp_epoch": now,
             "last_visit_time": current_ts, # Also initial last_visit_time for recency calc
+            "last_visit_epoch": now,
             "access_count_lfu": 0 # For LFU eviction policy
         }
-        session_obj["H_segment"] = compute_segment_heat(session_obj)
+        session_obj["H_segment"] = compute_segment_heat(session_obj, now=now)
+        if len(self.sessions) >= self.max_capacity:
+            # Make room before inserting, a fresh session would otherwise lose the heat tie-break among unvisited ones
+            self._evict_sessions(len(self.sessions) - self.max_capacity + 1) # Flushed by the save below
         self.sessions[session_id] = session_obj
+        self.version += 1
         self.access_frequency[session_id] = 0 # Initialize for LFU
-        heapq.heappush(self.heap, (-session_obj["H_segment"], session_id)) # Use negative heat for max-heap behavior
+        self._dirty_sessions.add(session_id)
+        self._dirty_details.add(session_id)
+        self.summary_index.add(session_id, summary_vec)
+        self.page_matrices[session_id] = np.array([p["page_embedding"] for p in processed_details], dtype=np.float32)
+        self._index_pages(session_id)
+        self._index_keywords(session_id)
+        self._index_lexical(session_id)
+        self._index_files(session_id, processed_details)
+        self.lfu.set(session_id, 0, session_obj["H_segment"])
+        self.refresh_heat(session_id)
         
         print(f"MidTermMemory: Added new session {session_id}. Initial heat: {session_obj['H_segment']:.2f}.")
-        if len(self.sessions) > self.max_capacity:
-            self.evict_lfu()
         self.save()
         return session_id
 
     def rebuild_heap(self):
-        self.heap = []
+        # Full O(n) rebuild, only needed after load; single sessions go through refresh_heat
+        self.heap.rebuild((sid, session_data["H_segment"]) for sid, session_data in self.sessions.items())
+        self.heat_table.clear()
         for sid, session_data in self.sessions.items():
-            # Ensure H_segment is up-to-date before rebuilding heap if necessary
-            # session_data["H_segment"] = compute_segment_heat(session_data)
-            heapq.heappush(self.heap, (-session_data["H_segment"], sid))
-        # heapq.heapify(self.heap) # Not needed if pushing one by one
+            self.heat_table.upsert(sid, session_data.get("N_visit", 0), session_data.get("L_interaction", 0),
+                                   session_data.get("last_visit_epoch"))
+
+    def rebuild_lfu(self):
+        # Older visits enter their bucket first, so they are evicted first among equal frequency and heat
+        ordered = sorted(self.sessions.items(), key=lambda item: item[1].get("last_visit_epoch") or 0.0)
+        self.lfu.rebuild((sid, self.access_frequency.get(sid, 0), session.get("H_segment", 0.0)) for sid, session in ordered)
         # No save here, it's an internal operation often followed by other ops that save
 
+    def refresh_heat(self, session_id):
+        """session 的 H_segment 被修改后调用，O(log n) 更新其在堆中的位置"""
+        session = self.sessions.get(session_id)
+        if session is None:
+            self.heap.remove(session_id)
+            self.lfu.remove(session_id)
+            self.heat_table.remove(session_id)
+        else:
+            self.heap.update(session_id, session["H_segment"])
+            self.lfu.update_heat(session_id, session["H_segment"])
+            self.heat_table.upsert(session_id, session.get("N_visit", 0), session.get("L_interaction", 0),
+                                   session.get("last_visit_epoch"))
+
+    def peek_hottest(self):
+        """返回 (session_id, H_segment)，没有 session 时返回 None"""
+        return self.heap.peek()
+
+    @_synchronized
+    def compute_all_heat(self, now=None):
+        """按当前时间向量化计算所有 session 的热度，不修改 session；返回 (session_ids, heat, recency)"""
+        now = time.time() if now is None else now
+        heat, recency = self.heat_table.compute(now, HEAT_ALPHA, HEAT_BETA, HEAT_GAMMA, RECENCY_TAU_HOURS)
+        return list(self.heat_table.session_ids), heat, recency
+
+    @_synchronized
+    def refresh_all_heat(self, now=None):
+        """
+        维护任务选择最热 session 前调用：把随时间衰减后的 R_recency / H_segment 写回所有 session 并重建堆，
+        返回最热的 (session_id, H_segment)。变化的 session 头部标记为 dirty，下次 save() 写盘；
+        热度不是检索内容，不增加 version。
+        """
+        session_ids, heat, recency = self.compute_all_heat(now)
+        heat_values = heat.tolist()
+        for sid, h, r in zip(session_ids, heat_values, recency.tolist()):
+            session = self.sessions[sid]
+            if session.get("H_segment") != h or session.get("R_recency") != r:
+                session["H_segment"] = h
+                session["R_recency"] = r
+                self._dirty_sessions.add(sid)
+            self.lfu.update_heat(sid, h)
+        self.heap.rebuild(zip(session_ids, heat_values))
+        return self.peek_hottest()
+
     def insert_pages_into_session(self, summary_for_new_pages, keywords_for_new_pages, pages_to_insert, 
                                   similarity_threshold=0.6, keyword_similarity_alpha=1.0):
+        # Both the merge and the new-session path need these, compute them before taking the lock
+        new_summary_vec = self._embed_text(summary_for_new_pages)
+        page_vectors = self._embed_pages(pages_to_insert)
+        with self._lock:
+            return self._insert_pages_locked(summary_for_new_pages, keywords_for_new_pages, pages_to_insert, similarity_threshold,
+                                             keyword_similarity_alpha, new_summary_vec, page_vectors)
+
+    def _insert_pages_locked(self, summary_for_new_pages, keywords_for_new_pages, pages_to_insert, similarity_threshold,
+                             keyword_similarity_alpha, new_summary_vec, page_vectors):
         if not self.sessions: # If no existing sessions, just add as a new one
             print("MidTermMemory: No existing sessions. Adding new session directly.")
-            return self.add_session(summary_for_new_pages, pages_to_insert, keywords_for_new_pages)
+            return self._add_session_locked(summary_for_new_pages, pages_to_insert, keywords_for_new_pages, new_summary_vec, page_vectors)
 
-        new_summary_vec = get_embedding(
-            summary_for_new_pages,
-            model_name=self.embedding_model_name,
-            **self.embedding_model_kwargs
-        )
-        new_summary_vec = normalize_vector(new_summary_vec)
-        
         best_sid = None
         best_overall_score = -1
 
-        for sid, existing_session in self.sessions.items():
-            existing_summary_vec = np.array(existing_session["summary_embedding"], dtype=np.float32)
-            semantic_sim = float(np.dot(existing_summary_vec, new_summary_vec))
-            
-            # Keyword similarity (Jaccard index based)
-            existing_keywords = set(existing_session.get("summary_keywords", []))
-            new_keywords_set = set(keywords_for_new_pages)
-            s_topic_keywords = 0
-            if existing_keywords and new_keywords_set:
-                intersection = len(existing_keywords.intersection(new_keywords_set))
-                union = len(existing_keywords.union(new_keywords_set))
-                if union > 0:
-                    s_topic_keywords = intersection / union 
-            
-            overall_score = semantic_sim + keyword_similarity_alpha * s_topic_keywords
-            
-            if overall_score > best_overall_score:
-                best_overall_score = overall_score
-                best_sid = sid
+        # Semantic similarity against every session summary in one matmul (rows follow the summary index)
+        overall_scores, row_sids, sid_rows = self.summary_index.score_all(new_summary_vec)
+        if len(overall_scores):
+            overall_scores = overall_scores.astype(np.float64)
+            # Keyword similarity (Jaccard index based), only for sessions sharing at least one keyword
+            for sid, s_topic_keywords in self.keyword_jaccard(keywords_for_new_pages).items():
+                row = sid_rows.get(sid)
+                if row is not None:
+                    overall_scores[row] += keyword_similarity_alpha * s_topic_keywords
+            best_row = int(np.argmax(overall_scores))
+            if overall_scores[best_row] > best_overall_score:
+                best_overall_score = float(overall_scores[best_row])
+                best_sid = row_sids[best_row]
         
         if best_sid and best_overall_score >= similarity_threshold:
             print(f"MidTermMemory: Merging pages into session {best_sid}. Score: {best_overall_score:.2f} (Threshold: {similarity_threshold})")
             target_session = self.sessions[best_sid]
+            target_details = self.get_session_details(best_sid)
+            first_new_position = len(target_session["page_ids"])
             
             processed_new_pages = []
-            for page_data in pages_to_insert:
+            page_rows = self.embedding_store.append(np.vstack(page_vectors)) if page_vectors else []
+            for idx, page_data in enumerate(pages_to_insert):
                 page_id = page_data.get("page_id", generate_id("page")) # Use existing or generate new ID
                 
-                # 检查是否已有embedding，避免重复计算
-                if "page_embedding" in page_data and page_data["page_embedding"]:
-                    print(f"MidTermMemory: Reusing existing embedding for page {page_id}")
-                    inp_vec = page_data["page_embedding"]
-                    # 确保embedding是normalized的
-                    if isinstance(inp_vec, list):
-                        inp_vec_np = np.array(inp_vec, dtype=np.float32)
-                        if np.linalg.norm(inp_vec_np) > 1.1 or np.linalg.norm(inp_vec_np) < 0.9:  # 检查是否需要重新normalize
-                            inp_vec = normalize_vector(inp_vec_np).tolist()
-                else:
-                    print(f"MidTermMemory: Computing new embedding for page {page_id}")
-                    full_text = f"User: {page_data.get('user_input','')} Assistant: {page_data.get('agent_response','')}"
-                    inp_vec = get_embedding(
-                        full_text,
-                        model_name=self.embedding_model_name,
-                        **self.embedding_model_kwargs
-                    )
-                    inp_vec = normalize_vector(inp_vec).tolist()
+                inp_vec = page_vectors[idx]
                 
                 # 使用已有keywords或继承session的keywords
                 if "page_keywords" in page_data and page_data["page_keywords"]:
@@ -257,127 +658,377 @@ class MidTermMemory:
                     "page_keywords": page_keywords_current,
                     # analyzed, preloaded flags should be part of page_data if set
                 }
-                target_session["details"].append(processed_page)
+                target_details.append(processed_page)
                 processed_new_pages.append(processed_page)
 
+            target_session["page_ids"].extend(page["page_id"] for page in processed_new_pages)
+            target_session["page_embedding_rows"].extend(page_rows)
+            self._append_page_vectors(best_sid, processed_new_pages)
+            self._index_pages(best_sid, start=first_new_position)
+            self._index_lexical_pages(best_sid, processed_new_pages)
+            self._index_files(best_sid, processed_new_pages)
             target_session["L_interaction"] += len(pages_to_insert)
-            target_session["last_visit_time"] = get_timestamp() # Update last visit time on modification
+            self.version += 1
+            set_last_visit(target_session) # Update last visit time on modification
             target_session["H_segment"] = compute_segment_heat(target_session)
-            self.rebuild_heap() # Rebuild heap as heat has changed
+            self._dirty_sessions.add(best_sid)
+            self._dirty_details.add(best_sid)
+            self.refresh_heat(best_sid)
             self.save()
             return best_sid
         else:
             print(f"MidTermMemory: No suitable session to merge (best score {best_overall_score:.2f} < threshold {similarity_threshold}). Creating new session.")
-            return self.add_session(summary_for_new_pages, pages_to_insert, keywords_for_new_pages)
+            return self._add_session_locked(summary_for_new_pages, pages_to_insert, keywords_for_new_pages, new_summary_vec, page_vectors)
 
     def search_sessions(self, query_text, segment_similarity_threshold=0.1, page_similarity_threshold=0.1, 
-                          top_k_sessions=5, keyword_alpha=1.0, recency_tau_search=3600):
-        if not self.sessions:
-            return []
-
-        query_vec = get_embedding(
-            query_text,
-            model_name=self.embedding_model_name,
-            **self.embedding_model_kwargs
-        )
-        query_vec = normalize_vector(query_vec)
-        query_keywords = set()  # Keywords extraction removed, relying on semantic similarity
-
-        candidate_sessions = []
-        session_ids = list(self.sessions.keys())
-        if not session_ids: return []
+                          top_k_sessions=5, recency_tau_search=3600, top_k_pages=None,
+                          lexical_weight=None, mode="hybrid", query_vec=None):
+        """
+        mode="hybrid" 时 session / page 分数 = 向量相似度 + lexical_weight * 归一化 BM25 分数，
+        只被词法命中的 session 也会进入候选；查询像精确词（文件名、ID）且有词法命中时不计算 embedding。
+        mode="dense" 为原有纯向量检索，mode="lexical" 只用 BM25。
+        query_vec 为调用方预先计算好的 query embedding（如 Retriever 各检索任务共用同一个），为 None 时在锁外计算。
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode}")
+        lexical_weight = self.lexical_weight if lexical_weight is None else lexical_weight
 
-        summary_embeddings_list = [self.sessions[s]["summary_embedding"] for s in session_ids]
-        summary_embeddings_np = np.array(summary_embeddings_list, dtype=np.float32)
+        with self._lock:
+            if not self.sessions:
+                return []
+            lexical_matches = {}
+            if mode == "lexical" or (mode == "hybrid" and lexical_weight > 0):
+                lexical_matches = self.lexical_search(query_text, top_k_sessions)
+                if mode == "hybrid" and lexical_matches and is_exact_term_query(query_text):
+                    mode = "lexical" # Exact-term lookup, the BM25 hits are the answer
+        if mode == "lexical":
+            query_vec, lexical_weight = None, 1.0
+        else:
+            if query_vec is None:
+                query_vec = self._embed_text(query_text) # Outside the lock, writers are not blocked on the embedding call
+            query_vec = normalize_vector(query_vec)
+        with self._lock:
+            return self._search_sessions_locked(segment_similarity_threshold, page_similarity_threshold, top_k_sessions,
+                                                top_k_pages, lexical_weight, lexical_matches, query_vec)
 
-        dim = summary_embeddings_np.shape[1]
-        index = faiss.IndexFlatIP(dim) # Inner product for similarity
-        index.add(summary_embeddings_np)
-        
-        query_arr_np = np.array([query_vec], dtype=np.float32)
-        distances, indices = index.search(query_arr_np, min(top_k_sessions, len(session_ids)))
+    def _search_sessions_locked(self, segment_similarity_threshold, page_similarity_threshold, top_k_sessions,
+                                top_k_pages, lexical_weight, lexical_matches, query_vec):
+        # Long-lived index maintained by add_session / evict_lfu, no per-query rebuild
+        candidates = dict(self.summary_index.search(query_vec, top_k_sessions)) if query_vec is not None else {}
+        for session_id in lexical_matches:
+            if session_id not in candidates and session_id in self.sessions: # May have been evicted while embedding
+                # Found only lexically: score its summary directly against the query
+                summary_vec = self.sessions[session_id].get("summary_embedding")
+                candidates[session_id] = float(np.dot(summary_vec, query_vec)) if query_vec is not None and has_embedding(summary_vec) else 0.0
 
-        results = []
-        current_time_str = get_timestamp()
+        scored_sessions = []
+        for session_id, semantic_sim_score in candidates.items(): # Score is the dot product
+            session = self.sessions.get(session_id)
+            if session is None: continue
 
-        for i, idx in enumerate(indices[0]):
-            if idx == -1: continue
-            
-            session_id = session_ids[idx]
-            session = self.sessions[session_id]
-            semantic_sim_score = float(distances[0][i]) # This is the dot product
-
-            # Keyword similarity for session summary
-            session_keywords = set(session.get("summary_keywords", []))
-            s_topic_keywords = 0
-            if query_keywords and session_keywords:
-                intersection = len(query_keywords.intersection(session_keywords))
-                union = len(query_keywords.union(session_keywords))
-                if union > 0: s_topic_keywords = intersection / union
-            
             # Time decay for session recency in search scoring
             # time_decay_factor = compute_time_decay(session["timestamp"], current_time_str, tau_hours=recency_tau_search)
             
-            # Combined score for session relevance
-            session_relevance_score =  (semantic_sim_score + keyword_alpha * s_topic_keywords)
+            # Combined score for session relevance; summary_keywords are part of the BM25 session document
+            lexical_score = lexical_matches.get(session_id, {}).get("score", 0.0)
+            session_relevance_score = semantic_sim_score + lexical_weight * lexical_score
+            scored_sessions.append((session_relevance_score, session_id))
+        # Dense and lexical candidates together may exceed top_k_sessions, keep the best fused ones
+        scored_sessions.sort(key=lambda item: item[0], reverse=True)
+
+        results = []
+        now = time.time()
 
+        for session_relevance_score, session_id in scored_sessions[:top_k_sessions]:
+            session = self.sessions[session_id]
             if session_relevance_score >= segment_similarity_threshold:
-                matched_pages_in_session = []
-                for page in session.get("details", []):
-                    page_embedding = np.array(page["page_embedding"], dtype=np.float32)
-                    # page_keywords = set(page.get("page_keywords", []))
-                    
-                    page_sim_score = float(np.dot(page_embedding, query_vec))
-                    # Can also add keyword sim for pages if needed, but keeping it simpler for now
+                # Score every page of the session with one matmul, then mask by threshold
+                lexical_pages = lexical_matches.get(session_id, {}).get("pages")
+                page_scores, hit_rows = self._score_pages(session_id, query_vec, page_similarity_threshold, top_k_pages,
+                                                          lexical_pages, lexical_weight)
+                details = []
+                if len(hit_rows):
+                    # Only sessions with matching pages have their details read from disk
+                    details = self.get_session_details(session_id)
+                    if len(details) != len(page_scores): # Details on disk were incomplete, header was trimmed
+                        page_scores, hit_rows = self._score_pages(session_id, query_vec, page_similarity_threshold, top_k_pages,
+                                                                  lexical_pages, lexical_weight)
+                matched_pages_in_session = [
+                    {"page_data": details[row], "score": float(page_scores[row])} for row in hit_rows
+                ]
 
-                    if page_sim_score >= page_similarity_threshold:
-                        matched_pages_in_session.append({"page_data": page, "score": page_sim_score})
-                
                 if matched_pages_in_session:
                     # Update session access stats
                     session["N_visit"] += 1
-                    session["last_visit_time"] = current_time_str
+                    set_last_visit(session, now)
                     session["access_count_lfu"] = session.get("access_count_lfu", 0) + 1
                     self.access_frequency[session_id] = session["access_count_lfu"]
-                    session["H_segment"] = compute_segment_heat(session)
-                    self.rebuild_heap() # Heat changed
+                    session["H_segment"] = compute_segment_heat(session, now=now)
+                    self._dirty_sessions.add(session_id)
+                    self.lfu.set(session_id, session["access_count_lfu"], session["H_segment"])
+                    self.refresh_heat(session_id)
                     
                     results.append({
                         "session_id": session_id,
                         "session_summary": session["summary"],
                         "session_relevance_score": session_relevance_score,
-                        "matched_pages": sorted(matched_pages_in_session, key=lambda x: x["score"], reverse=True) # Sort pages by score
+                        "matched_pages": matched_pages_in_session # Already sorted by score
                     })
         
         self.save() # Save changes from access updates
         # Sort final results by session_relevance_score
         return sorted(results, key=lambda x: x["session_relevance_score"], reverse=True)
 
-    def save(self):
-        # Make a copy for saving to avoid modifying heap during iteration if it happens
-        # Though current heap is list of tuples, so direct modification risk is low
-        # sessions_to_save = {sid: data for sid, data in self.sessions.items()}
-        data_to_save = {
-            "sessions": self.sessions,
+    def _score_pages(self, session_id, query_vec, threshold, top_k=None, lexical_pages=None, lexical_weight=1.0):
+        """
+        返回 (page_scores, 命中的行号，按分数降序)。
+        lexical_pages 为 {page_id: 归一化 BM25 分数}，按 lexical_weight 加到向量分数上；query_vec 为 None 时只用词法分数。
+        """
+        session = self.sessions[session_id]
+        if not session.get("page_embedding_rows"):
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        if query_vec is None:
+            page_scores = np.zeros(len(session["page_embedding_rows"]), dtype=np.float32)
+        else:
+            page_scores = self._get_page_matrix(session_id) @ query_vec
+        if lexical_pages:
+            for position, page_id in enumerate(session.get("page_ids", [])):
+                if page_id in lexical_pages:
+                    page_scores[position] += lexical_weight * lexical_pages[page_id]
+        hit_rows = np.flatnonzero(page_scores >= threshold)
+        if top_k and len(hit_rows) > top_k:
+            hit_rows = np.sort(hit_rows[np.argpartition(-page_scores[hit_rows], top_k - 1)[:top_k]])
+        return page_scores, hit_rows[np.argsort(-page_scores[hit_rows], kind="stable")]
+
+    @staticmethod
+    def _serialize_page(page, inline_embeddings=False):
+        out = {k: v for k, v in page.items() if k not in PAGE_HEADER_FIELDS}
+        if inline_embeddings and has_embedding(page.get("page_embedding")):
+            out["page_embedding"] = np.asarray(page["page_embedding"], dtype=np.float32).tolist()
+        return out
+
+    def _serialize_session(self, session, inline_embeddings=False):
+        """
+        生成用于持久化的 session 头：不含 details 与 embedding，只保留行号。
+        inline_embeddings=True 时生成原有布局（details 内联、embedding 为 float 列表），用于导出。
+        """
+        serialized = {k: v for k, v in session.items() if k not in ("details", "summary_embedding")}
+        if inline_embeddings:
+            for field in ("summary_embedding_row", "page_ids", "page_embedding_rows"):
+                serialized.pop(field, None)
+            if has_embedding(session.get("summary_embedding")):
+                serialized["summary_embedding"] = np.asarray(session["summary_embedding"], dtype=np.float32).tolist()
+            serialized["details"] = [self._serialize_page(page, inline_embeddings=True)
+                                     for page in self.get_session_details(session["id"])]
+        return serialized
+
+    def _write_dirty_details(self):
+        for sid in self._dirty_details:
+            session = self.sessions.get(sid)
+            if session is not None and "details" in session:
+                write_json_atomic(self._details_path(sid), [self._serialize_page(page) for page in session["details"]])
+        self._dirty_details = set()
+
+    def _remove_details_files(self, session_ids):
+        for sid in session_ids:
+            if sid in self.sessions:
+                continue
+            try:
+                os.remove(self._details_path(sid))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"MidTermMemory: Could not remove details of session {sid}: {e}")
+
+    def _compact_embeddings_if_needed(self):
+        live_rows = []
+        for session in self.sessions.values():
+            live_rows.append(session.get("summary_embedding_row"))
+            live_rows.extend(session.get("page_embedding_rows", []))
+        if not self.embedding_store.needs_compaction(len(live_rows)):
+            return
+        row_map = self.embedding_store.compact(live_rows)
+        for session in self.sessions.values():
+            session["summary_embedding_row"] = row_map.get(session.get("summary_embedding_row"))
+            session["summary_embedding"] = self.embedding_store.get(session["summary_embedding_row"])
+            session["page_embedding_rows"] = [row_map.get(row) for row in session.get("page_embedding_rows", [])]
+            # Unloaded details need no rewrite: their rows live in the header
+            for page, row in zip(session.get("details", []), session["page_embedding_rows"]):
+                page["page_embedding"] = self.embedding_store.get(row)
+        print(f"MidTermMemory: Compacted embedding sidecar to {len(row_map)} rows.")
+
+    def _build_snapshot(self):
+        self._compact_embeddings_if_needed() # Only when a full snapshot is written
+        return {
+            "sessions": {sid: self._serialize_session(session) for sid, session in self.sessions.items()},
             "access_frequency": dict(self.access_frequency), # Convert defaultdict to dict for JSON
+            "embedding_store": self.embedding_store.state(),
             # Heap is derived, no need to save typically, but can if desired for faster load
             # "heap_snapshot": self.heap 
         }
+
+    def _collect_records(self):
+        generation = self.embedding_store.generation
+        records = [{"op": "del_session", "sid": sid, "embedding_generation": generation}
+                   for sid in self._deleted_sessions if sid not in self.sessions]
+        for sid in self._dirty_sessions:
+            if sid in self.sessions:
+                records.append({
+                    "op": "put_session",
+                    "sid": sid,
+                    "session": self._serialize_session(self.sessions[sid]),
+                    "access_frequency": self.access_frequency.get(sid, 0),
+                    "embedding_generation": generation
+                })
+        self._dirty_sessions = set()
+        self._deleted_sessions = set()
+        return records
+
+    @_synchronized
+    def save(self):
         try:
-            # 确保目录存在（防止目录被删除或路径变更的情况）
-            ensure_directory_exists(self.file_path)
-            with open(self.file_path, "w", encoding="utf-8") as f:
-                json.dump(data_to_save, f, ensure_ascii=False, indent=2)
+            # Details files go first so a saved header never points at pages that were not written
+            self._write_dirty_details()
+            deleted = set(self._deleted_sessions)
+            # Only dirty sessions are appended by the WAL backend; the JSON backend rewrites everything
+            self.storage.save(self._collect_records(), self._build_snapshot)
+            self._remove_details_files(deleted)
+            self.embedding_store.drop_stale_files() # Previous generation is unreferenced once the snapshot is written
         except IOError as e:
             print(f"Error saving MidTermMemory to {self.file_path}: {e}")
+        self.summary_index.save(self.summary_index_path) # No-op unless sessions were added/evicted
+        if self.lexical_index.dirty:
+            self.lexical_index.save(self.lexical_index_path, self._lexical_meta())
+        self.file_index.save(self.file_index_path, self._lexical_meta())
+
+    @_synchronized
+    def export_json(self, export_path):
+        """以原有 JSON 布局（indent=2，embedding 为 float 列表）导出"""
+        data = {
+            "sessions": {sid: self._serialize_session(session, inline_embeddings=True) for sid, session in self.sessions.items()},
+            "access_frequency": dict(self.access_frequency),
+        }
+        ensure_directory_exists(export_path)
+        with open(export_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    def _apply_record(self, record):
+        if record.get("embedding_generation", 0) < self.embedding_store.generation:
+            return # Written before the snapshot's embedding compaction, already folded into it
+        op = record.get("op")
+        if op == "put_session":
+            self.sessions[record["sid"]] = record["session"]
+            self.access_frequency[record["sid"]] = record.get("access_frequency", 0)
+        elif op == "del_session":
+            self.sessions.pop(record["sid"], None)
+            self.access_frequency.pop(record["sid"], None)
+
+    def _sidecar_row(self, record, field):
+        """返回 record 中 field 的 sidecar 行号，旧版 JSON 中的 float 列表会追加到 sidecar"""
+        if record.get(f"{field}_row") is not None:
+            return record[f"{field}_row"]
+        if has_embedding(record.get(field)):
+            return self.embedding_store.append(np.asarray(record[field], dtype=np.float32))[0]
+        return None
+
+    def _attach_embeddings(self):
+        """
+        把行号解析为 memmap 行视图。旧版布局（details 内联在 mid_term.json 中、embedding 为 float 列表）
+        迁移为 session 头 + 单独的 details 文件 + 二进制 sidecar。
+        """
+        migrated = 0
+        for sid, session in self.sessions.items():
+            session["summary_embedding_row"] = self._sidecar_row(session, "summary_embedding")
+            session["summary_embedding"] = self.embedding_store.get(session["summary_embedding_row"])
+            if "details" not in session:
+                continue
+            details = session["details"]
+            session["page_ids"] = [page.get("page_id") for page in details]
+            session["page_embedding_rows"] = [self._sidecar_row(page, "page_embedding") for page in details]
+            for page, row in zip(details, session["page_embedding_rows"]):
+                page.pop("page_embedding_row", None)
+                page["page_embedding"] = self.embedding_store.get(row)
+            self._dirty_details.add(sid)
+            migrated += 1
+        if migrated:
+            print(f"MidTermMemory: Migrated {migrated} session(s) to separate details files and binary embedding sidecar.")
+            self._write_dirty_details()
+            self.storage.compact(self._build_snapshot()) # Persist the new layout so the next load does not migrate again
+
+    def _migrate_epochs(self):
+        """旧数据只有时间字符串：加载时补上 epoch 字段，下次保存时写回"""
+        migrated = 0
+        for sid, session in self.sessions.items():
+            for str_field, epoch_field in EPOCH_FIELDS.items():
+                if epoch_field not in session and session.get(str_field):
+                    session[epoch_field] = parse_timestamp(session[str_field])
+                    self._dirty_sessions.add(sid)
+                    migrated += 1
+        if migrated:
+            print(f"MidTermMemory: Added epoch timestamps to {migrated} field(s) of legacy sessions.")
+
+    def _load_summary_index(self):
+        if self.summary_index.load(self.summary_index_path, self.sessions.keys()):
+            return
+        print(f"MidTermMemory: Summary index missing or stale, rebuilding from {len(self.sessions)} sessions.")
+        self.summary_index.rebuild(
+            (sid, session.get("summary_embedding")) for sid, session in self.sessions.items()
+        )
+
+    def _load_lexical_index(self):
+        meta = self.lexical_index.load(self.lexical_index_path) or {}
+        expected = self._lexical_meta()
+        if meta == expected:
+            return
+        # Only sessions whose page count differs are reindexed (this reads their details)
+        stale = {sid for sid in set(meta) | set(expected) if meta.get(sid) != expected.get(sid)}
+        for doc_id in self.lexical_index.doc_ids():
+            if (doc_id[0] if isinstance(doc_id, tuple) else doc_id) in stale:
+                self.lexical_index.remove(doc_id)
+        reindex = [sid for sid in stale if sid in self.sessions]
+        if reindex:
+            print(f"MidTermMemory: Lexical index missing or stale, reindexing {len(reindex)} session(s).")
+        for sid in reindex:
+            self._index_lexical(sid)
+
+    def _load_file_index(self):
+        meta = self.file_index.load(self.file_index_path) or {}
+        expected = self._lexical_meta()
+        if meta == expected:
+            return
+        stale = {sid for sid in set(meta) | set(expected) if meta.get(sid) != expected.get(sid)}
+        for sid, page_id in self.file_index.pages():
+            if sid in stale:
+                self.file_index.remove(sid, page_id)
+        reindex = [sid for sid in stale if sid in self.sessions]
+        if reindex:
+            print(f"MidTermMemory: File index missing or stale, reindexing {len(reindex)} session(s).")
+        for sid in reindex:
+            self._index_files(sid, self.get_session_details(sid))
+        self.file_index.dirty = True # Rewrite with the current meta even if no file page changed
 
     def load(self):
         try:
-            with open(self.file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                self.sessions = data.get("sessions", {})
-                self.access_frequency = defaultdict(int, data.get("access_frequency", {}))
-                self.rebuild_heap() # Rebuild heap from loaded sessions
+            data, records = self.storage.load()
+            if data is None and not records:
+                raise FileNotFoundError(self.file_path)
+            data = data or {}
+            self.sessions = data.get("sessions", {})
+            self.access_frequency = defaultdict(int, data.get("access_frequency", {}))
+            self.embedding_store.open(data.get("embedding_store"))
+            for record in records: # Replay WAL on top of the snapshot
+                self._apply_record(record)
+            self._attach_embeddings()
+            self._migrate_epochs()
+            # Drop access counts of sessions that no longer exist
+            self.access_frequency = defaultdict(int, {sid: freq for sid, freq in self.access_frequency.items() if sid in self.sessions})
+            self.rebuild_heap() # Rebuild heap from loaded sessions
+            self.rebuild_lfu()
+            self.rebuild_page_index()
+            self.rebuild_keyword_index()
+            self._load_summary_index()
+            self._load_lexical_index()
+            self._load_file_index()
             print(f"MidTermMemory: Loaded from {self.file_path}. Sessions: {len(self.sessions)}.")
         except FileNotFoundError:
             print(f"MidTermMemory: No history file found at {self.file_path}. Initializing new memory.")
@@ -251,6 +251,30 @@ META_INFO_USER_PROMPT = ("""Update the conversation meta-summary by incorporatin
 
     Updated Meta-summary:""") 
 
+# Prompt for batched short-term -> mid-term migration (utils.gpt_batch_migration)
+# One call replaces the per-page continuity check + meta info calls and the multi-summary call
+BATCH_MIGRATION_SYSTEM_PROMPT = ("You are a conversation memory organizer. For a window of consecutive dialogue pages you detect "
+                                 "conversation continuity, maintain running meta-summaries and summarize topics. Output ONLY valid JSON.")
+BATCH_MIGRATION_USER_PROMPT = ("""Process the numbered dialogue pages below in order.
+
+    For each page i:
+    1. "continuous": true if page i is a true continuation of the page right before it (page 0 for page 1) without topic shift, otherwise false. Page 1 is false if there is no page 0.
+    2. "meta_info": the meta-summary of the conversation chain page i belongs to (1-2 sentences). If continuous, update the previous page's meta-summary with the new dialogue; otherwise start a new one from page i alone.
+
+    Then summarize the whole window with extremely concise subtopic summaries, with a maximum of two themes.
+
+    Output JSON only, in this format:
+    {{
+      "pages": [{{"index": 1, "continuous": false, "meta_info": "..."}}],
+      "summaries": [{{"theme": "Brief theme", "keywords": ["key1", "key2"], "content": "summary"}}]
+    }}
+
+    Page 0 (already stored, for continuity only):
+    {previous_page}
+
+    Pages:
+    {pages}""")
+
 # Prompt for video structured caption generation (used by videorag/_videoutil/caption.py)
 VIDEO_STRUCTURED_CAPTION_PROMPT = """
 你将看到按时间顺序提供的若干视频帧图像，并收到对应的字幕文本（如果有）。
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class RetrievalCache:
+    """
+    单个用户的检索结果缓存，按 query embedding 查找：与已缓存 query 的余弦相似度 >= similarity_threshold
+    且检索参数相同即命中。
+    - 条目超过 ttl 秒失效，总数超过 max_entries 时淘汰最久未用的条目
+    - version 为各记忆层写入计数组成的元组，与缓存时不同则整体清空（任何中期 / 长期写入都会使其失效）
+    """
+
+    def __init__(self, max_entries=128, ttl=300, similarity_threshold=0.97):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # entry_id -> (query_vec, params, expires_at, result)
+        self._next_id = 0
+        self._version = None
+        self._matrix = None  # Stacked query vectors, rebuilt lazily after puts / evictions
+        self._matrix_ids = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _sync_version(self, version):
+        if version != self._version:
+            self._entries.clear()
+            self._matrix = None
+            self._version = version
+
+    def get(self, query_vec, params, version):
+        """返回缓存的检索结果，未命中返回 None"""
+        with self._lock:
+            self._sync_version(version)
+            if not self._entries:
+                self.misses += 1
+                return None
+            if self._matrix is None:
+                self._matrix_ids = list(self._entries)
+                self._matrix = np.vstack([self._entries[i][0] for i in self._matrix_ids])
+            scores = self._matrix @ np.asarray(query_vec, dtype=np.float32)
+            now = time.monotonic()
+            for row in np.argsort(-scores):
+                if scores[row] < self.similarity_threshold:
+                    break
+                entry_id = self._matrix_ids[row]
+                entry = self._entries.get(entry_id)
+                if entry is None or entry[1] != params:
+                    continue
+                if entry[2] < now:
+                    del self._entries[entry_id]
+                    self._matrix = None
+                    continue
+                self._entries.move_to_end(entry_id)
+                self.hits += 1
+                return entry[3]
+            self.misses += 1
+            return None
+
+    def put(self, query_vec, params, version, result):
+        """缓存检索结果；调用方需确认检索期间 version 没有变化"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._sync_version(version)
+            self._entries[self._next_id] = (np.asarray(query_vec, dtype=np.float32), params, time.monotonic() + self.ttl, result)
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
@@ -1,21 +1,39 @@
+import asyncio
+import json
 from collections import deque
 import heapq
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional
 
-from .utils import get_timestamp, OpenAIClient, run_parallel_tasks
+from .utils import get_timestamp, OpenAIClient, run_parallel_tasks, get_embedding, aget_embedding, normalize_vector
 from .short_term import ShortTermMemory
 from .mid_term import MidTermMemory
 from .long_term import LongTermMemory
+from .retrieval_cache import RetrievalCache
+from .lexical_index import is_exact_term_query
 # from .updater import Updater # Updater is not directly used by Retriever
 
+_shared_executor = None
+_shared_executor_lock = threading.Lock()
+
+def _get_shared_executor():
+    """未传入 executor 的 Retriever 共用的线程池，避免每次检索都创建、销毁线程池"""
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="memcontext-retrieval")
+        return _shared_executor
+
 class Retriever:
     def __init__(self, 
                  mid_term_memory: MidTermMemory, 
                  long_term_memory: LongTermMemory, 
                  assistant_long_term_memory: Optional[LongTermMemory] = None, # Add assistant LTM
                  # client: OpenAIClient, # Not strictly needed if all LLM calls are within memory modules
-                 queue_capacity=7): # Default from main_memoybank was 7 for retrieval_queue
+                 queue_capacity=7, # Default from main_memoybank was 7 for retrieval_queue
+                 executor: Optional[ThreadPoolExecutor] = None, # Shared pool (e.g. MemcontextRuntime); None uses the module-wide pool
+                 cache: Optional[RetrievalCache] = None): # Per-user result cache keyed by query embedding, None disables it
         # Short term memory is usually for direct context, not primary retrieval source here
         # self.short_term_memory = short_term_memory 
         self.mid_term_memory = mid_term_memory
@@ -23,16 +41,21 @@ class Retriever:
         self.assistant_long_term_memory = assistant_long_term_memory # Store assistant LTM reference
         # self.client = client 
         self.retrieval_queue_capacity = queue_capacity
+        self.executor = executor
+        self.cache = cache
         # self.retrieval_queue = deque(maxlen=queue_capacity) # This was instance level, but retrieve returns it, so maybe not needed as instance var
 
-    def _retrieve_mid_term_context(self, user_query, segment_similarity_threshold, page_similarity_threshold, top_k_sessions):
+    def _retrieve_mid_term_context(self, user_query, segment_similarity_threshold, page_similarity_threshold, top_k_sessions, query_vec=None,
+                                   mode="hybrid"):
         """并行任务：从中期记忆检索"""
         print("Retriever: Searching mid-term memory...")
         matched_sessions = self.mid_term_memory.search_sessions(
             query_text=user_query, 
             segment_similarity_threshold=segment_similarity_threshold,
             page_similarity_threshold=page_similarity_threshold,
-            top_k_sessions=top_k_sessions
+            top_k_sessions=top_k_sessions,
+            mode=mode,
+            query_vec=query_vec
         )
         
         # Use a heap to get top N pages across all relevant sessions based on their scores
@@ -69,16 +92,16 @@ class Retriever:
         print(f"Retriever: Mid-term memory recalled {len(retrieved_pages)} pages.")
         return retrieved_pages
 
-    def _retrieve_user_knowledge(self, user_query, knowledge_threshold, top_k_knowledge):
+    def _retrieve_user_knowledge(self, user_query, knowledge_threshold, top_k_knowledge, query_vec=None):
         """并行任务：从用户长期知识检索"""
         print("Retriever: Searching user long-term knowledge...")
         retrieved_knowledge = self.long_term_memory.search_user_knowledge(
-            user_query, threshold=knowledge_threshold, top_k=top_k_knowledge
+            user_query, threshold=knowledge_threshold, top_k=top_k_knowledge, query_vec=query_vec
         )
         print(f"Retriever: Long-term user knowledge recalled {len(retrieved_knowledge)} items.")
         return retrieved_knowledge
 
-    def _retrieve_assistant_knowledge(self, user_query, knowledge_threshold, top_k_knowledge):
+    def _retrieve_assistant_knowledge(self, user_query, knowledge_threshold, top_k_knowledge, query_vec=None):
         """并行任务：从助手长期知识检索"""
         if not self.assistant_long_term_memory:
             print("Retriever: No assistant long-term memory provided, skipping assistant knowledge retrieval.")
@@ -86,7 +109,7 @@ class Retriever:
         
         print("Retriever: Searching assistant long-term knowledge...")
         retrieved_knowledge = self.assistant_long_term_memory.search_assistant_knowledge(
-            user_query, threshold=knowledge_threshold, top_k=top_k_knowledge
+            user_query, threshold=knowledge_threshold, top_k=top_k_knowledge, query_vec=query_vec
         )
         print(f"Retriever: Long-term assistant knowledge recalled {len(retrieved_knowledge)} items.")
         return retrieved_knowledge
@@ -101,28 +124,193 @@ class Retriever:
                          ):
         print(f"Retriever: Starting PARALLEL retrieval for query: '{user_query[:50]}...'")
         
+        # 精确词查询先只走中期记忆的词法索引，有命中时中期记忆不再需要 query 向量
+        exact_pages = None
+        if self._is_exact_term_lookup(user_query):
+            exact_pages = self._retrieve_mid_term_context(user_query, segment_similarity_threshold, page_similarity_threshold,
+                                                          top_k_sessions, mode="lexical") or None
+        # query embedding 只计算一次，各检索任务共用
+        query_vecs = self._embed_query(user_query, include_mid_term=exact_pages is None)
+        if exact_pages is not None:
+            tasks = self._retrieval_tasks(user_query, segment_similarity_threshold, page_similarity_threshold,
+                                          knowledge_threshold, top_k_sessions, top_k_knowledge, query_vecs)[1:]
+            return self._pack_results([exact_pages] + self._run_tasks(self.executor or _get_shared_executor(), tasks))
+        params = (segment_similarity_threshold, page_similarity_threshold, knowledge_threshold, top_k_sessions, top_k_knowledge)
+        version = self._memory_version()
+        cached = self._cached_result(query_vecs, params, version)
+        if cached is not None:
+            return cached
+
         # 并行执行三个检索任务
-        tasks = [
-            lambda: self._retrieve_mid_term_context(user_query, segment_similarity_threshold, page_similarity_threshold, top_k_sessions),
-            lambda: self._retrieve_user_knowledge(user_query, knowledge_threshold, top_k_knowledge),
-            lambda: self._retrieve_assistant_knowledge(user_query, knowledge_threshold, top_k_knowledge)
-        ]
+        tasks = self._retrieval_tasks(user_query, segment_similarity_threshold, page_similarity_threshold,
+                                      knowledge_threshold, top_k_sessions, top_k_knowledge, query_vecs)
         
         # 使用并行处理
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            futures = []
-            for i, task in enumerate(tasks):
-                future = executor.submit(task)
-                futures.append((i, future))
-            
-            results = [None] * 3
-            for task_idx, future in futures:
-                try:
-                    results[task_idx] = future.result()
-                except Exception as e:
-                    print(f"Error in retrieval task {task_idx}: {e}")
-                    results[task_idx] = []
+        results = self._run_tasks(self.executor or _get_shared_executor(), tasks)
+        return self._store_result(query_vecs, params, version, results)
+
+    def _run_tasks(self, executor, tasks):
+        futures = []
+        for i, task in enumerate(tasks):
+            future = executor.submit(task)
+            futures.append((i, future))
         
+        results = [None] * len(tasks)
+        for task_idx, future in futures:
+            try:
+                results[task_idx] = future.result()
+            except Exception as e:
+                print(f"Error in retrieval task {task_idx}: {e}")
+                results[task_idx] = None # Packed as [], but keeps the result out of the cache
+        return results
+
+    async def aretrieve_context(self, user_query: str, 
+                                user_id: str,
+                                segment_similarity_threshold=0.1,
+                                page_similarity_threshold=0.1,
+                                knowledge_threshold=0.01,
+                                top_k_sessions=5,
+                                top_k_knowledge=20
+                                ):
+        """
+        retrieve_context 的 asyncio 版本。
+        query embedding 通过异步 embedding 客户端计算一次并直接传给三个检索任务；
+        检索任务可能从磁盘读取 session details 并保存中期记忆，在线程池中执行，不阻塞事件循环。
+        """
+        print(f"Retriever: Starting ASYNC retrieval for query: '{user_query[:50]}...'")
+        loop = asyncio.get_running_loop()
+        executor = self.executor or _get_shared_executor()
+        # 精确词查询先只走中期记忆的词法索引，有命中时中期记忆不再需要 query 向量
+        exact_pages = None
+        if self._is_exact_term_lookup(user_query):
+            exact_pages = await loop.run_in_executor(executor, lambda: self._retrieve_mid_term_context(
+                user_query, segment_similarity_threshold, page_similarity_threshold, top_k_sessions, mode="lexical")) or None
+        configs = self._embedding_configs(include_mid_term=exact_pages is None)
+        vectors = await asyncio.gather(*[
+            aget_embedding(user_query, model_name=model_name, **model_kwargs)
+            for model_name, model_kwargs in configs.values()
+        ], return_exceptions=True)
+        query_vecs = {}
+        for key, vec in zip(configs, vectors):
+            if isinstance(vec, Exception):
+                # That memory falls back to the synchronous embedding path inside its search
+                print(f"Retriever: Async query embedding failed, searches will embed synchronously: {vec}")
+            else:
+                query_vecs[key] = normalize_vector(vec)
+
+        if exact_pages is not None:
+            tasks = self._retrieval_tasks(user_query, segment_similarity_threshold, page_similarity_threshold,
+                                          knowledge_threshold, top_k_sessions, top_k_knowledge, query_vecs)[1:]
+            return self._pack_results([exact_pages] + await self._arun_tasks(loop, executor, tasks))
+
+        params = (segment_similarity_threshold, page_similarity_threshold, knowledge_threshold, top_k_sessions, top_k_knowledge)
+        version = self._memory_version()
+        cached = self._cached_result(query_vecs, params, version)
+        if cached is not None:
+            return cached
+
+        tasks = self._retrieval_tasks(user_query, segment_similarity_threshold, page_similarity_threshold,
+                                      knowledge_threshold, top_k_sessions, top_k_knowledge, query_vecs)
+        results = await self._arun_tasks(loop, executor, tasks)
+        return self._store_result(query_vecs, params, version, results)
+
+    async def _arun_tasks(self, loop, executor, tasks):
+        outcomes = await asyncio.gather(*[loop.run_in_executor(executor, task) for task in tasks], return_exceptions=True)
+        results = []
+        for task_idx, outcome in enumerate(outcomes):
+            if isinstance(outcome, Exception):
+                print(f"Error in retrieval task {task_idx}: {outcome}")
+                outcome = None
+            results.append(outcome)
+        return results
+
+    def _memory_version(self):
+        return (self.mid_term_memory.version, self.long_term_memory.version,
+                self.assistant_long_term_memory.version if self.assistant_long_term_memory else None)
+
+    def _cache_vector(self, query_vecs):
+        """缓存查找用的 query 向量：优先用中期记忆的 embedding 配置"""
+        vec = query_vecs.get(self._embedding_key(self.mid_term_memory))
+        if vec is None and query_vecs:
+            vec = next(iter(query_vecs.values()))
+        return vec
+
+    @staticmethod
+    def _copy_result(packed):
+        # Callers may edit the lists, the cached copy must stay intact
+        return {key: list(value) if isinstance(value, list) else value for key, value in packed.items()}
+
+    def _cached_result(self, query_vecs, params, version):
+        cache_vec = self._cache_vector(query_vecs)
+        if self.cache is None or cache_vec is None:
+            return None
+        cached = self.cache.get(cache_vec, params, version)
+        if cached is None:
+            return None
+        print("Retriever: Returning cached retrieval result.")
+        return self._copy_result(cached)
+
+    def _store_result(self, query_vecs, params, version, results):
+        packed = self._pack_results(results)
+        cache_vec = self._cache_vector(query_vecs)
+        # Skip failed runs and runs that overlapped a write (the result may mix old and new memory)
+        if (self.cache is not None and cache_vec is not None and all(result is not None for result in results)
+                and self._memory_version() == version):
+            self.cache.put(cache_vec, params, version, self._copy_result(packed))
+        return packed
+
+    @staticmethod
+    def _embedding_key(memory):
+        return json.dumps({"model_name": memory.embedding_model_name, **(memory.embedding_model_kwargs or {})}, sort_keys=True)
+
+    def _embedding_configs(self, include_mid_term=True):
+        """
+        本轮会执行检索的记忆层使用的 {key: (embedding_model_name, embedding_model_kwargs)}，去重；
+        空的记忆层不检索，不为其计算 embedding。
+        """
+        memories = [
+            (self.mid_term_memory, self.mid_term_memory.sessions if include_mid_term else None),
+            (self.long_term_memory, self.long_term_memory.knowledge_base),
+            (self.assistant_long_term_memory, self.assistant_long_term_memory.assistant_knowledge if self.assistant_long_term_memory else None),
+        ]
+        configs = {}
+        for memory, contents in memories:
+            if memory is None or not contents:
+                continue
+            configs[self._embedding_key(memory)] = (memory.embedding_model_name, memory.embedding_model_kwargs or {})
+        return configs
+
+    def _is_exact_term_lookup(self, user_query):
+        """
+        精确词查询（文件名、ID）先单独跑中期记忆的词法检索：有命中时中期记忆结果即为 BM25 结果，
+        query 向量只为长期知识计算（两个知识库共用），结果不进入检索缓存；没有命中时按普通查询处理。
+        """
+        return self.mid_term_memory.lexical_weight > 0 and is_exact_term_query(user_query)
+
+    def _embed_query(self, user_query, include_mid_term=True):
+        """每种 embedding 配置只计算一次 query 向量，返回 {key: 归一化向量}；失败的由各检索任务自行计算"""
+        query_vecs = {}
+        for key, (model_name, model_kwargs) in self._embedding_configs(include_mid_term).items():
+            try:
+                query_vecs[key] = normalize_vector(get_embedding(user_query, model_name=model_name, **model_kwargs))
+            except Exception as e:
+                print(f"Retriever: Query embedding failed, searches will embed on their own: {e}")
+        return query_vecs
+
+    def _retrieval_tasks(self, user_query, segment_similarity_threshold, page_similarity_threshold,
+                         knowledge_threshold, top_k_sessions, top_k_knowledge, query_vecs=None):
+        query_vecs = query_vecs or {}
+        def query_vec(memory):
+            return query_vecs.get(self._embedding_key(memory)) if memory is not None else None
+        return [
+            lambda: self._retrieve_mid_term_context(user_query, segment_similarity_threshold, page_similarity_threshold, top_k_sessions,
+                                                    query_vec(self.mid_term_memory)),
+            lambda: self._retrieve_user_knowledge(user_query, knowledge_threshold, top_k_knowledge, query_vec(self.long_term_memory)),
+            lambda: self._retrieve_assistant_knowledge(user_query, knowledge_threshold, top_k_knowledge,
+                                                       query_vec(self.assistant_long_term_memory))
+        ]
+
+    def _pack_results(self, results):
         retrieved_mid_term_pages, retrieved_user_knowledge, retrieved_assistant_knowledge = results
 
         return {
@@ -130,4 +318,4 @@ class Retriever:
             "retrieved_user_knowledge": retrieved_user_knowledge or [], # List of knowledge entry dicts
             "retrieved_assistant_knowledge": retrieved_assistant_knowledge or [], # List of assistant knowledge entry dicts
             "retrieved_at": get_timestamp()
-        } 
\ No newline at end of file
+        }
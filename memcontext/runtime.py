@@ -0,0 +1,205 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .utils import (OpenAIClient, AsyncOpenAIClient, configure_embedding_cache, get_embedding_cache,
+                    configure_llm_response_cache, get_llm_response_cache)
+from .maintenance import MaintenanceQueue
+
+
+class MemcontextRuntime:
+    """
+    进程级共享运行时，供大量按用户创建的 Memcontext 实例共用：
+    - LLM 客户端池：相同 (api_key, base_url) 复用同一个 OpenAIClient / AsyncOpenAIClient（及其 HTTP 连接池）
+    - 线程池：background_executor 执行长期记忆分析等后台任务，retrieval_executor 执行检索子任务
+    - 维护队列：maintenance 按用户串行、合并重复的迁移/分析触发，排队过多或 LLM 满载时丢弃新触发
+    - 并发上限：所有共享客户端的 LLM 请求总数不超过 max_concurrency
+    - 用户实例注册表：按 key 缓存 Memcontext，空闲超过 idle_timeout 或超过 max_users 时回收（LRU）
+
+    embedding 模型（utils._model_cache）、embedding 缓存与 LLM 响应缓存本身即为进程级共享，这里只负责配置。
+    """
+
+    def __init__(self, max_workers=16, retrieval_workers=8, max_concurrency=32,
+                 idle_timeout=1800, max_users=None,
+                 embedding_cache_max_bytes=None, embedding_cache_path=None, max_pending_maintenance=1000,
+                 llm_cache_path=None):
+        self.background_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="memcontext-bg")
+        # Retrieval tasks are leaves (they never wait on other pool tasks), so a separate pool cannot deadlock
+        self.retrieval_executor = ThreadPoolExecutor(max_workers=retrieval_workers, thread_name_prefix="memcontext-retrieval")
+        self.max_concurrency = max_concurrency
+        self.concurrency_limiter = threading.BoundedSemaphore(max_concurrency)
+        self.maintenance = MaintenanceQueue(executor=self.background_executor, max_pending=max_pending_maintenance,
+                                            saturation_check=self.llm_saturated)
+        self.idle_timeout = idle_timeout
+        self.max_users = max_users
+
+        self._clients = {}
+        self._async_clients = {}
+        self._users = OrderedDict()  # key -> {"memcontext", "last_used", "in_use"}
+        self._lock = threading.RLock()
+        self._closed = False
+        self._last_sweep = time.monotonic()
+
+        configure_embedding_cache(max_bytes=embedding_cache_max_bytes, disk_path=embedding_cache_path)
+        configure_llm_response_cache(disk_path=llm_cache_path)
+
+    @property
+    def embedding_cache(self):
+        return get_embedding_cache()
+
+    @property
+    def llm_response_cache(self):
+        return get_llm_response_cache()
+
+    # ---- LLM client pool ----
+    def get_client(self, api_key, base_url=None):
+        key = (api_key, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = OpenAIClient(api_key=api_key, base_url=base_url,
+                                      executor=self.background_executor,
+                                      concurrency_limiter=self.concurrency_limiter)
+                self._clients[key] = client
+            return client
+
+    def get_async_client(self, api_key, base_url=None):
+        key = (api_key, base_url)
+        with self._lock:
+            client = self._async_clients.get(key)
+            if client is None:
+                client = AsyncOpenAIClient(api_key=api_key, base_url=base_url, max_concurrency=self.max_concurrency)
+                self._async_clients[key] = client
+            return client
+
+    def llm_saturated(self):
+        """所有共享客户端的在途 LLM 请求数是否已达到 max_concurrency"""
+        with self._lock:
+            clients = list(self._clients.values())
+        return sum(client.in_flight for client in clients) >= self.max_concurrency
+
+    # ---- Executors ----
+    def submit_background(self, fn, *args, **kwargs):
+        """在 background_executor 中执行后台子任务（如画像分析时并行的知识提取）"""
+        return self.background_executor.submit(fn, *args, **kwargs)
+
+    # ---- Per-user instance registry ----
+    def _acquire_entry(self, key, factory, borrow):
+        with self._lock:
+            entry = self._users.get(key)
+        if entry is None:
+            if factory is None:
+                return None
+            # Build outside the lock so loading one user's files does not block every other user
+            created = factory()
+            with self._lock:
+                entry = self._users.get(key)
+                if entry is None:
+                    entry = {"memcontext": created, "last_used": time.monotonic(), "in_use": 0}
+                    self._users[key] = entry
+                    created = None
+            if created is not None:
+                created.close() # Another request registered the same key first
+        with self._lock:
+            entry["last_used"] = time.monotonic()
+            if borrow:
+                entry["in_use"] += 1
+            if key in self._users:
+                self._users.move_to_end(key)
+        self._maybe_evict()
+        return entry["memcontext"]
+
+    def _maybe_evict(self):
+        # The idle scan walks every instance, so run it at most once a minute; the max_users bound is checked every time
+        now = time.monotonic()
+        if now - self._last_sweep >= min(60, self.idle_timeout or 60) or (self.max_users is not None and len(self._users) > self.max_users):
+            self._last_sweep = now
+            self.evict_idle(now)
+
+    def get_user(self, key, factory=None):
+        """
+        返回 key 对应的 Memcontext；不存在时若提供 factory 则调用 factory() 创建并注册，否则返回 None。
+        每次访问都会刷新最近使用时间，并顺带回收空闲实例。
+        """
+        return self._acquire_entry(key, factory, borrow=False)
+
+    def register_user(self, key, memcontext):
+        """注册（或替换）key 对应的实例"""
+        with self._lock:
+            old = self._users.pop(key, None)
+            self._users[key] = {"memcontext": memcontext, "last_used": time.monotonic(), "in_use": 0}
+        if old is not None and old["memcontext"] is not memcontext:
+            old["memcontext"].close()
+        self._maybe_evict()
+        return memcontext
+
+    @contextmanager
+    def borrow(self, key, factory=None):
+        """在 with 块内使用实例，期间不会被空闲回收"""
+        memcontext = self._acquire_entry(key, factory, borrow=True)
+        try:
+            yield memcontext
+        finally:
+            with self._lock:
+                entry = self._users.get(key)
+                if entry is not None and entry["memcontext"] is memcontext and entry["in_use"] > 0:
+                    entry["in_use"] -= 1
+                    entry["last_used"] = time.monotonic()
+
+    def release_user(self, key):
+        with self._lock:
+            entry = self._users.pop(key, None)
+        if entry is not None:
+            entry["memcontext"].close()
+
+    def _busy_keys(self):
+        """
+        有正在执行或排队的维护任务（迁移、画像分析）的 key。这些实例不能回收，否则重新创建的实例
+        会与仍在写入的旧实例同时持有同一份文件。在 _lock 外查询：维护队列提交任务时会调用 llm_saturated。
+        """
+        with self._lock:
+            entries = list(self._users.items())
+        return {key for key, entry in entries if entry["in_use"] == 0 and entry["memcontext"].has_pending_maintenance()}
+
+    def evict_idle(self, now=None):
+        """回收空闲超时的实例；超过 max_users 时按最近最少使用回收。返回被回收的 key 列表"""
+        now = time.monotonic() if now is None else now
+        busy = self._busy_keys()
+        evicted = []
+        with self._lock:
+            for key, entry in list(self._users.items()):
+                if (entry["in_use"] == 0 and key not in busy and self.idle_timeout is not None
+                        and now - entry["last_used"] > self.idle_timeout):
+                    evicted.append((key, self._users.pop(key)))
+            if self.max_users is not None:
+                # OrderedDict is kept in recency order; skip instances that are currently borrowed or still maintaining
+                for key in list(self._users.keys()):
+                    if len(self._users) <= self.max_users:
+                        break
+                    if self._users[key]["in_use"] == 0 and key not in busy:
+                        evicted.append((key, self._users.pop(key)))
+        for key, entry in evicted:
+            print(f"MemcontextRuntime: Evicted idle instance {key}.")
+            entry["memcontext"].close()
+        return [key for key, _ in evicted]
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, key):
+        return key in self._users
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            users = list(self._users.values())
+            self._users.clear()
+        for entry in users:
+            entry["memcontext"].close()
+        self.maintenance.shutdown(wait=wait)
+        self.background_executor.shutdown(wait=wait)
+        self.retrieval_executor.shutdown(wait=wait)
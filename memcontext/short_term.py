@@ -1,14 +1,17 @@
 import json
 from collections import deque
 
-from .utils import get_timestamp, ensure_directory_exists
+from .utils import get_timestamp, generate_id, ensure_directory_exists
+from .storage import create_storage_backend
 
 class ShortTermMemory:
-    def __init__(self, file_path, max_capacity=10):
+    def __init__(self, file_path, max_capacity=10, storage_backend="json", storage_options=None):
         self.max_capacity = max_capacity
         self.file_path = file_path
         ensure_directory_exists(self.file_path)
         self.memory = deque(maxlen=max_capacity)
+        self._pending_records = [] # Appends/evictions since the last save, written as WAL records by the WAL backend
+        self.storage = create_storage_backend(self.file_path, storage_backend, **(storage_options or {}))
         self.load()
 
     def add_qa_pair(self, qa_pair):
@@ -18,8 +21,14 @@ class ShortTermMemory:
             qa_copy["timestamp"] = get_timestamp()
         if "meta_data" not in qa_copy or qa_copy["meta_data"] is None:
             qa_copy["meta_data"] = {}
+        # WAL records refer to QAs by this id; timestamp + input is not unique (same input twice in one second)
+        qa_copy["qa_id"] = generate_id("qa")
         
+        if len(self.memory) >= self.max_capacity:
+            # The deque drops the oldest entry itself; log it so replay does not depend on maxlen
+            self._pending_records.append({"op": "evict", "qa_id": self.memory[0].get("qa_id")})
         self.memory.append(qa_copy)
+        self._pending_records.append({"op": "append", "qa": qa_copy})
         print(f"ShortTermMemory: Added QA. User: {qa_pair.get('user_input','')[:30]}...")
         self.save()
 
@@ -32,29 +41,55 @@ class ShortTermMemory:
     def pop_oldest(self):
         if self.memory:
             msg = self.memory.popleft()
+            self._pending_records.append({"op": "evict", "qa_id": msg.get("qa_id")})
             print("ShortTermMemory: Evicted oldest QA pair.")
             self.save()
             return msg
         return None
 
     def save(self):
+        # Only the appends/evictions since the last save are logged by the WAL backend; the JSON backend rewrites everything
+        records, self._pending_records = self._pending_records, []
         try:
-            # 确保目录存在（防止目录被删除或路径变更的情况）
-            ensure_directory_exists(self.file_path)
-            with open(self.file_path, "w", encoding="utf-8") as f:
-                json.dump(list(self.memory), f, ensure_ascii=False, indent=2)
+            self.storage.save(records, lambda: list(self.memory))
         except IOError as e:
             print(f"Error saving ShortTermMemory to {self.file_path}: {e}")
 
+    def export_json(self, export_path):
+        """以原有 JSON 布局（indent=2）导出"""
+        ensure_directory_exists(export_path)
+        with open(export_path, "w", encoding="utf-8") as f:
+            json.dump(list(self.memory), f, ensure_ascii=False, indent=2)
+
+    @staticmethod
+    def _apply_record(entries, record):
+        """
+        在 entries（list）上重放一条 WAL 记录。append 跳过已存在的 qa_id、evict 按 qa_id 删除，
+        所以压缩时崩溃导致快照已包含部分记录时，重放结果不变。
+        """
+        op = record.get("op")
+        if op == "append":
+            qa = record.get("qa", {})
+            if all(entry.get("qa_id") != qa.get("qa_id") for entry in entries):
+                entries.append(qa)
+        elif op == "evict":
+            entries[:] = [entry for entry in entries if entry.get("qa_id") != record.get("qa_id")]
+
     def load(self):
         try:
-            with open(self.file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                # Ensure items are loaded correctly, especially if file was empty or malformed
-                if isinstance(data, list):
-                    self.memory = deque(data, maxlen=self.max_capacity)
-                else:
-                    self.memory = deque(maxlen=self.max_capacity)
+            data, records = self.storage.load()
+            if data is None and not records:
+                raise FileNotFoundError(self.file_path)
+            # Ensure items are loaded correctly, especially if file was empty or malformed
+            entries = list(data) if isinstance(data, list) else []
+            for record in records:
+                self._apply_record(entries, record)
+            self.memory = deque(entries[-self.max_capacity:], maxlen=self.max_capacity)
+            if any("qa_id" not in qa for qa in self.memory):
+                # History written before QAs had ids: assign them and snapshot, so later WAL records can refer to them
+                for qa in self.memory:
+                    qa.setdefault("qa_id", generate_id("qa"))
+                self.storage.compact(list(self.memory))
             print(f"ShortTermMemory: Loaded from {self.file_path}.")
         except FileNotFoundError:
             self.memory = deque(maxlen=self.max_capacity)
@@ -64,4 +99,4 @@ class ShortTermMemory:
             print(f"ShortTermMemory: Error decoding JSON from {self.file_path}. Initializing new memory.")
         except Exception as e:
             self.memory = deque(maxlen=self.max_capacity)
-            print(f"ShortTermMemory: An unexpected error occurred during load from {self.file_path}: {e}. Initializing new memory.") 
\ No newline at end of file
+            print(f"ShortTermMemory: An unexpected error occurred during load from {self.file_path}: {e}. Initializing new memory.")
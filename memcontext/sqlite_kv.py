@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class SqliteKVStore:
+    """
+    基于 SQLite 的简单 key/value 持久化表（value 为 bytes），供磁盘缓存层复用。
+    单个连接 + 锁，允许多线程访问；使用 WAL journal 以减少写入阻塞读取。
+    """
+
+    def __init__(self, db_path, table="kv", max_entries=None):
+        self.db_path = db_path
+        self.table = table
+        self.max_entries = max_entries
+        self._puts_since_prune = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30.0)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value BLOB NOT NULL, created REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """返回 {key: value}，不存在的 key 不出现在结果中"""
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update((k, bytes(v)) for k, v in rows)
+        return found
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        items = list(items)
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created) VALUES (?, ?, ?)",
+                [(k, sqlite3.Binary(v), now) for k, v in items]
+            )
+            self._conn.commit()
+            self._puts_since_prune += len(items)
+            if self.max_entries and self._puts_since_prune >= max(1, self.max_entries // 10):
+                self._prune_locked()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def _prune_locked(self):
+        # INSERT OR REPLACE assigns a fresh rowid, so the lowest rowids are the oldest writes
+        self._conn.execute(
+            f"DELETE FROM {self.table} WHERE rowid IN "
+            f"(SELECT rowid FROM {self.table} ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        self._conn.commit()
+        self._puts_since_prune = 0
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+_stage_executor = None
+_stage_executor_lock = threading.Lock()
+
+def _get_stage_executor():
+    """
+    StageGraph 默认使用的线程池。与检索线程池分开：检索阶段本身会向检索线程池提交子任务并等待，
+    共用一个池在并发请求多时可能互相占满工作线程。
+    """
+    global _stage_executor
+    with _stage_executor_lock:
+        if _stage_executor is None:
+            _stage_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="memcontext-stage")
+        return _stage_executor
+
+
+class StageGraph:
+    """
+    回复生成前各阶段的依赖图：阶段在其依赖全部完成后立即开始，互不依赖的阶段并发执行。
+    阶段函数以依赖阶段的结果为位置参数调用（顺序同 deps）；依赖失败时该阶段以同一异常失败、不再执行。
+    每次运行把各阶段相对起点的开始时间与耗时（毫秒）写入 timings，用于观察 TTFT 的变化。
+    """
+
+    def __init__(self):
+        self._stages = {}  # name -> (fn, deps), insertion order is a topological order
+        self.timings = {}
+
+    def add(self, name, fn, deps=()):
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dep}'")
+        self._stages[name] = (fn, tuple(deps))
+        return self
+
+    def _record(self, name, start, origin):
+        self.timings[name] = {"start_ms": (start - origin) * 1000, "duration_ms": (time.perf_counter() - start) * 1000}
+
+    def _timed_call(self, name, fn, args, origin):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._record(name, start, origin)
+
+    def run(self, executor=None):
+        """提交所有阶段并立即返回 {name: Future}；调用方等待自己需要的阶段即可"""
+        executor = executor or _get_stage_executor()
+        origin = time.perf_counter()
+        self.timings = {}
+        futures = {name: Future() for name in self._stages}
+        waiting = {name: len(deps) for name, (_, deps) in self._stages.items()}
+        dependents = {name: [] for name in self._stages}
+        for name, (_, deps) in self._stages.items():
+            for dep in deps:
+                dependents[dep].append(name)
+        lock = threading.Lock()
+
+        def launch(name):
+            fn, deps = self._stages[name]
+            failed = next((futures[dep].exception() for dep in deps if futures[dep].exception() is not None), None)
+            if failed is not None:
+                futures[name].set_exception(failed)
+                finish(name)
+                return
+            args = [futures[dep].result() for dep in deps]
+            inner = executor.submit(self._timed_call, name, fn, args, origin)
+            inner.add_done_callback(lambda done, name=name: settle(name, done))
+
+        def settle(name, done):
+            if done.exception() is not None:
+                futures[name].set_exception(done.exception())
+            else:
+                futures[name].set_result(done.result())
+            finish(name)
+
+        def finish(name):
+            # Dependents are started from completion callbacks, so no worker ever blocks waiting on another stage
+            for dependent in dependents[name]:
+                with lock:
+                    waiting[dependent] -= 1
+                    ready = waiting[dependent] == 0
+                if ready:
+                    launch(dependent)
+
+        for name, count in list(waiting.items()):
+            if count == 0:
+                launch(name)
+        return futures
+
+    async def arun(self, executor=None):
+        """
+        asyncio 版本：返回 {name: asyncio.Task}。协程函数直接 await，
+        普通函数在 executor（默认 StageGraph 线程池）中执行，不阻塞事件循环。
+        """
+        loop = asyncio.get_running_loop()
+        executor = executor or _get_stage_executor()
+        origin = time.perf_counter()
+        self.timings = {}
+        tasks = {}
+
+        async def run_stage(name, fn, deps):
+            args = [await tasks[dep] for dep in deps]
+            start = time.perf_counter()
+            try:
+                if asyncio.iscoroutinefunction(fn):
+                    return await fn(*args)
+                return await loop.run_in_executor(executor, lambda: fn(*args))
+            finally:
+                self._record(name, start, origin)
+
+        for name, (fn, deps) in self._stages.items():
+            tasks[name] = asyncio.ensure_future(run_stage(name, fn, deps))
+        return tasks
+
+    def format_timings(self):
+        return " ".join(f"{name}={timing['duration_ms']:.1f}" for name, timing in self.timings.items())
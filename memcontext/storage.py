@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+
+from .utils import ensure_directory_exists
+
+STORAGE_BACKEND_JSON = "json"
+STORAGE_BACKEND_WAL = "wal"
+
+
+def write_json_atomic(file_path, data, indent=None):
+    """先写临时文件再替换，避免写到一半的 JSON 覆盖旧文件"""
+    ensure_directory_exists(file_path)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, file_path)
+
+
+class JsonFileBackend:
+    """
+    原有存储方式：每次保存都用 indent=2 重写完整的 JSON 文件。
+    """
+    kind = STORAGE_BACKEND_JSON
+
+    def __init__(self, file_path, indent=2):
+        self.file_path = file_path
+        self.indent = indent
+
+    def load(self):
+        """返回 (snapshot, records)；文件不存在时 snapshot 为 None"""
+        if not os.path.exists(self.file_path):
+            return None, []
+        with open(self.file_path, "r", encoding="utf-8") as f:
+            return json.load(f), []
+
+    def save(self, records, build_snapshot):
+        # Records are ignored: every save is a full snapshot
+        ensure_directory_exists(self.file_path)
+        with open(self.file_path, "w", encoding="utf-8") as f:
+            json.dump(build_snapshot(), f, ensure_ascii=False, indent=self.indent)
+
+    def compact(self, snapshot):
+        self.save(None, lambda: snapshot)
+
+
+class WalFileBackend:
+    """
+    追加写 WAL 存储：每次保存只把变更记录追加到 <file>.wal（一行一个 JSON），
+    累计 compact_every 条后把完整状态压缩写入 <file>（与原 JSON 布局一致）并清空 WAL。
+    加载时读取快照再重放 WAL。
+
+    各层的 WAL 记录需可重复应用（重放幂等），因为压缩过程中崩溃可能导致快照已包含部分记录。
+    """
+    kind = STORAGE_BACKEND_WAL
+
+    def __init__(self, file_path, compact_every=200, fsync=False):
+        self.file_path = file_path
+        self.wal_path = f"{file_path}.wal"
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.records_since_compaction = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        snapshot = None
+        if os.path.exists(self.file_path):
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        records = []
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path, "r", encoding="utf-8") as f:
+                for line_no, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # A torn tail write from a crash; everything before it is intact
+                        print(f"WalFileBackend: Ignoring corrupt WAL record at {self.wal_path}:{line_no} and everything after it.")
+                        break
+        self.records_since_compaction = len(records)
+        return snapshot, records
+
+    def save(self, records, build_snapshot):
+        """records 为 None 表示需要完整快照（例如无法描述为增量的变更）"""
+        with self._lock:
+            if records is None or self.records_since_compaction + len(records) >= self.compact_every:
+                self._compact_locked(build_snapshot())
+                return
+            if not records:
+                return
+            ensure_directory_exists(self.wal_path)
+            with open(self.wal_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False))
+                    f.write("\n")
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            self.records_since_compaction += len(records)
+
+    def compact(self, snapshot):
+        with self._lock:
+            self._compact_locked(snapshot)
+
+    def _compact_locked(self, snapshot):
+        write_json_atomic(self.file_path, snapshot)
+        if os.path.exists(self.wal_path):
+            os.remove(self.wal_path)
+        self.records_since_compaction = 0
+
+
+def create_storage_backend(file_path, backend=STORAGE_BACKEND_JSON, **options):
+    """
+    根据名称创建存储后端，也可以直接传入已构造的后端实例。
+    - "json": JsonFileBackend（默认，兼容原有行为）
+    - "wal": WalFileBackend，options 可包含 compact_every / fsync
+    """
+    if not isinstance(backend, str):
+        return backend
+    if backend == STORAGE_BACKEND_JSON:
+        return JsonFileBackend(file_path, **options)
+    if backend == STORAGE_BACKEND_WAL:
+        return WalFileBackend(file_path, **options)
+    raise ValueError(f"Unknown storage backend: {backend}")
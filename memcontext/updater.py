@@ -2,8 +2,8 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from .utils import (
     generate_id, get_timestamp,
-    gpt_generate_multi_summary, check_conversation_continuity, generate_page_meta_info, OpenAIClient,
-    run_parallel_tasks
+    gpt_generate_multi_summary, check_conversation_continuity, generate_page_meta_info, gpt_batch_migration, OpenAIClient,
+    run_parallel_tasks, has_embedding
 )
 from .short_term import ShortTermMemory
 from .mid_term import MidTermMemory
@@ -16,7 +16,8 @@ class Updater:
                  long_term_memory: LongTermMemory, 
                  client: OpenAIClient,
                  topic_similarity_threshold=0.5,
-                 llm_model="gpt-4o-mini"):
+                 llm_model="gpt-4o-mini",
+                 batch_migration=True):
         self.short_term_memory = short_term_memory
         self.mid_term_memory = mid_term_memory
         self.long_term_memory = long_term_memory
@@ -24,18 +25,20 @@ class Updater:
         self.topic_similarity_threshold = topic_similarity_threshold
         self.last_evicted_page_for_continuity = None # Tracks the actual last page object for continuity checks
         self.llm_model = llm_model
+        # One structured LLM call per evicted window instead of 2 calls per page + 1 summary call
+        self.batch_migration = batch_migration
 
     def _process_page_embedding_and_keywords(self, page_data):
         """处理单个页面的embedding生成（关键词由multi-summary提供）"""
         page_id = page_data.get("page_id", generate_id("page"))
         
         # 检查是否已有embedding
-        if "page_embedding" in page_data and page_data["page_embedding"]:
+        if has_embedding(page_data.get("page_embedding")):
             print(f"Updater: Page {page_id} already has embedding, skipping computation")
             return page_data
         
         # 只处理embedding，关键词由multi-summary统一提供
-        if not ("page_embedding" in page_data and page_data["page_embedding"]):
+        if not has_embedding(page_data.get("page_embedding")):
             full_text = f"User: {page_data.get('user_input','')} Assistant: {page_data.get('agent_response','')}"
             try:
                 embedding = self._get_embedding_for_page(full_text)
@@ -80,6 +83,7 @@ class Updater:
             page = self.mid_term_memory.get_page_by_id(current_page_id)
             if page:
                 page["meta_info"] = new_meta_info
+                self.mid_term_memory.mark_page_dirty(current_page_id)
                 # Check previous page
                 prev_id = page.get("pre_page")
                 if prev_id and prev_id not in visited:
@@ -93,6 +97,44 @@ class Updater:
         if q: # If any pages were updated
             self.mid_term_memory.save() # Save mid-term memory after updates
 
+    def _link_pages(self, pages, decisions=None):
+        """
+        按顺序为新 page 建立 pre_page 链接并设置 meta_info。
+        decisions 为批量调用给出的 [(is_continuous, meta_info), ...]；为 None 时逐页调用 LLM 判断连续性并生成 meta_info。
+        """
+        temp_last_page_in_batch = self.last_evicted_page_for_continuity # Carry over from previous batch if any
+        for i, current_page_obj in enumerate(pages):
+            if decisions is None:
+                is_continuous = check_conversation_continuity(temp_last_page_in_batch, current_page_obj, self.client, model=self.llm_model)
+            else:
+                is_continuous, new_meta = decisions[i]
+            
+            if is_continuous and temp_last_page_in_batch:
+                current_page_obj["pre_page"] = temp_last_page_in_batch["page_id"]
+                # The actual next_page for temp_last_page_in_batch will be set when it's stored in mid-term
+                # or if it's already there, it needs an update. This linking is tricky.
+                # For now, we establish the link from current to previous.
+                # MidTermMemory's update_page_connections can fix the other side if pages are already there.
+                
+                # Meta info generation based on continuity
+                if decisions is None:
+                    last_meta = temp_last_page_in_batch.get("meta_info")
+                    new_meta = generate_page_meta_info(last_meta, current_page_obj, self.client, model=self.llm_model)
+                current_page_obj["meta_info"] = new_meta
+                # If temp_last_page_in_batch was part of a chain, its meta_info and subsequent ones should update.
+                # This implies that meta_info should perhaps be updated more globally or propagated.
+                # For now, new_meta applies to current_page_obj and potentially its chain.
+                # We can call _update_linked_pages_meta_info if temp_last_page_in_batch is in mid-term already.
+                if temp_last_page_in_batch.get("page_id") and self.mid_term_memory.get_page_by_id(temp_last_page_in_batch["page_id"]):
+                    self._update_linked_pages_meta_info(temp_last_page_in_batch["page_id"], new_meta)
+            else:
+                # Start of a new chain or no previous page
+                if decisions is None:
+                    new_meta = generate_page_meta_info(None, current_page_obj, self.client, model=self.llm_model)
+                current_page_obj["meta_info"] = new_meta
+            
+            temp_last_page_in_batch = current_page_obj # Update for the next iteration in this batch
+
     def process_short_term_to_mid_term(self):
         evicted_qas = []
         while self.short_term_memory.is_full():
@@ -108,8 +150,6 @@ class Updater:
         
         # 1. Create page structures and handle continuity within the evicted batch
         current_batch_pages = []
-        temp_last_page_in_batch = self.last_evicted_page_for_continuity # Carry over from previous batch if any
-
         for qa_pair in evicted_qas:
             # 原代码（已注释）：
             # current_page_obj = {
@@ -137,33 +177,25 @@ class Updater:
                 "meta_info": None,
                 "meta_data": qa_pair.get("meta_data", {})  # 保留 meta_data，包含视频元数据信息
             }
-            
-            is_continuous = check_conversation_continuity(temp_last_page_in_batch, current_page_obj, self.client, model=self.llm_model)
-            
-            if is_continuous and temp_last_page_in_batch:
-                current_page_obj["pre_page"] = temp_last_page_in_batch["page_id"]
-                # The actual next_page for temp_last_page_in_batch will be set when it's stored in mid-term
-                # or if it's already there, it needs an update. This linking is tricky.
-                # For now, we establish the link from current to previous.
-                # MidTermMemory's update_page_connections can fix the other side if pages are already there.
-                
-                # Meta info generation based on continuity
-                last_meta = temp_last_page_in_batch.get("meta_info")
-                new_meta = generate_page_meta_info(last_meta, current_page_obj, self.client, model=self.llm_model)
-                current_page_obj["meta_info"] = new_meta
-                # If temp_last_page_in_batch was part of a chain, its meta_info and subsequent ones should update.
-                # This implies that meta_info should perhaps be updated more globally or propagated.
-                # For now, new_meta applies to current_page_obj and potentially its chain.
-                # We can call _update_linked_pages_meta_info if temp_last_page_in_batch is in mid-term already.
-                if temp_last_page_in_batch.get("page_id") and self.mid_term_memory.get_page_by_id(temp_last_page_in_batch["page_id"]):
-                    self._update_linked_pages_meta_info(temp_last_page_in_batch["page_id"], new_meta)
-            else:
-                # Start of a new chain or no previous page
-                current_page_obj["meta_info"] = generate_page_meta_info(None, current_page_obj, self.client, model=self.llm_model)
-            
             current_batch_pages.append(current_page_obj)
-            temp_last_page_in_batch = current_page_obj # Update for the next iteration in this batch
-        
+
+        multi_summary_result = None
+        batch_result = None
+        if self.batch_migration:
+            try:
+                batch_result = gpt_batch_migration(self.last_evicted_page_for_continuity, current_batch_pages,
+                                                   self.client, model=self.llm_model)
+            except Exception as e:
+                print(f"Updater: Batched migration call failed: {e}")
+        if batch_result is not None:
+            self._link_pages(current_batch_pages, [(item["continuous"], item["meta_info"]) for item in batch_result["pages"]])
+            if batch_result["summaries"] is not None:
+                multi_summary_result = {"summaries": batch_result["summaries"]}
+        else:
+            if self.batch_migration:
+                print("Updater: Falling back to per-page continuity and meta info calls.")
+            self._link_pages(current_batch_pages)
+
         # Update the global last evicted page for the next run of this method
         if current_batch_pages:
             self.last_evicted_page_for_continuity = current_batch_pages[-1]
@@ -177,8 +209,9 @@ class Updater:
             for p in current_batch_pages
         ])
         
-        print("Updater: Generating multi-topic summary for the evicted batch...")
-        multi_summary_result = gpt_generate_multi_summary(input_text_for_summary, self.client, model=self.llm_model)
+        if multi_summary_result is None: # Not already produced by the batched call
+            print("Updater: Generating multi-topic summary for the evicted batch...")
+            multi_summary_result = gpt_generate_multi_summary(input_text_for_summary, self.client, model=self.llm_model)
         
         # 3. Insert pages into MidTermMemory based on summaries
         if multi_summary_result and multi_summary_result.get("summaries"):
@@ -235,16 +268,12 @@ class Updater:
         user_private_knowledge = profile_analysis_result.get("private")
         if user_private_knowledge and user_private_knowledge.lower() != "none":
             print(f"Updater: Adding user private knowledge for {user_id} to LongTermMemory.")
-            # Split if multiple lines, assuming each line is a distinct piece of knowledge
-            for line in user_private_knowledge.split('\n'):
-                if line.strip() and line.strip().lower() not in ["none", "- none", "- none."]:
-                    self.long_term_memory.add_user_knowledge(line.strip()) 
+            # Split if multiple lines, assuming each line is a distinct piece of knowledge; written in one batch
+            self.long_term_memory.add_user_knowledge_batch(user_private_knowledge.split('\n'))
 
         assistant_knowledge_text = profile_analysis_result.get("assistant_knowledge")
         if assistant_knowledge_text and assistant_knowledge_text.lower() != "none":
             print("Updater: Adding assistant knowledge to LongTermMemory.")
-            for line in assistant_knowledge_text.split('\n'):
-                if line.strip() and line.strip().lower() not in ["none", "- none", "- none."]:
-                    self.long_term_memory.add_assistant_knowledge(line.strip())
+            self.long_term_memory.add_assistant_knowledge_batch(assistant_knowledge_text.split('\n'))
 
-        # LongTermMemory.save() is called by its add/update methods 
\ No newline at end of file
+        # LongTermMemory.save() is called by its add/update methods, once per knowledge batch 
\ No newline at end of file
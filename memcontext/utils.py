@@ -8,10 +8,15 @@ import os
 import inspect
 import requests
 from functools import wraps
+from contextlib import nullcontext
 from . import prompts
-from openai import OpenAI
+from .embedding_cache import EmbeddingCache
+from .llm_cache import LLMResponseCache
+from openai import OpenAI, AsyncOpenAI
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
+import asyncio
+import weakref
 
 def clean_reasoning_model_output(text):
     """
@@ -31,31 +36,82 @@ def clean_reasoning_model_output(text):
     
     return cleaned_text
 
+# 进程内共享的 LLM 响应缓存：条目数限制的 LRU + TTL，可通过 configure_llm_response_cache 启用 SQLite 磁盘层
+_llm_response_cache = LLMResponseCache()
+
+def configure_llm_response_cache(max_entries=None, ttl=None, disk_path=None, replace=True):
+    """
+    配置进程内共享的 LLM 响应缓存。
+    :param max_entries: 内存层条目数上限，None 表示不修改。
+    :param ttl: 过期秒数，None 表示不修改。
+    :param disk_path: SQLite 磁盘层文件路径，None 表示不修改。
+    :param replace: 为 False 时只在尚未启用磁盘层时启用，不替换已有的磁盘层。
+    """
+    if max_entries is not None:
+        _llm_response_cache.max_entries = max_entries
+    if ttl is not None:
+        _llm_response_cache.ttl = ttl
+    if disk_path:
+        _llm_response_cache.attach_disk(disk_path, replace=replace)
+    return _llm_response_cache
+
+def get_llm_response_cache():
+    return _llm_response_cache
+
 # ---- OpenAI Client ----
 class OpenAIClient:
-    def __init__(self, api_key, base_url=None, max_workers=5):
+    def __init__(self, api_key, base_url=None, max_workers=5, executor=None, concurrency_limiter=None, use_response_cache=True):
+        """
+        executor: 共享线程池（例如 MemcontextRuntime 提供），为 None 时自建 max_workers 个线程
+        concurrency_limiter: 共享的信号量，限制同时进行的 LLM 请求数
+        use_response_cache: 是否使用进程内共享的 LLM 响应缓存（见 chat_completion 的 cache 参数）
+        """
         self.api_key = api_key
         self.base_url = base_url if base_url else "https://api.openai.com/v1"
         # The openai library looks for OPENAI_API_KEY and OPENAI_BASE_URL env vars by default
         # or they can be passed directly to the client.
         # For simplicity and explicit control, we'll pass them to the client constructor.
         self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._owns_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=max_workers)
+        self.concurrency_limiter = concurrency_limiter
         self._lock = threading.Lock()
+        self.in_flight = 0 # Requests currently waiting on the API, used to detect a saturated backend
+        self.use_response_cache = use_response_cache
 
-    def chat_completion(self, model, messages, temperature=0.7, max_tokens=2000, stream=False):
+    def chat_completion(self, model, messages, temperature=0.7, max_tokens=2000, stream=False, cache=None, validate=None):
         """
         增加 stream 参数支持流式输出
+        cache: 是否读写响应缓存；None 时只缓存确定性请求（temperature == 0），流式请求从不缓存
+        validate: 可选的 callable(content) -> bool；不通过的回复不写入缓存，命中但不通过的缓存条目被删除并重新请求
         """
+        cache_key = None
+        if not stream and self.use_response_cache and (cache if cache is not None else temperature == 0):
+            cache_key = LLMResponseCache.make_key(self.base_url, model, messages, temperature=temperature, max_tokens=max_tokens)
+            cached = _llm_response_cache.get(cache_key)
+            if cached is not None and (validate is None or validate(cached)):
+                print(f"OpenAI response cache hit. Model: {model}")
+                return cached
+            if cached is not None:
+                print(f"OpenAI response cache: Evicting a cached reply that failed validation. Model: {model}")
+                _llm_response_cache.delete(cache_key)
         print(f"Calling OpenAI API. Model: {model} (Stream: {stream})")
         try:
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                stream=stream  # 传 stream 参数
-            )
+            # For streams the limit covers opening the request, not consuming the chunks
+            with self._lock:
+                self.in_flight += 1
+            try:
+                with self.concurrency_limiter if self.concurrency_limiter is not None else nullcontext():
+                    response = self.client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        stream=stream  # 传 stream 参数
+                    )
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
             
             # 如果是流式，直接返回生成器对象，不要去读取 content
             if stream:
@@ -64,6 +120,8 @@ class OpenAIClient:
             # 如果不是流式，保持原有逻辑
             raw_content = response.choices[0].message.content.strip()
             cleaned_content = clean_reasoning_model_output(raw_content)
+            if cache_key is not None and (validate is None or validate(cleaned_content)):
+                _llm_response_cache.put(cache_key, cleaned_content) # Error replies below are never cached
             return cleaned_content
             
         except Exception as e:
@@ -101,8 +159,55 @@ class OpenAIClient:
         return results
 
     def shutdown(self):
-        """关闭线程池"""
-        self.executor.shutdown(wait=True)
+        """关闭线程池（共享线程池由其所有者关闭）"""
+        if self._owns_executor:
+            self.executor.shutdown(wait=True)
+
+class AsyncOpenAIClient:
+    """
+    OpenAIClient 的 asyncio 版本，基于 AsyncOpenAI。
+    供 aget_response / aget_response_stream 使用，单个事件循环即可并发大量请求。
+    """
+    def __init__(self, api_key, base_url=None, max_concurrency=None):
+        self.api_key = api_key
+        self.base_url = base_url if base_url else "https://api.openai.com/v1"
+        self.client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+        self.max_concurrency = max_concurrency
+        self._semaphores = weakref.WeakKeyDictionary() # asyncio primitives are bound to one event loop
+
+    def _limiter(self):
+        if not self.max_concurrency:
+            return nullcontext()
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    async def chat_completion(self, model, messages, temperature=0.7, max_tokens=2000, stream=False):
+        """stream=True 时返回 async 迭代器，否则返回清理后的文本"""
+        print(f"Calling OpenAI API (async). Model: {model} (Stream: {stream})")
+        try:
+            async with self._limiter():
+                response = await self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=stream
+                )
+            if stream:
+                return response
+            raw_content = response.choices[0].message.content.strip()
+            return clean_reasoning_model_output(raw_content)
+        except Exception as e:
+            if stream:
+                raise # Callers of the stream handle errors (same as iterating a failed sync stream)
+            print(f"Error calling OpenAI API: {e}")
+            return "Error: Could not get response from LLM."
+
+    async def close(self):
+        await self.client.close()
 
 # ---- Parallel Processing Utilities ----
 def run_parallel_tasks(tasks, max_workers=3):
@@ -123,8 +228,18 @@ def run_parallel_tasks(tasks, max_workers=3):
         return results
 
 # ---- Basic Utilities ----
-def get_timestamp():
-    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def get_timestamp(epoch=None):
+    """本地时间显示字符串；epoch 为 None 时取当前时间"""
+    return time.strftime(TIMESTAMP_FORMAT, time.localtime(epoch))
+
+def parse_timestamp(timestamp_str):
+    """把 get_timestamp() 格式的字符串转换为 epoch 秒，无法解析时返回 None"""
+    try:
+        return time.mktime(time.strptime(timestamp_str, TIMESTAMP_FORMAT))
+    except (TypeError, ValueError, OverflowError):
+        return None
 
 def generate_id(prefix="id"):
     return f"{prefix}_{uuid.uuid4().hex[:8]}"
@@ -134,7 +249,8 @@ def ensure_directory_exists(path):
 
 # ---- Embedding Utilities ----
 _model_cache = {}
-_embedding_cache = {}  # 添加embedding缓存
+# 进程内共享的 embedding 缓存：按字节数限制的 LRU，可通过 configure_embedding_cache 启用 SQLite 磁盘层
+_embedding_cache = EmbeddingCache()
 
 def _get_valid_kwargs(func, kwargs):
     """Helper to filter kwargs for a given function's signature."""
@@ -146,6 +262,142 @@ def _get_valid_kwargs(func, kwargs):
         # Fallback for functions/methods where signature inspection is not straightforward
         return kwargs
 
+# 远程 embedding 接口单次请求的最大文本数
+EMBEDDING_API_BATCH_SIZE = 32
+
+def _is_doubao_bge_embedding(model_name):
+    return ('doubao'  in model_name.lower() and 'embedding' in model_name.lower())  or 'bge' in model_name.lower()
+
+def _remote_embedding_config(model_name, kwargs):
+    """
+    远程 embedding 接口配置 (endpoint, api_key, model, timeout)；本地模型返回 None。
+    - 豆包 / bge 模型：EMBEDDING_BASE_URL(/LLM_BASE_URL) + /embeddings
+    - use_siliconflow=True：siliconflow_endpoint / siliconflow_api_key 等参数（向后兼容）
+    """
+    if _is_doubao_bge_embedding(model_name):
+        embedding_api_key = os.environ.get('EMBEDDING_API_KEY') or os.environ.get('LLM_API_KEY', '')
+        embedding_base_url = os.environ.get('EMBEDDING_BASE_URL') or os.environ.get('LLM_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3')
+        if not embedding_api_key:
+            raise RuntimeError("豆包 Embedding API Key 未配置，请设置 EMBEDDING_API_KEY 或 LLM_API_KEY 环境变量")
+        return f"{embedding_base_url}/embeddings", embedding_api_key, model_name, 60.0
+    if kwargs.get("use_siliconflow", False):
+        siliconflow_api_key = kwargs.get("siliconflow_api_key", os.environ.get("SILICONFLOW_API_KEY"))
+        if not siliconflow_api_key:
+            raise RuntimeError("SILICONFLOW_API_KEY 未配置，无法调用远程 embedding。")
+        return (
+            kwargs.get("siliconflow_endpoint", os.environ.get("SILICONFLOW_EMBEDDING_ENDPOINT", "https://api.siliconflow.cn/v1/embeddings")),
+            siliconflow_api_key,
+            kwargs.get("siliconflow_model", model_name),
+            kwargs.get("siliconflow_timeout", 60.0),
+        )
+    return None
+
+def _embedding_request(texts, api_key, model):
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "model": model,
+        "input": list(texts),
+        "encoding_format": "float"
+    }
+    return headers, payload
+
+def _parse_embedding_response(result, expected_count):
+    if not result.get("data") or len(result["data"]) != expected_count:
+        raise RuntimeError(f"Embedding 接口返回数据为空或数量不匹配: {result}")
+    # OpenAI-compatible APIs may return items out of order; "index" restores the input order
+    data = sorted(result["data"], key=lambda item: item.get("index", 0))
+    return np.array([item["embedding"] for item in data], dtype=np.float32)
+
+def _post_embeddings(texts, endpoint, api_key, model, timeout):
+    """一次 HTTP 请求计算多条文本的 embedding"""
+    headers, payload = _embedding_request(texts, api_key, model)
+    response = requests.post(endpoint, headers=headers, json=payload, timeout=timeout)
+    response.raise_for_status()
+    return _parse_embedding_response(response.json(), len(texts))
+
+async def _apost_embeddings(http_client, texts, endpoint, api_key, model, timeout):
+    headers, payload = _embedding_request(texts, api_key, model)
+    response = await http_client.post(endpoint, headers=headers, json=payload, timeout=timeout)
+    response.raise_for_status()
+    return _parse_embedding_response(response.json(), len(texts))
+
+def _load_embedding_model(model_name, kwargs):
+    model_init_key = json.dumps({"model_name": model_name, **{k:v for k,v in kwargs.items() if k not in ['batch_size', 'max_length']}}, sort_keys=True)
+    if model_init_key not in _model_cache:
+        print(f"Loading model: {model_name}...")
+        if 'bge-m3' in model_name.lower():
+            try:
+                from FlagEmbedding import BGEM3FlagModel
+                init_kwargs = _get_valid_kwargs(BGEM3FlagModel.__init__, kwargs)
+                print(f"-> Using BGEM3FlagModel with init kwargs: {init_kwargs}")
+                _model_cache[model_init_key] = BGEM3FlagModel(model_name,device='cpu', **init_kwargs)
+            except ImportError:
+                raise ImportError("Please install FlagEmbedding: 'pip install -U FlagEmbedding' to use bge-m3 model.")
+        else: # Default handler for SentenceTransformer-based models (like Qwen, all-MiniLM, etc.)
+            try:
+                from sentence_transformers import SentenceTransformer
+                init_kwargs = _get_valid_kwargs(SentenceTransformer.__init__, kwargs)
+                print(f"-> Using SentenceTransformer with init kwargs: {init_kwargs}")
+                _model_cache[model_init_key] = SentenceTransformer(model_name,device='cpu', **(init_kwargs))
+            except ImportError:
+                raise ImportError("Please install sentence-transformers: 'pip install -U sentence-transformers' to use this model.")
+    return _model_cache[model_init_key]
+
+def _encode_local(texts, model_name, batch_size, kwargs):
+    """使用本地 SentenceTransformer / BGEM3 模型一次 encode 多条文本"""
+    kwargs = {k: v for k, v in kwargs.items() if k != "use_siliconflow" and not k.startswith("siliconflow_")}
+    # --- Model Loading ---
+    model = _load_embedding_model(model_name, kwargs)
+    
+    # --- Encoding ---
+    encode_kwargs = _get_valid_kwargs(model.encode, kwargs)
+    if batch_size:
+        encode_kwargs.update(_get_valid_kwargs(model.encode, {"batch_size": batch_size}))
+    if 'bge-m3' in model_name.lower():
+        print(f"-> Encoding {len(texts)} text(s) with BGEM3FlagModel using kwargs: {encode_kwargs}")
+        result = model.encode(list(texts), **encode_kwargs)
+        return np.asarray(result['dense_vecs'], dtype=np.float32)
+    # Default to SentenceTransformer-based models
+    print(f"-> Encoding {len(texts)} text(s) with SentenceTransformer using kwargs: {encode_kwargs}")
+    return np.asarray(model.encode(list(texts), **encode_kwargs), dtype=np.float32)
+
+def _encode_texts(texts, model_name, batch_size=None, **kwargs):
+    """
+    不经过缓存地计算一组文本的 embedding，返回 (n, d) float32 矩阵。
+    远程接口按 batch_size（默认 EMBEDDING_API_BATCH_SIZE）分批请求；本地模型一次 encode，由模型内部按 batch_size 分批。
+    """
+    remote = _remote_embedding_config(model_name, kwargs)
+    if remote is None:
+        return _encode_local(texts, model_name, batch_size, kwargs)
+    step = batch_size or EMBEDDING_API_BATCH_SIZE
+    return np.vstack([_post_embeddings(texts[i:i + step], *remote) for i in range(0, len(texts), step)])
+
+_async_http_clients = weakref.WeakKeyDictionary() # httpx.AsyncClient is bound to the event loop it was first used on
+
+def _get_async_http_client():
+    """当前事件循环共用的 httpx.AsyncClient，复用连接池，避免每次请求 embedding 都重新建立连接"""
+    import httpx
+    loop = asyncio.get_running_loop()
+    http_client = _async_http_clients.get(loop)
+    if http_client is None or http_client.is_closed:
+        http_client = _async_http_clients[loop] = httpx.AsyncClient()
+    return http_client
+
+async def _aencode_texts(texts, model_name, batch_size=None, **kwargs):
+    """_encode_texts 的 asyncio 版本：远程接口用 httpx 异步并发请求，本地模型在线程池中 encode"""
+    remote = _remote_embedding_config(model_name, kwargs)
+    if remote is None:
+        return await asyncio.to_thread(_encode_local, texts, model_name, batch_size, kwargs)
+    step = batch_size or EMBEDDING_API_BATCH_SIZE
+    http_client = _get_async_http_client()
+    chunks = await asyncio.gather(*[
+        _apost_embeddings(http_client, texts[i:i + step], *remote) for i in range(0, len(texts), step)
+    ])
+    return np.vstack(chunks)
+
 def get_embedding(text, model_name="all-MiniLM-L6-v2", use_cache=True, **kwargs):
     """
     获取文本的embedding向量。
@@ -164,112 +416,95 @@ def get_embedding(text, model_name="all-MiniLM-L6-v2", use_cache=True, **kwargs)
     model_config_key = json.dumps({"model_name": model_name, **kwargs}, sort_keys=True)
     
     if use_cache:
-        cache_key = f"{model_config_key}::{hash(text)}"
-        if cache_key in _embedding_cache:
-            return _embedding_cache[cache_key]
-    
-    # 检查是否是豆包 embedding 模型（通过模型名称判断）
-    is_doubao_bge_embedding = ('doubao'  in model_name.lower() and 'embedding' in model_name.lower())  or 'bge' in model_name.lower()
+        cache_key = EmbeddingCache.make_key(model_config_key, text)
+        cached = _embedding_cache.get(cache_key)
+        if cached is not None:
+            return cached
     
-    if is_doubao_bge_embedding:
-        # 使用豆包或者siliconflow的 embedding API
-        embedding_api_key = os.environ.get('EMBEDDING_API_KEY') or os.environ.get('LLM_API_KEY', '')
-        embedding_base_url = os.environ.get('EMBEDDING_BASE_URL') or os.environ.get('LLM_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3')
-        
-        if not embedding_api_key:
-            raise RuntimeError("豆包 Embedding API Key 未配置，请设置 EMBEDDING_API_KEY 或 LLM_API_KEY 环境变量")
-        
-        # 使用同步方式调用（因为 get_embedding 是同步函数）
-        import requests
-        response = requests.post(
-            f"{embedding_base_url}/embeddings",
-            headers={
-                "Authorization": f"Bearer {embedding_api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": model_name,
-                "input": [text],
-                "encoding_format": "float"
-            },
-            timeout=60.0
-        )
-        response.raise_for_status()
-        result = response.json()
-        if not result.get("data"):
-            raise RuntimeError(f"豆包 embedding 返回数据为空: {result}")
-        embedding = np.array(result["data"][0]["embedding"], dtype=np.float32)
-    else:
-        # 保留原有的 siliconflow 和本地模型逻辑（向后兼容）
-        use_siliconflow = kwargs.pop("use_siliconflow", False)
-        if use_siliconflow:
-            siliconflow_api_key = kwargs.pop("siliconflow_api_key", os.environ.get("SILICONFLOW_API_KEY"))
-            siliconflow_model = kwargs.pop("siliconflow_model", model_name)
-            siliconflow_endpoint = kwargs.pop("siliconflow_endpoint", os.environ.get("SILICONFLOW_EMBEDDING_ENDPOINT", "https://api.siliconflow.cn/v1/embeddings"))
-            siliconflow_timeout = kwargs.pop("siliconflow_timeout", 60.0)
-            embedding = _call_siliconflow_embedding(
-                text,
-                model=siliconflow_model,
-                api_key=siliconflow_api_key,
-                endpoint=siliconflow_endpoint,
-                timeout=siliconflow_timeout,
-            )
-        else:
-            # --- Model Loading ---
-            model_init_key = json.dumps({"model_name": model_name, **{k:v for k,v in kwargs.items() if k not in ['batch_size', 'max_length']}}, sort_keys=True)
-            if model_init_key not in _model_cache:
-                print(f"Loading model: {model_name}...")
-                if 'bge-m3' in model_name.lower():
-                    try:
-                        from FlagEmbedding import BGEM3FlagModel
-                        init_kwargs = _get_valid_kwargs(BGEM3FlagModel.__init__, kwargs)
-                        print(f"-> Using BGEM3FlagModel with init kwargs: {init_kwargs}")
-                        _model_cache[model_init_key] = BGEM3FlagModel(model_name,device='cpu', **init_kwargs)
-                    except ImportError:
-                        raise ImportError("Please install FlagEmbedding: 'pip install -U FlagEmbedding' to use bge-m3 model.")
-                else: # Default handler for SentenceTransformer-based models (like Qwen, all-MiniLM, etc.)
-                    try:
-                        from sentence_transformers import SentenceTransformer
-                        init_kwargs = _get_valid_kwargs(SentenceTransformer.__init__, kwargs)
-                        print(f"-> Using SentenceTransformer with init kwargs: {init_kwargs}")
-                        _model_cache[model_init_key] = SentenceTransformer(model_name,device='cpu', **(init_kwargs))
-                    except ImportError:
-                        raise ImportError("Please install sentence-transformers: 'pip install -U sentence-transformers' to use this model.")
-                    
-            model = _model_cache[model_init_key]
-            
-            # --- Encoding ---
-            if 'bge-m3' in model_name.lower():
-                encode_kwargs = _get_valid_kwargs(model.encode, kwargs)
-                print(f"-> Encoding with BGEM3FlagModel using kwargs: {encode_kwargs}")
-                result = model.encode([text], **encode_kwargs)
-                embedding = result['dense_vecs'][0]
-            else: # Default to SentenceTransformer-based models
-                encode_kwargs = _get_valid_kwargs(model.encode, kwargs)
-                print(f"-> Encoding with SentenceTransformer using kwargs: {encode_kwargs}")
-                embedding = model.encode([text], **encode_kwargs)[0]
+    embedding = _encode_texts([text], model_name, **kwargs)[0]
 
     if use_cache:
-        cache_key = f"{model_config_key}::{hash(text)}"
-        _embedding_cache[cache_key] = embedding
-        if len(_embedding_cache) > 10000:
-            keys_to_remove = list(_embedding_cache.keys())[:1000]
-            for key in keys_to_remove:
-                try:
-                    del _embedding_cache[key]
-                except KeyError:
-                    pass
-            print("Cleaned embedding cache to prevent memory overflow")
+        embedding = _embedding_cache.put(cache_key, embedding)
     
     return embedding
 
+def get_embeddings(texts, model_name="all-MiniLM-L6-v2", use_cache=True, batch_size=None, **kwargs):
+    """
+    批量获取 embedding，返回 (n, d) float32 矩阵，行顺序与 texts 一致。
+    缓存命中与重复文本只计算一次；其余文本按 provider 分批请求（远程接口每批
+    batch_size 条，默认 EMBEDDING_API_BATCH_SIZE），本地模型以 batch_size 一次 encode。
+
+    :param texts: 文本列表。
+    :param batch_size: 每批文本数；None 时远程接口使用 EMBEDDING_API_BATCH_SIZE，本地模型使用其默认值。
+    其余参数同 get_embedding，缓存与 get_embedding 共享。
+    """
+    texts = list(texts)
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    keys, resolved, pending = _lookup_cached_embeddings(texts, model_name, use_cache, kwargs)
+    if pending:
+        vectors = _encode_texts(pending, model_name, batch_size=batch_size, **kwargs)
+        _store_computed_embeddings(keys, resolved, pending, vectors, use_cache)
+    return np.vstack([np.asarray(resolved[text], dtype=np.float32) for text in texts])
+
+async def aget_embeddings(texts, model_name="all-MiniLM-L6-v2", use_cache=True, batch_size=None, **kwargs):
+    """get_embeddings 的 asyncio 版本，缓存与同步版本共享"""
+    texts = list(texts)
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    keys, resolved, pending = _lookup_cached_embeddings(texts, model_name, use_cache, kwargs)
+    if pending:
+        vectors = await _aencode_texts(pending, model_name, batch_size=batch_size, **kwargs)
+        _store_computed_embeddings(keys, resolved, pending, vectors, use_cache)
+    return np.vstack([np.asarray(resolved[text], dtype=np.float32) for text in texts])
+
+async def aget_embedding(text, model_name="all-MiniLM-L6-v2", use_cache=True, **kwargs):
+    """get_embedding 的 asyncio 版本"""
+    return (await aget_embeddings([text], model_name=model_name, use_cache=use_cache, **kwargs))[0]
+
+def _lookup_cached_embeddings(texts, model_name, use_cache, kwargs):
+    """返回 (keys, resolved, pending)：缓存 key、已命中的 {text: vec}、需要计算的去重文本"""
+    model_config_key = json.dumps({"model_name": model_name, **kwargs}, sort_keys=True)
+    resolved = {}
+    keys = {}
+    if use_cache:
+        keys = {text: EmbeddingCache.make_key(model_config_key, text) for text in texts}
+        cached = _embedding_cache.get_many(keys.values())
+        resolved = {text: cached[key] for text, key in keys.items() if key in cached}
+    pending = list(dict.fromkeys(text for text in texts if text not in resolved))
+    return keys, resolved, pending
+
+def _store_computed_embeddings(keys, resolved, pending, vectors, use_cache):
+    resolved.update(zip(pending, vectors))
+    if use_cache:
+        _embedding_cache.put_many((keys[text], vec) for text, vec in zip(pending, vectors))
+
 
-def clear_embedding_cache():
-    """清空embedding缓存"""
-    global _embedding_cache
-    _embedding_cache.clear()
+def configure_embedding_cache(max_bytes=None, disk_path=None, replace=True):
+    """
+    配置进程内共享的 embedding 缓存。
+    :param max_bytes: 内存层容量（字节），None 表示不修改。
+    :param disk_path: SQLite 磁盘层文件路径，None 表示不修改。
+    :param replace: 为 False 时只在尚未启用磁盘层时启用，不替换已有的磁盘层。
+    """
+    if max_bytes is not None:
+        _embedding_cache.max_bytes = max_bytes
+    if disk_path:
+        _embedding_cache.attach_disk(disk_path, replace=replace)
+    return _embedding_cache
+
+def get_embedding_cache():
+    return _embedding_cache
+
+def clear_embedding_cache(disk=False):
+    """清空embedding缓存（disk=True 时同时清空磁盘层）"""
+    _embedding_cache.clear(disk=disk)
     print("Embedding cache cleared")
 
+def has_embedding(vec):
+    """判断 embedding 是否存在（兼容 list 与 numpy 数组，数组不能直接做真值判断）"""
+    return vec is not None and len(vec) > 0
+
 def normalize_vector(vec):
     vec = np.array(vec, dtype=np.float32)
     norm = np.linalg.norm(vec)
@@ -277,37 +512,15 @@ def normalize_vector(vec):
         return vec
     return vec / norm
 
-def _call_siliconflow_embedding(text, model, api_key, endpoint, timeout=60.0):
-    if not api_key:
-        raise RuntimeError("SILICONFLOW_API_KEY 未配置，无法调用远程 embedding。")
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "model": model,
-        "input": [text],
-        "encoding_format": "float"
-    }
-    response = requests.post(endpoint, headers=headers, json=payload, timeout=timeout)
-    response.raise_for_status()
-    result = response.json()
-    if not result.get("data"):
-        raise RuntimeError(f"SiliconFlow embedding 返回数据为空: {result}")
-    vector = result["data"][0]["embedding"]
-    return np.array(vector, dtype=np.float32)
-
 # ---- Time Decay Function ----
-def compute_time_decay(event_timestamp_str, current_timestamp_str, tau_hours=24):
-    from datetime import datetime
-    fmt = "%Y-%m-%d %H:%M:%S"
-    try:
-        t_event = datetime.strptime(event_timestamp_str, fmt)
-        t_current = datetime.strptime(current_timestamp_str, fmt)
-        delta_hours = (t_current - t_event).total_seconds() / 3600.0
-        return np.exp(-delta_hours / tau_hours)
-    except ValueError: # Handle cases where timestamp might be invalid
+def compute_time_decay(event_timestamp, current_timestamp, tau_hours=24):
+    """时间衰减 exp(-dt/tau)；两个参数可以是 epoch 秒（推荐，免解析）或 get_timestamp() 格式的字符串"""
+    t_event = event_timestamp if isinstance(event_timestamp, (int, float)) else parse_timestamp(event_timestamp)
+    t_current = current_timestamp if isinstance(current_timestamp, (int, float)) else parse_timestamp(current_timestamp)
+    if t_event is None or t_current is None: # Handle cases where timestamp might be invalid
         return 0.1 # Default low recency
+    delta_hours = (t_current - t_event) / 3600.0
+    return float(np.exp(-delta_hours / tau_hours))
 
 
 # ---- LLM-based Utility Functions ----
@@ -443,9 +656,69 @@ def check_conversation_continuity(previous_page, current_page, client: OpenAICli
         {"role": "system", "content": prompts.CONTINUITY_CHECK_SYSTEM_PROMPT},
         {"role": "user", "content": user_prompt}
     ]
-    response = client.chat_completion(model=model, messages=messages, temperature=0.0, max_tokens=10)
+    response = client.chat_completion(model=model, messages=messages, temperature=0.0, max_tokens=10,
+                                      validate=lambda text: text.strip().lower() in ("true", "false"))
     return response.strip().lower() == "true"
 
+def _extract_json(response_text):
+    """解析 LLM 返回的 JSON，容忍 ```json 代码块包裹；失败时返回 None"""
+    text = (response_text or "").strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+def gpt_batch_migration(previous_page, pages, client: OpenAIClient, model="gpt-4o-mini"):
+    """
+    一次调用同时完成整批短期记忆迁移所需的连续性判断、链式 meta_info 和多主题摘要。
+    返回 {"pages": [{"continuous": bool, "meta_info": str}, ...]（与 pages 一一对应）, "summaries": [...] 或 None}；
+    无法解析或页数不匹配时返回 None，由调用方逐页回退。
+    """
+    if previous_page:
+        previous_text = (f"User: {previous_page.get('user_input', '')}\nAssistant: {previous_page.get('agent_response', '')}\n"
+                         f"Meta-summary: {previous_page.get('meta_info') or 'None'}")
+    else:
+        previous_text = "None"
+    pages_text = "\n\n".join(
+        f"Page {i}:\nUser: {page.get('user_input', '')}\nAssistant: {page.get('agent_response', '')}"
+        for i, page in enumerate(pages, start=1)
+    )
+    messages = [
+        {"role": "system", "content": prompts.BATCH_MIGRATION_SYSTEM_PROMPT},
+        {"role": "user", "content": prompts.BATCH_MIGRATION_USER_PROMPT.format(previous_page=previous_text, pages=pages_text)}
+    ]
+    print(f"Calling LLM for batched migration of {len(pages)} page(s)...")
+    # Unparseable replies are kept out of the response cache, otherwise the same window would fail on every retry
+    response_text = client.chat_completion(model=model, messages=messages, temperature=0.0,
+                                           validate=lambda text: _parse_batch_migration(text, len(pages))[0] is not None)
+    result, warning = _parse_batch_migration(response_text, len(pages))
+    if warning:
+        print(warning)
+    return result
+
+def _parse_batch_migration(response_text, n_pages):
+    """返回 (结果, None)，无法解析时返回 (None, 警告信息)"""
+    result = _extract_json(response_text)
+    page_results = result.get("pages") if isinstance(result, dict) else None
+    if not isinstance(page_results, list) or len(page_results) != n_pages:
+        return None, f"Warning: Could not parse batched migration JSON: {response_text}"
+    by_index = {}
+    for position, item in enumerate(page_results, start=1):
+        if not isinstance(item, dict) or not isinstance(item.get("meta_info"), str):
+            return None, f"Warning: Malformed page entry in batched migration JSON: {item}"
+        by_index[item.get("index", position)] = item
+    if sorted(by_index) != list(range(1, n_pages + 1)):
+        return None, f"Warning: Page indexes in batched migration JSON do not match the window: {response_text}"
+    summaries = result.get("summaries")
+    return {
+        "pages": [{"continuous": str(by_index[i].get("continuous")).strip().lower() == "true",
+                   "meta_info": by_index[i]["meta_info"].strip()} for i in range(1, n_pages + 1)],
+        "summaries": summaries if isinstance(summaries, list) else None
+    }, None
+
 def generate_page_meta_info(last_page_meta, current_page, client: OpenAIClient, model="gpt-4o-mini"):
     current_conversation = f"User: {current_page.get('user_input', '')}\nAssistant: {current_page.get('agent_response', '')}"
     user_prompt = prompts.META_INFO_USER_PROMPT.format(
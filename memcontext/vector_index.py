@@ -0,0 +1,266 @@
+import json
+import os
+import threading
+
+import numpy as np
+import faiss
+
+from .utils import ensure_directory_exists
+
+# Index types supported by SessionSummaryIndex
+INDEX_TYPE_FLAT = "flat"
+INDEX_TYPE_IVF = "ivf"
+INDEX_TYPE_HNSW = "hnsw"
+
+
+class SessionSummaryIndex:
+    """
+    常驻内存的 session summary 向量索引，随 MidTermMemory 的增删增量维护，
+    避免每次检索都重新构建 faiss 索引。
+
+    - index_type="flat": 精确内积检索（默认）
+    - index_type="ivf" / "hnsw": 大规模存储时使用近似检索，
+      session 数量低于 ann_min_size 时仍使用 flat，超过后自动切换
+    """
+
+    def __init__(self, index_type=INDEX_TYPE_FLAT, ann_min_size=1024, ivf_nlist=64, ivf_nprobe=8, hnsw_m=32):
+        if index_type not in (INDEX_TYPE_FLAT, INDEX_TYPE_IVF, INDEX_TYPE_HNSW):
+            raise ValueError(f"Unsupported session index type: {index_type}")
+        self.index_type = index_type
+        self.ann_min_size = ann_min_size
+        self.ivf_nlist = ivf_nlist
+        self.ivf_nprobe = ivf_nprobe
+        self.hnsw_m = hnsw_m
+
+        self.dim = None
+        self._vectors = None    # float32 matrix, row == faiss id
+        self._alive = None      # bool per row, False for removed rows
+        self._row_sids = []     # row -> session_id (None for removed rows)
+        self._sid_rows = {}     # session_id -> row
+        self._dead_rows = 0     # removed rows still occupying space (tombstones for hnsw)
+        self._index = None
+        self._active_type = INDEX_TYPE_FLAT
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._sid_rows)
+
+    def __contains__(self, session_id):
+        return session_id in self._sid_rows
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    # ---- Index construction ----
+    def _create_index(self, index_type, train_vectors=None):
+        if index_type == INDEX_TYPE_IVF:
+            nlist = max(1, min(self.ivf_nlist, len(train_vectors) // 39 if train_vectors is not None else 1))
+            quantizer = faiss.IndexFlatIP(self.dim)
+            index = faiss.IndexIVFFlat(quantizer, self.dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            index.train(train_vectors)
+            index.nprobe = min(self.ivf_nprobe, nlist)
+            return index
+        if index_type == INDEX_TYPE_HNSW:
+            return faiss.IndexIDMap2(faiss.IndexHNSWFlat(self.dim, self.hnsw_m, faiss.METRIC_INNER_PRODUCT))
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+
+    def _target_type(self, live_count):
+        if self.index_type != INDEX_TYPE_FLAT and live_count >= self.ann_min_size:
+            return self.index_type
+        return INDEX_TYPE_FLAT
+
+    def _ensure_capacity(self, rows_needed):
+        if self._vectors is None:
+            self._vectors = np.zeros((max(16, rows_needed), self.dim), dtype=np.float32)
+            self._alive = np.zeros(self._vectors.shape[0], dtype=bool)
+        elif rows_needed > self._vectors.shape[0]:
+            new_cap = max(rows_needed, self._vectors.shape[0] * 2)
+            grown = np.zeros((new_cap, self.dim), dtype=np.float32)
+            grown[:len(self._row_sids)] = self._vectors[:len(self._row_sids)]
+            self._vectors = grown
+            alive = np.zeros(new_cap, dtype=bool)
+            alive[:len(self._row_sids)] = self._alive[:len(self._row_sids)]
+            self._alive = alive
+
+    def rebuild(self, items):
+        """
+        从 (session_id, embedding) 列表全量重建索引（加载失败或碎片过多时使用）。
+        """
+        with self._lock:
+            items = [(sid, np.asarray(vec, dtype=np.float32).reshape(-1)) for sid, vec in items if vec is not None and len(vec) > 0]
+            self._row_sids = []
+            self._sid_rows = {}
+            self._dead_rows = 0
+            self._vectors = None
+            self._alive = None
+            self._index = None
+            if not items:
+                self._dirty = True
+                return
+            self.dim = items[0][1].shape[0]
+            self._ensure_capacity(len(items))
+            for row, (sid, vec) in enumerate(items):
+                self._vectors[row] = vec
+                self._alive[row] = True
+                self._row_sids.append(sid)
+                self._sid_rows[sid] = row
+            live = self._vectors[:len(items)]
+            self._active_type = self._target_type(len(items))
+            self._index = self._create_index(self._active_type, train_vectors=live)
+            self._index.add_with_ids(live, np.arange(len(items), dtype=np.int64))
+            self._dirty = True
+
+    def _compact_if_needed(self):
+        live = len(self._sid_rows)
+        if self._dead_rows > max(64, live) or self._target_type(live) != self._active_type:
+            self.rebuild([(sid, self._vectors[row].copy()) for sid, row in self._sid_rows.items()])
+
+    # ---- Incremental maintenance ----
+    def add(self, session_id, embedding):
+        vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        with self._lock:
+            if session_id in self._sid_rows:
+                self._remove_locked(session_id)
+            if self.dim is None:
+                self.dim = vec.shape[0]
+            if vec.shape[0] != self.dim:
+                raise ValueError(f"Embedding dim {vec.shape[0]} does not match index dim {self.dim}")
+            if self._index is None:
+                self._index = self._create_index(INDEX_TYPE_FLAT)
+                self._active_type = INDEX_TYPE_FLAT
+            row = len(self._row_sids)
+            self._ensure_capacity(row + 1)
+            self._vectors[row] = vec
+            self._alive[row] = True
+            self._row_sids.append(session_id)
+            self._sid_rows[session_id] = row
+            self._index.add_with_ids(vec.reshape(1, -1), np.array([row], dtype=np.int64))
+            self._dirty = True
+            self._compact_if_needed()
+
+    def update(self, session_id, embedding):
+        self.add(session_id, embedding)
+
+    def _remove_locked(self, session_id):
+        row = self._sid_rows.pop(session_id, None)
+        if row is None:
+            return False
+        self._row_sids[row] = None
+        self._alive[row] = False
+        self._dead_rows += 1
+        if self._active_type != INDEX_TYPE_HNSW:
+            # HNSW does not support removal; its rows are filtered as tombstones at search time
+            self._index.remove_ids(np.array([row], dtype=np.int64))
+        self._dirty = True
+        return True
+
+    def remove(self, session_id):
+        with self._lock:
+            removed = self._remove_locked(session_id)
+            if removed:
+                self._compact_if_needed()
+            return removed
+
+    # ---- Query ----
+    def score_all(self, query_vec):
+        """
+        对所有 session 做一次精确内积（与 faiss 索引类型无关），返回 (scores, row_sids, sid_rows)：
+        scores 按内部行号排列，已删除的行为 -inf；row_sids / sid_rows 为只读的行号映射。
+        """
+        with self._lock:
+            rows = len(self._row_sids)
+            if not rows or self._vectors is None:
+                return np.zeros(0, dtype=np.float32), [], {}
+            query = np.asarray(query_vec, dtype=np.float32).reshape(-1)
+            scores = self._vectors[:rows] @ query
+            if self._dead_rows:
+                scores[~self._alive[:rows]] = -np.inf
+            return scores, self._row_sids, self._sid_rows
+
+    def search(self, query_vec, top_k):
+        """返回 [(session_id, score), ...]，按 score 降序"""
+        with self._lock:
+            live = len(self._sid_rows)
+            if not live or self._index is None:
+                return []
+            k = min(top_k, live)
+            # Over-fetch so tombstoned HNSW rows do not shrink the result set
+            fetch = min(k + (self._dead_rows if self._active_type == INDEX_TYPE_HNSW else 0), len(self._row_sids))
+            query = np.asarray(query_vec, dtype=np.float32).reshape(1, -1)
+            distances, indices = self._index.search(query, fetch)
+            results = []
+            for score, row in zip(distances[0], indices[0]):
+                if row < 0:
+                    continue
+                sid = self._row_sids[row]
+                if sid is None:
+                    continue
+                results.append((sid, float(score)))
+                if len(results) >= k:
+                    break
+            return results
+
+    # ---- Persistence ----
+    def save(self, base_path):
+        """写入 <base_path>.faiss / .npy / .json，仅在结构变化后写盘"""
+        with self._lock:
+            if not self._dirty:
+                return
+            ensure_directory_exists(base_path)
+            meta = {
+                "index_type": self.index_type,
+                "active_type": self._active_type,
+                "dim": self.dim,
+                "row_sids": self._row_sids,
+                "dead_rows": self._dead_rows,
+            }
+            try:
+                if self._index is not None:
+                    faiss.write_index(self._index, f"{base_path}.faiss")
+                    np.save(f"{base_path}.npy", self._vectors[:len(self._row_sids)])
+                elif os.path.exists(f"{base_path}.faiss"):
+                    os.remove(f"{base_path}.faiss")
+                with open(f"{base_path}.json", "w", encoding="utf-8") as f:
+                    json.dump(meta, f, ensure_ascii=False)
+                self._dirty = False
+            except (IOError, RuntimeError) as e:
+                print(f"SessionSummaryIndex: Error saving index to {base_path}: {e}")
+
+    def load(self, base_path, expected_session_ids):
+        """
+        从磁盘加载索引。若索引与当前 sessions 不一致则返回 False，由调用方重建。
+        """
+        expected = set(expected_session_ids)
+        try:
+            with open(f"{base_path}.json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("index_type") != self.index_type:
+                return False
+            row_sids = meta.get("row_sids", [])
+            live_sids = [sid for sid in row_sids if sid is not None]
+            if set(live_sids) != expected or len(live_sids) != len(expected):
+                return False
+            if not expected:
+                return False
+            index = faiss.read_index(f"{base_path}.faiss")
+            vectors = np.load(f"{base_path}.npy")
+        except (FileNotFoundError, json.JSONDecodeError, RuntimeError, ValueError, OSError):
+            return False
+
+        with self._lock:
+            self.dim = meta.get("dim")
+            self._active_type = meta.get("active_type", INDEX_TYPE_FLAT)
+            self._index = index
+            if self._active_type == INDEX_TYPE_IVF:
+                faiss.extract_index_ivf(index).nprobe = self.ivf_nprobe
+            self._row_sids = row_sids
+            self._sid_rows = {sid: row for row, sid in enumerate(row_sids) if sid is not None}
+            self._dead_rows = meta.get("dead_rows", len(row_sids) - len(self._sid_rows))
+            self._vectors = None
+            self._ensure_capacity(len(row_sids))
+            self._vectors[:len(row_sids)] = vectors
+            self._alive[:len(row_sids)] = [sid is not None for sid in row_sids]
+            self._dirty = False
+        return True
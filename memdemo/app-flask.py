@@ -699,7 +699,7 @@ def get_memory_state():
                 'heat': session_data.get('H_segment', 0),
                 'visit_count': session_data.get('N_visit', 0),
                 'last_visit': session_data.get('last_visit_time', ''),
-                'page_count': len(session_data.get('details', []))
+                'page_count': len(session_data.get('page_ids', []))
             })
         
         # Sort by heat
@@ -745,8 +745,8 @@ def trigger_analysis():
         
         # Check if there are any unanalyzed pages in mid-term memory
         has_unanalyzed_pages = False
-        for session_data in memory_system.mid_term_memory.sessions.values():
-            unanalyzed_pages = [p for p in session_data.get('details', []) if not p.get('analyzed', False)]
+        for sid in memory_system.mid_term_memory.sessions:
+            unanalyzed_pages = [p for p in memory_system.mid_term_memory.get_session_details(sid) if not p.get('analyzed', False)]
             if unanalyzed_pages:
                 has_unanalyzed_pages = True
                 break
@@ -27,6 +27,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 # Import memcontext modules directly
 from memcontext import Memcontext
+from memcontext.runtime import MemcontextRuntime
 from memcontext.utils import get_timestamp
 
 # 创建 FastAPI 应用
@@ -44,11 +45,14 @@ app.add_middleware(
 # 线程池用于执行同步操作
 executor = ThreadPoolExecutor(max_workers=10)
 
-# Global memcontext instance (in production, you'd use proper session management)
-memory_systems: Dict[str, Memcontext] = {}
-# Session storage: session_id -> user_id mapping
+# 进程级共享运行时：所有会话的 Memcontext 共用 LLM 客户端、线程池与并发上限，空闲会话自动回收
+runtime = MemcontextRuntime(max_workers=10, max_concurrency=32, idle_timeout=30 * 60, max_users=1000)
+# Session storage: session_id -> user_id mapping and the Memcontext constructor kwargs
 session_storage: Dict[str, Dict[str, Any]] = {}
 
+def create_memory_system(memory_kwargs: Dict[str, Any]) -> Memcontext:
+    return Memcontext(runtime=runtime, **memory_kwargs)
+
 # 商品数据(用于广告推荐)
 ad_data_dir = os.path.join(os.path.dirname(__file__), 'ad_data')
 with open(os.path.join(ad_data_dir, 'ad_demo_format.json'), 'r', encoding='utf-8') as f: 
@@ -77,9 +81,11 @@ async def get_session_id(request: Request) -> Optional[str]:
 # 依赖注入：获取 memory_system
 async def get_memory_system(session_id: Optional[str] = Depends(get_session_id)) -> Memcontext:
     """获取 memory_system，如果不存在则抛出异常"""
-    if not session_id or session_id not in memory_systems:
+    if not session_id or session_id not in session_storage:
         raise HTTPException(status_code=400, detail='Memory system not initialized')
-    return memory_systems[session_id]
+    # 被空闲回收的会话按保存的参数重新加载（记忆均已持久化在磁盘上）
+    memory_kwargs = session_storage[session_id]['memory_kwargs']
+    return runtime.get_user(session_id, lambda: create_memory_system(memory_kwargs))
 
 @app.get('/')
 async def index():
@@ -138,7 +144,7 @@ async def init_memory(request_data: InitMemoryRequest):
             project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
             file_storage_base_path = project_root
         
-        memory_system = Memcontext(
+        memory_kwargs = dict(
             user_id=user_id,
             openai_api_key=api_key,
             openai_base_url=base_url,
@@ -153,11 +159,13 @@ async def init_memory(request_data: InitMemoryRequest):
             llm_model=model,
             file_storage_base_path=file_storage_base_path
         )
+        memory_system = create_memory_system(memory_kwargs)
         
         session_id = secrets.token_hex(8)
-        memory_systems[session_id] = memory_system
+        runtime.register_user(session_id, memory_system)
         session_storage[session_id] = {
             'user_id': user_id,
+            'memory_kwargs': memory_kwargs,
             'memory_config': {
                 'api_key': api_key,
                 'base_url': base_url,
@@ -337,8 +345,8 @@ async def chat(request_data: ChatRequest, memory_system: Memcontext = Depends(ge
         )
 
         try:
-            # 优先处理聊天流
-            for chunk in memory_system.get_response_stream(user_input):
+            # 优先处理聊天流（asyncio 原生，不占用线程池）
+            async for chunk in memory_system.aget_response_stream(user_input):
                 yield f"data: {json.dumps({'response': chunk}, ensure_ascii=False)}\n\n"
             
             # 发送文字结束信号
@@ -460,7 +468,7 @@ async def import_from_cache_endpoint(request_data: ImportCacheRequest, memory_sy
         
         # 使用正常流程：逐个添加到 short_term
         for mem in memories_to_add:
-            memory_system.add_memory(
+            await memory_system.aadd_memory(
                 user_input=mem["user_input"],
                 agent_response=mem["agent_response"],
                 timestamp=mem["timestamp"],
@@ -680,7 +688,7 @@ async def get_memory_state(memory_system: Memcontext = Depends(get_memory_system
                 'heat': session_data.get('H_segment', 0),
                 'visit_count': session_data.get('N_visit', 0),
                 'last_visit': session_data.get('last_visit_time', ''),
-                'page_count': len(session_data.get('details', []))
+                'page_count': len(session_data.get('page_ids', []))
             })
         
         mid_term_sessions.sort(key=lambda x: x['heat'], reverse=True)
@@ -716,8 +724,8 @@ async def trigger_analysis(memory_system: Memcontext = Depends(get_memory_system
             raise HTTPException(status_code=400, detail='No Mid-term memory, but at least keep short-term memory for seven rounds.')
         
         has_unanalyzed_pages = False
-        for session_data in memory_system.mid_term_memory.sessions.values():
-            unanalyzed_pages = [p for p in session_data.get('details', []) if not p.get('analyzed', False)]
+        for sid in memory_system.mid_term_memory.sessions:
+            unanalyzed_pages = [p for p in memory_system.mid_term_memory.get_session_details(sid) if not p.get('analyzed', False)]
             if unanalyzed_pages:
                 has_unanalyzed_pages = True
                 break
@@ -847,7 +855,7 @@ async def clear_memory(request: Request, memory_system: Memcontext = Depends(get
         data_path = memory_system.data_storage_path
         embedding_model = os.environ.get('EMBEDDING_MODEL', 'doubao-embedding-large-text-250515').strip()
         
-        new_memory_system = Memcontext(
+        memory_kwargs = dict(
             user_id=user_id,
             openai_api_key=api_key,
             openai_base_url=base_url,
@@ -861,8 +869,10 @@ async def clear_memory(request: Request, memory_system: Memcontext = Depends(get
             embedding_model_name=embedding_model, 
             embedding_model_kwargs={}
         )
+        new_memory_system = create_memory_system(memory_kwargs)
         
-        memory_systems[session_id] = new_memory_system
+        runtime.register_user(session_id, new_memory_system)
+        session_storage[session_id]['memory_kwargs'] = memory_kwargs
         
         return {'success': True, 'message': 'All memories cleared successfully'}
     except HTTPException:
@@ -885,7 +895,7 @@ async def import_conversations(request_data: ImportConversationsRequest, memory_
             timestamp = conv.get('timestamp', get_timestamp())
             
             if user_input and agent_response:
-                memory_system.add_memory(
+                await memory_system.aadd_memory(
                     user_input=user_input,
                     agent_response=agent_response,
                     timestamp=timestamp